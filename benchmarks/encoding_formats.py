@@ -0,0 +1,58 @@
+"""
+Encoding benchmark for the list response formats
+
+Encodes a list of serialized Inventory records with every supported
+representation and reports the encode time and payload size, raw and
+gzipped.
+
+  python -m benchmarks.encoding_formats --rows 10000
+"""
+import argparse
+import gzip
+import random
+import timeit
+
+from flask_restx import marshal
+from service import app
+from service.common import representations
+from service.models import Inventory
+from service.routes import inventory_model
+
+
+def sample_records(rows):
+    """Builds marshalled records like InventoryCollection.get returns"""
+    conditions = list(Inventory.Condition)
+    records = [
+        Inventory(product_id=i, name=random.choice(["laptop", "monitor", "desk", "chair"]),
+                  condition=random.choice(conditions), quantity=random.randint(0, 500),
+                  active=random.random() > 0.1).serialize()
+        for i in range(rows)
+    ]
+    return marshal(records, inventory_model)
+
+
+def main():
+    """Benchmarks each representation and prints a table"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    data = sample_records(args.rows)
+    outputs = {
+        "json": representations.output_vary_json,
+        "columnar json": representations.output_columnar,
+    }
+    if representations.msgpack is not None:
+        outputs["msgpack"] = representations.output_msgpack
+
+    print(f"{args.rows} rows")
+    print(f"{'format':>14} {'encode ms':>10} {'bytes':>10} {'gzip bytes':>11}")
+    with app.test_request_context():
+        for name, output in outputs.items():
+            seconds = min(timeit.repeat(lambda out=output: out(data, 200), number=1, repeat=args.repeat))
+            body = output(data, 200).get_data()
+            print(f"{name:>14} {seconds * 1000:>10.1f} {len(body):>10} {len(gzip.compress(body)):>11}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Request validation benchmark
+
+Validates generated request bodies, a tenth of them invalid, with the
+compiled validator behind Inventory.deserialize and with the per-field
+checks it replaced, and reports rows per second for each. Both deserialize paths set the
+attributes of a record; validate and validate_many only return the clean
+values, as bulk imports use them.
+
+  python -m benchmarks.validation --rows 100000
+"""
+import argparse
+import random
+import timeit
+
+from service.models import DataValidationError, Inventory, OutOfRangeError
+
+
+def legacy_deserialize(record, data):
+    """The checks Inventory.deserialize made before validation was compiled"""
+    try:
+        if not isinstance(data, dict) or data == {}:
+            raise TypeError
+        if data.get("product_id") is not None and data.get("condition") is not None:
+            if isinstance(data.get("product_id"), int) and isinstance(data.get("condition"), str):
+                record.product_id = data.get("product_id")
+                record.condition = Inventory.Condition(data.get("condition"))
+        if data.get("name"):
+            if not isinstance(data.get("name"), str):
+                raise TypeError
+            record.name = data.get("name")
+        if data.get("active") is not None:
+            if not isinstance(data.get("active"), bool):
+                raise TypeError
+            record.active = data.get("active")
+        if data.get("quantity"):
+            if not isinstance(data.get("quantity"), int):
+                raise TypeError
+            if data.get("quantity") < 0:
+                raise ValueError
+            record.quantity = data.get("quantity")
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def deserialize(record, data):
+    """Inventory.deserialize, errors counted as a failed row"""
+    try:
+        record.deserialize(data)
+    except (DataValidationError, OutOfRangeError):
+        return False
+    return True
+
+
+def sample_rows(rows):
+    """Builds request bodies, one in ten with a bad value"""
+    conditions = [condition.value for condition in Inventory.Condition]
+    bodies = []
+    for i in range(rows):
+        body = {"product_id": i, "name": random.choice(["laptop", "monitor", "desk", "chair"]),
+                "condition": random.choice(conditions), "quantity": random.randint(1, 500),
+                "active": random.random() > 0.1}
+        if i % 10 == 0:
+            body[random.choice(["name", "quantity", "active"])] = random.choice([-1, "x", 7])
+        bodies.append(body)
+    return bodies
+
+
+def main():
+    """Benchmarks both validation paths and prints a table"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    bodies = sample_rows(args.rows)
+    record = Inventory()
+    paths = {
+        "legacy checks": lambda: [legacy_deserialize(record, body) for body in bodies],
+        "deserialize": lambda: [deserialize(record, body) for body in bodies],
+        "validate": lambda: [Inventory.validator.validate(body) for body in bodies],
+        "validate_many": lambda: Inventory.validator.validate_many(bodies),
+    }
+
+    print(f"{args.rows} rows")
+    print(f"{'path':>14} {'rows/s':>12}")
+    for name, path in paths.items():
+        seconds = min(timeit.repeat(path, number=1, repeat=args.repeat))
+        print(f"{name:>14} {args.rows / seconds:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
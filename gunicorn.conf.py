@@ -0,0 +1,104 @@
+"""
+Gunicorn configuration
+
+Gunicorn reads this file from the working directory, so ``gunicorn
+service:app`` picks it up. Every setting can be tuned from the environment:
+
+  GUNICORN_WORKERS            worker processes (default 2)
+  GUNICORN_WORKER_CLASS       gthread (default), sync or gevent
+  GUNICORN_THREADS            threads per gthread worker (default 8)
+  GUNICORN_WORKER_CONNECTIONS concurrent requests per gevent worker (default 100)
+  GUNICORN_PRELOAD            load the app once in the master (default true, false for gevent)
+  GUNICORN_MAX_REQUESTS       recycle a worker after this many requests (default 1000, 0 = never)
+  GUNICORN_MAX_REQUESTS_JITTER  random extra requests so workers do not recycle together (default 100)
+  GUNICORN_MAX_WORKER_MEMORY_MB recycle a worker once its resident memory exceeds this (default 0 = never)
+  GUNICORN_TIMEOUT            seconds before a silent worker is killed (default 30)
+  GUNICORN_KEEPALIVE          seconds to keep idle connections open (default 5)
+  GUNICORN_LOG_LEVEL          default info
+
+Preloading imports the app, and with it the database setup, in the master
+so the workers share its memory copy-on-write. The master freezes the
+objects it allocated out of the garbage collector's reach, so collections
+in the workers do not touch (and copy) those pages, and closes its
+database connections before forking; each worker then forgets whatever
+connections it inherited and opens its own.
+
+Stock streams and CSV exports hold a thread (or a gevent greenlet) until
+their body is sent. Unless STREAM_MAX_PER_WORKER and EXPORT_MAX_PER_WORKER
+are set, each may take a quarter of a worker's threads or connections, so
+half are always left for other requests; sync workers, which serve one
+request at a time, refuse streams and send one export at a time.
+"""
+import gc
+import os
+import sys
+
+
+def _env_bool(name, default):
+    return os.getenv(name, str(default)).lower() in ("1", "true", "yes")
+
+
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '8080')}")
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+# read by the app's config, which is loaded after this file
+_concurrency = {"gthread": threads, "gevent": worker_connections}.get(worker_class, 1)
+os.environ.setdefault("STREAM_MAX_PER_WORKER", str(_concurrency // 4))
+os.environ.setdefault("EXPORT_MAX_PER_WORKER", str(max(1, _concurrency // 4)))
+# gevent has to patch the standard library before the app creates its locks and threads
+preload_app = _env_bool("GUNICORN_PRELOAD", worker_class != "gevent")
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "100"))
+max_worker_memory_mb = int(os.getenv("GUNICORN_MAX_WORKER_MEMORY_MB", "0"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = timeout
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+
+def _app_loaded():
+    """True in a process that has imported the app, e.g. the master with preload_app"""
+    return "service.models" in sys.modules
+
+
+def when_ready(server):  # pylint: disable=unused-argument
+    """Runs in the master once it is listening, before the first fork"""
+    if _app_loaded():
+        from service.models import dispose_connections  # pylint: disable=import-outside-toplevel
+        dispose_connections(close=True)
+        gc.freeze()
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Runs in each new worker"""
+    if _app_loaded():
+        from service.models import dispose_connections  # pylint: disable=import-outside-toplevel
+        dispose_connections(close=False)
+
+
+def post_worker_init(worker):  # pylint: disable=unused-argument
+    """Runs in each worker once it is set up, after gevent patched the standard library"""
+    if worker_class == "gevent":
+        try:
+            from psycogreen.gevent import patch_psycopg  # pylint: disable=import-outside-toplevel
+        except ImportError:
+            worker.log.warning("psycogreen is not installed: database calls will block gevent workers")
+        else:
+            patch_psycopg()
+
+
+def _resident_mb():
+    """Returns the resident memory of this process in MB"""
+    with open("/proc/self/statm", encoding="ascii") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def post_request(worker, req, environ, resp):  # pylint: disable=unused-argument
+    """Recycles a worker that grew past GUNICORN_MAX_WORKER_MEMORY_MB once its request is done"""
+    if max_worker_memory_mb and os.path.exists("/proc/self/statm") and worker.alive:
+        resident = _resident_mb()
+        if resident > max_worker_memory_mb:
+            worker.log.info("Recycling worker %s using %.0f MB", worker.pid, resident)
+            worker.alive = False
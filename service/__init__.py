@@ -33,6 +33,10 @@ api = Api(
 from service import routes         # noqa: E402, E261
 # pylint: disable=wrong-import-position
 from .common import error_handlers  # noqa: F401 E402
+# pylint: disable=wrong-import-position
+from .commands import inventory_cli  # noqa: E402
+
+app.cli.add_command(inventory_cli)
 
 # Set up logging for production
 log_handlers.init_logging(app, "gunicorn.error")
@@ -0,0 +1,272 @@
+"""
+Admission Control
+
+Every queued route needs one of a limited number of slots per worker
+process. Requests beyond the limit wait in a bounded queue, highest
+priority first (checkouts before writes before lists and exports); when
+the queue is full, or a request waited ADMISSION_MAX_WAIT_MS, it is
+rejected right away with 503 and a Retry-After header instead of piling
+up until the pod runs out of memory. A full queue makes room for a more
+important request by rejecting its least important waiter.
+
+The limit adapts to the database: once every ADMISSION_WINDOW_SECONDS the
+90th percentile duration of the queries run in that window is compared
+with ADMISSION_TARGET_DB_MS. The percentile is taken over a uniform
+sample of at most WINDOW_SAMPLES queries, so a handful of very slow
+queries (an export, a checkpoint) cannot shrink the limit on their own,
+while a slowdown of the bulk of the traffic still does. Slower queries
+shrink the limit by 10%, and a window that used every slot with fast
+queries grows it by one (additive increase, multiplicative decrease)
+between the minimum and maximum limits.
+"""
+import heapq
+import itertools
+import math
+import random
+import threading
+import time
+
+from flask import jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from service.common import status
+
+CRITICAL, NORMAL, LOW = 0, 1, 2
+DECREASE_FACTOR = 0.9
+PERCENTILE = 0.9
+WINDOW_SAMPLES = 512
+ACQUIRED_KEY = "inventory.admitted"
+QUERY_STARTED_KEY = "inventory.query_started"
+
+
+class _Waiter:  # pylint: disable=too-few-public-methods
+    """A request waiting for a slot"""
+
+    __slots__ = ("priority", "order", "event", "admitted", "cancelled")
+
+    def __init__(self, priority, order):
+        self.priority = priority
+        self.order = order
+        self.event = threading.Event()
+        self.admitted = False
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.priority, self.order) < (other.priority, other.order)
+
+
+class AdmissionController:
+    """Adaptive concurrency limit with a bounded priority queue"""
+
+    def __init__(self, limit=16, min_limit=2, max_limit=64, queue_size=32,
+                 target_db_seconds=0.05, window_seconds=1.0, clock=time.monotonic):
+        self.limit = float(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.queue_size = queue_size
+        self.target_db_seconds = target_db_seconds
+        self.window_seconds = window_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._order = itertools.count()
+        self._waiting = []
+        self._queued = 0
+        self.in_flight = 0
+        self._window_started = clock()
+        self._window_queries = 0
+        self._window_samples = []
+        self._window_saturated = False
+        self.last_db_seconds = 0.0
+        self.admitted = 0
+        self.rejected = 0
+
+    def acquire(self, priority, timeout):
+        """Waits up to timeout seconds for a slot; returns False when rejected"""
+        with self._lock:
+            self._adjust()
+            if self.in_flight < int(self.limit) and not self._queued:
+                return self._admit()
+            self._window_saturated = True
+            if self._queued >= self.queue_size and not self._evict(priority):
+                self.rejected += 1
+                return False
+            waiter = _Waiter(priority, next(self._order))
+            heapq.heappush(self._waiting, waiter)
+            self._queued += 1
+        waiter.event.wait(timeout)
+        with self._lock:
+            if waiter.admitted:
+                return True
+            if not waiter.cancelled:
+                waiter.cancelled = True
+                self._queued -= 1
+            self.rejected += 1
+            return False
+
+    def release(self):
+        """Frees the slot of a finished request and admits the next waiter"""
+        with self._lock:
+            self.in_flight -= 1
+            self._adjust()
+            self._admit_waiting()
+
+    def observe(self, seconds):
+        """Records the duration of one database query"""
+        with self._lock:
+            self._window_queries += 1
+            if len(self._window_samples) < WINDOW_SAMPLES:
+                self._window_samples.append(seconds)
+            else:
+                # reservoir sampling keeps every query of the window equally likely to be kept
+                kept = random.randrange(self._window_queries)
+                if kept < WINDOW_SAMPLES:
+                    self._window_samples[kept] = seconds
+
+    def _admit(self):
+        self.in_flight += 1
+        self.admitted += 1
+        if self.in_flight >= int(self.limit):
+            self._window_saturated = True
+        return True
+
+    def _admit_waiting(self):
+        while self._waiting and self.in_flight < int(self.limit):
+            waiter = heapq.heappop(self._waiting)
+            if waiter.cancelled:
+                continue
+            self._queued -= 1
+            waiter.admitted = True
+            self._admit()
+            waiter.event.set()
+
+    def _evict(self, priority):
+        """Rejects the least important waiter if it is less important than priority"""
+        live = [waiter for waiter in self._waiting if not waiter.cancelled]
+        worst = max(live, default=None)
+        if worst is None or worst.priority <= priority:
+            return False
+        worst.cancelled = True
+        self._queued -= 1
+        worst.event.set()
+        return True
+
+    def _adjust(self):
+        """Moves the limit once per window according to the database latency"""
+        now = self._clock()
+        if now - self._window_started < self.window_seconds:
+            return
+        if self._window_samples:
+            samples = sorted(self._window_samples)
+            self.last_db_seconds = samples[math.ceil(PERCENTILE * len(samples)) - 1]
+            if self.last_db_seconds > self.target_db_seconds:
+                self.limit = max(self.min_limit, self.limit * DECREASE_FACTOR)
+            elif self._window_saturated:
+                self.limit = min(self.max_limit, self.limit + 1)
+        self._window_started = now
+        self._window_queries = 0
+        self._window_samples = []
+        self._window_saturated = self.in_flight >= int(self.limit)
+        self._admit_waiting()
+
+    def stats(self):
+        """Returns the current limit, load and counts of admitted and rejected requests"""
+        with self._lock:
+            return {"limit": int(self.limit), "in_flight": self.in_flight, "queued": self._queued,
+                    "admitted": self.admitted, "rejected": self.rejected,
+                    "db_ms": round(self.last_db_seconds * 1000, 2)}
+
+
+controller = AdmissionController()
+
+
+class ResponseSlots:
+    """Caps the long-lived responses of one kind a worker sends at once
+
+    A streamed response holds a thread of a gthread worker until its body
+    is sent, so the cap has to stay below the thread count for other
+    requests to be served meanwhile.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open = 0
+        self.rejected = 0
+
+    def acquire(self, limit):
+        """Takes a slot unless limit responses are open; returns whether it did"""
+        with self._lock:
+            if self.open >= limit:
+                self.rejected += 1
+                return False
+            self.open += 1
+            return True
+
+    def release(self):
+        """Frees the slot of a finished response"""
+        with self._lock:
+            self.open -= 1
+
+    def stats(self):
+        """Returns the open responses and how many were turned away"""
+        with self._lock:
+            return {"open": self.open, "rejected": self.rejected}
+
+
+# Server-Sent Event streams and CSV exports of this worker
+streams = ResponseSlots()
+exports = ResponseSlots()
+
+
+def _query_started(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=too-many-arguments
+    # a connection runs one query at a time
+    conn.info[QUERY_STARTED_KEY] = time.monotonic()
+
+
+def _query_finished(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=too-many-arguments
+    started = conn.info.pop(QUERY_STARTED_KEY, None)
+    if started is not None:
+        controller.observe(time.monotonic() - started)
+
+
+def init_admission(app, priorities):
+    """Queues the requests of the routes in priorities ({endpoint or 'endpoint:METHOD': priority})
+
+    Requests to other routes (health checks, docs, assets, streams) are never queued.
+    """
+    controller.limit = float(app.config["ADMISSION_LIMIT"])
+    controller.min_limit = app.config["ADMISSION_MIN_LIMIT"]
+    controller.max_limit = app.config["ADMISSION_MAX_LIMIT"]
+    controller.queue_size = app.config["ADMISSION_QUEUE_SIZE"]
+    controller.target_db_seconds = app.config["ADMISSION_TARGET_DB_MS"] / 1000
+    controller.window_seconds = app.config["ADMISSION_WINDOW_SECONDS"]
+    if not event.contains(Engine, "before_cursor_execute", _query_started):
+        event.listen(Engine, "before_cursor_execute", _query_started)
+        event.listen(Engine, "after_cursor_execute", _query_finished)
+
+    @app.before_request
+    def admit():  # pylint: disable=unused-variable
+        if not app.config["ADMISSION_CONTROL"]:
+            return None
+        priority = priorities.get(f"{request.endpoint}:{request.method}", priorities.get(request.endpoint))
+        if priority is None:
+            return None
+        if controller.acquire(priority, app.config["ADMISSION_MAX_WAIT_MS"] / 1000):
+            request.environ[ACQUIRED_KEY] = True
+            return None
+        app.logger.warning("Shedding %s %s: %s", request.method, request.path, controller.stats())
+        retry_after = math.ceil(app.config["ADMISSION_RETRY_AFTER_SECONDS"])
+        return (jsonify(status=status.HTTP_503_SERVICE_UNAVAILABLE, error="Service Unavailable",
+                        message="The service is overloaded, please retry later."),
+                status.HTTP_503_SERVICE_UNAVAILABLE, {"Retry-After": str(retry_after)})
+
+    @app.after_request
+    def release_after(response):  # pylint: disable=unused-variable
+        # a streamed body (like a CSV export) is sent after the request tears down
+        if response.is_streamed and request.environ.pop(ACQUIRED_KEY, False):
+            response.call_on_close(controller.release)
+        return response
+
+    @app.teardown_request
+    def release(error=None):  # pylint: disable=unused-variable,unused-argument
+        if request.environ.pop(ACQUIRED_KEY, False):
+            controller.release()
@@ -0,0 +1,139 @@
+"""
+Group Commit
+
+This module coalesces concurrent checkout and reorder requests into a
+single database transaction.
+
+Request threads hand their line to the per-process GroupCommitter and
+block. A background thread collects every line that arrives within the
+batch window (or until the batch is full), applies each one inside its own
+SAVEPOINT so a failing line does not affect its neighbours, and commits
+the whole batch once. Each caller then receives its own result or error.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+
+from flask import current_app
+from service.models import DataValidationError, InactiveRecordError, Inventory, OutOfRangeError, db
+
+logger = logging.getLogger("flask.app")
+
+LINE_ERRORS = (DataValidationError, InactiveRecordError, OutOfRangeError)
+
+
+class BatchLine:
+    """One checkout or reorder waiting to be applied"""
+
+    __slots__ = ("operation", "key", "data", "result", "error", "done")
+
+    def __init__(self, operation, key, data):
+        self.operation = operation
+        self.key = key
+        self.data = data
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    """Per-process batching of checkout/reorder lines into one commit"""
+
+    OPERATIONS = {"checkout": "apply_checkout", "reorder": "apply_reorder"}
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.app = None
+        self.batches = 0
+        self.lines = 0
+
+    def submit(self, operation, product_id, condition, data):
+        """Applies an operation as part of the next batch
+
+        Returns:
+            tuple: the serialized record and the location a checkout was
+            allocated from (or None), or None if the record does not exist
+        """
+        if operation not in self.OPERATIONS:
+            raise ValueError(f"Unsupported batch operation '{operation}'")
+        if not isinstance(data, dict):
+            raise DataValidationError("Ordered quantity is missing or not int.")
+        line = BatchLine(operation, (product_id, condition), data)
+        self._ensure_worker()
+        self._queue.put(line)
+        line.done.wait()
+        if line.error is not None:
+            raise line.error
+        return line.result
+
+    def stats(self):
+        """Returns how many batches and lines have been committed"""
+        return {"batches": self.batches, "lines": self.lines}
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self.app is None:
+                self.app = current_app._get_current_object()  # pylint: disable=protected-access
+            # a worker started before a fork does not exist in the child
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            window = self.app.config["CHECKOUT_BATCH_WINDOW_MS"] / 1000
+            max_size = self.app.config["CHECKOUT_BATCH_MAX_SIZE"]
+            deadline = time.monotonic() + window
+            while len(batch) < max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._apply(batch)
+
+    def _apply(self, batch):
+        with self.app.app_context():
+            try:
+                # a stable order keeps row locks from deadlocking across workers
+                for line in sorted(batch, key=lambda line: tuple(map(str, line.key))):
+                    self._apply_line(line)
+                db.session.commit()
+                self.batches += 1
+                self.lines += len(batch)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error("Group commit of %d lines failed: %s", len(batch), error)
+                db.session.rollback()
+                for line in batch:
+                    line.result, line.error = None, line.error or error
+            finally:
+                db.session.remove()
+                for line in batch:
+                    line.done.set()
+
+    def _apply_line(self, line):
+        try:
+            with db.session.begin_nested():
+                record = Inventory.find(line.key)
+                if record is None:
+                    return
+                if not record.shard_count:
+                    # sharded records are updated through their shards instead
+                    db.session.refresh(record, with_for_update=True)
+                getattr(record, self.OPERATIONS[line.operation])(line.data)
+            record.stage_change()
+            line.result = (record.serialize(), record.allocated_from)
+        except LINE_ERRORS as error:
+            line.error = error
+
+
+group_committer = GroupCommitter()
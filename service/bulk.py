@@ -0,0 +1,426 @@
+"""
+Bulk CSV Import and Export
+
+This module loads inventory records from CSV much faster than posting
+them one at a time, and streams them back out as CSV. Rows are validated with the same rules as
+Inventory.deserialize, loaded into a temporary staging table (with
+PostgreSQL COPY, or executemany on other databases) and merged into the
+inventory table with a single INSERT ... SELECT.
+
+When a file contains the same (product_id, condition) more than once the
+last row wins. Rows whose key already exists in the table are handled
+according to the on_conflict mode:
+
+  error  - nothing is imported (ImportConflictError)
+  skip   - the existing record is kept
+  update - name, quantity and active of the existing record are replaced,
+           except for records kept in shards or locations, which are skipped
+
+Exports use PostgreSQL COPY ... TO STDOUT, fed to the response by a
+background thread through a bounded queue, or a chunked cursor on other
+databases, so memory stays constant however many rows are exported. The
+exported file has the same columns as the import format.
+
+Every record an import writes is recorded in the stock history and sent
+as a stock event once the import commits, like a single-record change.
+"""
+import csv
+import io
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import Boolean, Column, Integer, MetaData, String, Table, and_, case, cast, exists, func, literal, select
+from sqlalchemy.dialects import postgresql, sqlite
+from service.models import (DataValidationError, Inventory, InventoryHistory, OutOfRangeError, db,
+                            stage_result_invalidation)
+from service.notifications import broadcaster
+from service.replicas import read_engine
+
+logger = logging.getLogger("flask.app")
+
+ON_CONFLICT = ("error", "skip", "update")
+FIELDS = ("product_id", "name", "condition", "quantity", "active")
+TRUE_VALUES = ("true", "t", "1", "yes")
+FALSE_VALUES = ("false", "f", "0", "no")
+MAX_REPORTED_REJECTS = 1000
+COPY_CHUNK_BYTES = 64 * 1024
+COPY_QUEUED_CHUNKS = 16
+COPY_PUT_TIMEOUT_SECONDS = 0.5  # how often a COPY waiting on a slow reader checks for cancellation
+COPY_JOIN_SECONDS = 5
+
+staging = Table(
+    "inventory_import", MetaData(),
+    Column("line", Integer, nullable=False),
+    Column("product_id", Integer, nullable=False),
+    Column("name", String(63), nullable=False),
+    # the condition name ('NEW'), cast to the enum when merging
+    Column("condition", String(16), nullable=False),
+    Column("quantity", Integer, nullable=False),
+    Column("active", Boolean, nullable=False),
+    prefixes=["TEMPORARY"],
+    postgresql_on_commit="DROP",
+)
+
+
+class ImportConflictError(Exception):
+    """ Used when imported records already exist and on_conflict is 'error' """
+
+
+def parse_values(row):
+    """Converts a CSV row into the validated values of an Inventory
+
+    Args:
+        row (dict): the row as read by csv.DictReader
+
+    Returns:
+        dict: every field of the record, quantity and active defaulted
+    """
+    data = {}
+    try:
+        for field in ("product_id", "quantity"):
+            if row.get(field):
+                data[field] = int(row[field])
+    except ValueError as error:
+        raise DataValidationError(f"Invalid Inventory: {field} must be an int") from error
+    for field in ("name", "condition"):
+        if row.get(field):
+            data[field] = row[field]
+    active = (row.get("active") or "").strip().lower()
+    if active in TRUE_VALUES + FALSE_VALUES:
+        data["active"] = active in TRUE_VALUES
+    elif active:
+        raise DataValidationError("Invalid Inventory: active must be true or false")
+    if "product_id" not in data or "condition" not in data or "name" not in data:
+        raise DataValidationError("Invalid Inventory: product_id, condition and name are required")
+
+    values = {"quantity": 0, "active": True}
+    values.update(Inventory.validated(data))
+    return values
+
+
+def parse_row(row):
+    """Converts a CSV row into a validated Inventory
+
+    Args:
+        row (dict): the row as read by csv.DictReader
+
+    Returns:
+        Inventory: an unsaved record with every field set
+    """
+    return Inventory(**parse_values(row))
+
+
+def _copy_rows(connection, rows):
+    """Loads staging rows with PostgreSQL COPY"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row["line"], row["product_id"], row["name"], row["condition"],
+                         row["quantity"], row["active"]])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {staging.name} (line, product_id, name, condition, quantity, active) "
+        "FROM STDIN WITH (FORMAT csv)", buffer
+    )
+
+
+def _load(connection, rows):
+    if not rows:
+        return
+    if connection.dialect.name == "postgresql":
+        _copy_rows(connection, rows)
+    else:
+        connection.execute(staging.insert(), rows)
+
+
+def _merge(connection, on_conflict):
+    """Moves the last row of every key from the staging table into inventory"""
+    inventory = Inventory.__table__
+    condition = cast(staging.c.condition, inventory.c.condition.type)
+    ranked = select(
+        staging.c.product_id, staging.c.name, condition.label("condition"),
+        staging.c.quantity, staging.c.active,
+        func.row_number().over(
+            partition_by=[staging.c.product_id, staging.c.condition],
+            order_by=staging.c.line.desc()
+        ).label("rank")
+    ).subquery()
+    now = datetime.utcnow()
+    latest = select(
+        ranked.c.product_id, ranked.c.name, ranked.c.condition, ranked.c.quantity,
+        ranked.c.active, literal(0), literal(now), literal(now)
+    ).where(ranked.c.rank == 1)
+
+    if on_conflict == "error":
+        conflicts = connection.execute(
+            select(func.count()).select_from(staging.join(inventory, and_(
+                inventory.c.product_id == staging.c.product_id,
+                inventory.c.condition == condition
+            )))
+        ).scalar()
+        if conflicts:
+            raise ImportConflictError(f"{conflicts} imported rows refer to records that already exist")
+    columns = ["product_id", "name", "condition", "quantity", "active",
+               "shard_count", "created_at", "updated_at"]
+    insert = (postgresql if connection.dialect.name == "postgresql" else sqlite).insert(inventory)
+    statement = insert.from_select(columns, latest)
+    if on_conflict == "skip":
+        statement = statement.on_conflict_do_nothing(index_elements=["product_id", "condition"])
+    elif on_conflict == "update":
+        statement = statement.on_conflict_do_update(
+            index_elements=["product_id", "condition"],
+            set_={"name": statement.excluded.name, "quantity": statement.excluded.quantity,
+                  "active": statement.excluded.active, "updated_at": now},
+            # sharded and located records keep their quantity in the shards and locations
+            where=and_(inventory.c.shard_count == 0, inventory.c.location_count == 0)
+        )
+    imported = connection.execute(statement).rowcount
+    _record_history(connection, now)
+    _stage_stock_events(now)
+    return imported
+
+
+def _written(now):
+    """Selects the records the merge wrote, whose updated_at is now"""
+    inventory = Inventory.__table__
+    return inventory.c.updated_at == now, exists().where(
+        staging.c.product_id == inventory.c.product_id,
+        cast(staging.c.condition, inventory.c.condition.type) == inventory.c.condition
+    )
+
+
+def _record_history(connection, now):
+    """Appends the records the merge wrote, stamped with now, to the stock history"""
+    inventory = Inventory.__table__
+    written = select(
+        inventory.c.product_id, inventory.c.condition, inventory.c.name, inventory.c.quantity,
+        inventory.c.active, literal(False), literal(now)
+    ).where(*_written(now))
+    connection.execute(InventoryHistory.__table__.insert().from_select(
+        ["product_id", "condition", "name", "quantity", "active", "deleted", "recorded_at"], written
+    ))
+
+
+def _stage_stock_events(now):
+    """Publishes the new stock of the records the merge wrote once the import commits
+
+    Stream subscribers and the result caches of every worker see them like
+    the changes of single records.
+    """
+    inventory = Inventory.__table__
+    broadcaster.stage_rows(db.session, select(
+        inventory.c.product_id,
+        func.lower(cast(inventory.c.condition, String)).label("condition"),
+        inventory.c.quantity, inventory.c.active, literal(False).label("deleted")
+    ).where(*_written(now)))
+
+
+def import_csv(lines, on_conflict="error", batch_size=5000):
+    """Imports inventory records from CSV text
+
+    Args:
+        lines (iterable): the CSV text, one line at a time, with a header row
+        on_conflict (str): one of 'error', 'skip' or 'update'
+        batch_size (int): number of rows loaded into the staging table at once
+
+    Returns:
+        dict: counts of rows read, imported and rejected, the first rejected
+        rows with their errors and the rows per second achieved
+    """
+    if on_conflict not in ON_CONFLICT:
+        raise DataValidationError(f"on_conflict must be one of {', '.join(ON_CONFLICT)}")
+    started = time.monotonic()
+    reader = csv.DictReader(lines)
+    missing = set(FIELDS[:3]) - set(reader.fieldnames or ())
+    if missing:
+        raise DataValidationError(f"CSV header is missing {', '.join(sorted(missing))}")
+
+    connection = db.session.connection()
+    staging.create(connection)
+    # PostgreSQL drops the staging table with the transaction
+    drop_staging = connection.dialect.name != "postgresql"
+    try:
+        read, rejected, batch = 0, [], []
+        rejected_count = 0
+        for row in reader:
+            read += 1
+            try:
+                values = parse_values(row)
+            except (DataValidationError, OutOfRangeError) as error:
+                rejected_count += 1
+                if len(rejected) < MAX_REPORTED_REJECTS:
+                    rejected.append({"line": reader.line_num, "error": " ".join(str(error).split())})
+                continue
+            values["line"], values["condition"] = reader.line_num, values["condition"].name
+            batch.append(values)
+            if len(batch) >= batch_size:
+                _load(connection, batch)
+                batch = []
+        _load(connection, batch)
+        imported = _merge(connection, on_conflict)
+        # the merge writes through the connection, out of sight of the session events
+        stage_result_invalidation(db.session)
+    finally:
+        if drop_staging:
+            staging.drop(connection)
+    db.session.commit()
+    elapsed = time.monotonic() - started
+    logger.info("Imported %d of %d CSV rows in %.2fs", imported, read, elapsed)
+    return {
+        "read": read,
+        "imported": imported,
+        "rejected": rejected_count,
+        "rejected_rows": rejected,
+        "rows_per_second": round(read / elapsed) if elapsed else read,
+    }
+
+
+def export_statement(by_filters):
+    """Builds the SELECT of an export filtered like find_by_general_filter
+
+    Raises:
+        DataValidationError: when the quantity operator or product_id is not valid
+    """
+    criteria = Inventory.general_filter_criteria(by_filters)
+    if criteria is None:
+        raise DataValidationError("Invalid quantity operator or product_id")
+    inventory = Inventory.__table__
+    return select(
+        inventory.c.product_id,
+        inventory.c.name,
+        func.lower(cast(inventory.c.condition, String)).label("condition"),
+        Inventory.quantity_expression().label("quantity"),
+        case((inventory.c.active, "true"), else_="false").label("active"),
+    ).where(*criteria).order_by(inventory.c.product_id, inventory.c.condition)
+
+
+class _ChunkQueue:
+    """File-like object handing COPY output over to a reading thread"""
+
+    def __init__(self):
+        self.cancelled = False
+        self._queue = queue.Queue(COPY_QUEUED_CHUNKS)
+        self._buffer = []
+        self._size = 0
+
+    def write(self, data):
+        """Called by COPY with each piece of output"""
+        self._buffer.append(data if isinstance(data, str) else data.decode("utf-8"))
+        self._size += len(data)
+        if self._size >= COPY_CHUNK_BYTES:
+            self.flush()
+
+    def flush(self):
+        """Queues the buffered output, waiting while the reader is behind"""
+        if self._buffer:
+            self.put("".join(self._buffer))
+            self._buffer, self._size = [], 0
+
+    def put(self, item):
+        """Queues a chunk, a finishing exception or None for the end"""
+        while not self.cancelled:
+            try:
+                self._queue.put(item, timeout=COPY_PUT_TIMEOUT_SECONDS)
+                return
+            except queue.Full:
+                continue
+        raise IOError("CSV export cancelled")
+
+    def get(self):
+        """Returns the next queued item"""
+        return self._queue.get()
+
+
+def _copy_chunks(engine, statement):
+    """Streams the statement as CSV with COPY ... TO STDOUT"""
+    raw = engine.raw_connection()
+    chunks = _ChunkQueue()
+
+    def copy():
+        try:
+            query = statement.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True})
+            raw.cursor().copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", chunks)
+            chunks.flush()
+            chunks.put(None)
+        except Exception as error:  # pylint: disable=broad-except
+            if not chunks.cancelled:
+                chunks.put(error)
+
+    thread = threading.Thread(target=copy, name="csv-export", daemon=True)
+    thread.start()
+    finished = False
+    try:
+        while True:
+            item = chunks.get()
+            if item is None:
+                finished = True
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        chunks.cancelled = True
+        if not finished:
+            _cancel_copy(raw)
+        thread.join(COPY_JOIN_SECONDS)
+        if thread.is_alive():
+            logger.warning("CSV export thread still running after it was cancelled")
+        if finished:
+            raw.rollback()
+            raw.close()
+        else:
+            # an interrupted COPY can leave the connection mid-protocol, so it is not pooled again
+            raw.invalidate()
+
+
+def _cancel_copy(raw):
+    """Asks the server to stop the COPY of raw, which may still be running the query"""
+    cancel = getattr(raw.connection, "cancel", None)  # psycopg2
+    if cancel is None:
+        return
+    try:
+        cancel()
+    except Exception as error:  # pylint: disable=broad-except
+        logger.warning("Could not cancel a CSV export: %s", error)
+
+
+def _cursor_chunks(engine, statement, chunk_size):
+    """Streams the statement as CSV fetching chunk_size rows at a time"""
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(statement)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(result.keys())
+        while True:
+            rows = result.fetchmany(chunk_size)
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            if not rows:
+                return
+            buffer.seek(0)
+            buffer.truncate()
+
+
+def export_csv(by_filters, chunk_size=1000):
+    """Exports the inventory records matching the filters as CSV
+
+    The filters are validated right away; the rows are only read while the
+    returned generator is consumed, on a connection of their own (to the
+    replica of a replica read) so the generator can outlive the request.
+
+    Args:
+        by_filters (dict): filters as accepted by find_by_general_filter
+        chunk_size (int): rows fetched at once when COPY is not available
+
+    Returns:
+        generator: chunks of CSV text, starting with a header row
+    """
+    statement = export_statement(by_filters)
+    engine = read_engine() or db.engine
+    if engine.dialect.name == "postgresql":
+        return _copy_chunks(engine, statement)
+    return _cursor_chunks(engine, statement, chunk_size)
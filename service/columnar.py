@@ -0,0 +1,320 @@
+"""
+Columnar Snapshot
+
+An opt-in copy of the inventory table kept in the memory of each worker
+as NumPy arrays, one per column, that answers list filters with
+vectorized masks instead of a query.
+
+The arrays are sorted by primary key and hold the product_id, the code of
+the condition, the available quantity, active and the code of the name in
+a table of interned names: 22 bytes per row, about 21 MiB per million.
+
+The snapshot is refreshed in the background every interval seconds with
+the rows whose updated_at moved past the last one seen (less an overlap,
+for writers whose transactions commit late), along with the sharded rows
+whose quantity lives in shards that do not touch updated_at. The same
+statement counts the rows, so a count that differs from the merged arrays
+gives deletions away and the snapshot is loaded again in full, as it also
+is every full_interval seconds. Lists can thus be up to an interval (plus
+the time a refresh takes) behind the database.
+
+Sharded records are filtered and sorted on their available quantity,
+the sum of their shards, as the database does with
+Inventory.quantity_expression().
+
+Filters the arrays cannot answer (comparing or sorting names, which the
+database orders by its collation) are left to the database, as are all
+lists while NumPy is missing or the snapshot is not loaded yet.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover - numpy is optional
+    numpy = None
+
+from service.filters import OPERATORS
+
+logger = logging.getLogger("flask.app")
+
+# commits may land after rows with a later updated_at were already read
+OVERLAP = timedelta(seconds=5)
+# the filters whose values are compared with = only
+EQUALITY = ("condition", "active", "name")
+
+
+def available():
+    """Returns whether NumPy is installed"""
+    return numpy is not None
+
+
+class _Columns:  # pylint: disable=too-few-public-methods
+    """The arrays of one snapshot, never modified once built"""
+
+    __slots__ = ("product_id", "condition", "quantity", "active", "name", "names", "codes")
+
+    def __init__(self, arrays, names, codes):
+        self.product_id, self.condition, self.quantity, self.active, self.name = arrays
+        # append-only and shared with later snapshots until the next full load
+        self.names = names
+        self.codes = codes
+
+    def __len__(self):
+        return len(self.product_id)
+
+    @property
+    def arrays(self):
+        """The arrays in the order of the constructor"""
+        return self.product_id, self.condition, self.quantity, self.active, self.name
+
+    @property
+    def nbytes(self):
+        """The memory used by the arrays"""
+        return sum(array.nbytes for array in self.arrays)
+
+    def keys(self, conditions):
+        """Returns the sorted composite keys of the rows"""
+        return self.product_id * conditions + self.condition
+
+    @classmethod
+    def build(cls, rows, conditions, names=None, codes=None):
+        """Builds sorted arrays from (product_id, name, condition, quantity, active) rows"""
+        names = [] if names is None else names
+        codes = {} if codes is None else codes
+        code_of = {condition: code for code, condition in enumerate(conditions)}
+        product_id, name, condition, quantity, active = [], [], [], [], []
+        for row in rows:
+            product_id.append(row[0])
+            code = codes.get(row[1])
+            if code is None:
+                code = codes[row[1]] = len(names)
+                names.append(row[1])
+            name.append(code)
+            condition.append(code_of[row[2]])
+            quantity.append(row[3])
+            active.append(row[4])
+        arrays = (numpy.array(product_id, dtype=numpy.int64), numpy.array(condition, dtype=numpy.int8),
+                  numpy.array(quantity, dtype=numpy.int64), numpy.array(active, dtype=numpy.bool_),
+                  numpy.array(name, dtype=numpy.int32))
+        order = numpy.lexsort((arrays[1], arrays[0]))
+        return cls(tuple(array[order] for array in arrays), names, codes)
+
+    def merge(self, rows, conditions):
+        """Returns a snapshot with rows replacing or added to these ones"""
+        changed = self.build(rows, conditions, self.names, self.codes)
+        if not changed:
+            return self
+        # the last of the changed rows of a key wins
+        new_keys = changed.keys(len(conditions))
+        last = numpy.append(new_keys[1:] != new_keys[:-1], True)
+        changed_arrays = [array[last] for array in changed.arrays]
+        new_keys = new_keys[last]
+
+        keys = self.keys(len(conditions))
+        at = numpy.searchsorted(keys, new_keys)
+        found = at < len(keys)
+        found[found] = keys[at[found]] == new_keys[found]
+        arrays = []
+        for array, new in zip(self.arrays, changed_arrays):
+            array = array.copy()
+            array[at[found]] = new[found]
+            arrays.append(numpy.insert(array, at[~found], new[~found]))
+        return type(self)(tuple(arrays), self.names, self.codes)
+
+
+class ColumnarSnapshot:  # pylint: disable=too-many-instance-attributes
+    """Per-worker NumPy copy of a table answering list filters
+
+    Args:
+        conditions (list): the conditions in the order the database sorts them
+        interval (float): seconds between incremental refreshes
+        full_interval (float): seconds between full loads
+        clock (callable): returns the current time in seconds
+    """
+
+    def __init__(self, conditions, interval=5.0, full_interval=300.0, clock=time.monotonic):
+        self.conditions = list(conditions)
+        self.interval = interval
+        self.full_interval = full_interval
+        self.clock = clock
+        self._columns = None
+        self._load = None
+        self._context = None
+        self._lock = threading.Lock()
+        self._refreshed_at = self._loaded_at = None
+        self._watermark = None
+        self.refreshes = self.full_loads = self.served = self.fallbacks = 0
+
+    def init_app(self, load, context=None, teardown=None):
+        """Sets how rows are read and the context background refreshes run with
+
+        Args:
+            load (callable): load(since) returns the number of rows in the
+                table and the (product_id, name, condition, quantity, active,
+                updated_at) rows updated at or after since, all of them for None
+            context (callable): returns the context manager a refresh runs in
+            teardown (callable): called when a background refresh is done
+        """
+        self._load = load
+        self._context = None if context is None else (context, teardown)
+
+    def clear(self):
+        """Forgets the snapshot until it is loaded again"""
+        with self._lock:
+            self._columns = None
+            self._refreshed_at = self._loaded_at = self._watermark = None
+
+    def refresh(self):
+        """Merges the rows changed since the last refresh, or loads every row when due
+
+        Returns:
+            bool: False if another refresh was already running
+        """
+        if not self._lock.acquire(blocking=False):  # pylint: disable=consider-using-with
+            return False
+        try:
+            now = self.clock()
+            full = self._columns is None or now - self._loaded_at >= self.full_interval
+            if not full:
+                total, rows = self._load(self._watermark - OVERLAP)
+                columns = self._columns.merge([row[:5] for row in rows], self.conditions)
+                # rows were deleted since the last load
+                full = len(columns) != total
+            if full:
+                total, rows = self._load(None)
+                columns = _Columns.build([row[:5] for row in rows], self.conditions)
+                self._loaded_at = now
+                self.full_loads += 1
+            if rows:
+                latest = max(row[5] for row in rows)
+                self._watermark = latest if self._watermark is None else max(self._watermark, latest)
+            elif self._watermark is None:
+                self._watermark = datetime.min + OVERLAP
+            self._columns = columns
+            self._refreshed_at = now
+            self.refreshes += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def _refresh_when_due(self):
+        if self._context is None or self._lock.locked():
+            return
+        if self._refreshed_at is not None and self.clock() - self._refreshed_at < self.interval:
+            return
+        threading.Thread(target=self._refresh_in_context, name="columnar-refresh", daemon=True).start()
+
+    def _refresh_in_context(self):
+        context, teardown = self._context
+        try:
+            with context():
+                try:
+                    self.refresh()
+                finally:
+                    if teardown is not None:
+                        teardown()
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Refreshing the columnar snapshot failed: %s", error)
+
+    def select(self, by_filters):
+        """Returns the rows matching find_by_general_filter filters
+
+        Returns:
+            list: (product_id, name, condition, quantity, active) tuples, in
+                the order of the sort filter and then of the primary key, or
+                None when the snapshot cannot answer the filters
+        """
+        self._refresh_when_due()
+        columns = self._columns
+        positions = None if columns is None else self._positions(columns, by_filters)
+        if positions is None:
+            self.fallbacks += 1
+            return None
+        self.served += 1
+        names, conditions = columns.names, self.conditions
+        return [(product_id, names[name], conditions[condition], quantity, active)
+                for product_id, name, condition, quantity, active in zip(
+                    columns.product_id[positions].tolist(), columns.name[positions].tolist(),
+                    columns.condition[positions].tolist(), columns.quantity[positions].tolist(),
+                    columns.active[positions].tolist())]
+
+    def _positions(self, columns, by_filters):
+        mask = numpy.ones(len(columns), dtype=numpy.bool_)
+        for attr, values in by_filters.items():
+            if attr == "sort":
+                continue
+            if attr == "filter":
+                matched = self._filter_mask(columns, values)
+            elif attr == "quantity":
+                value, oper = values
+                try:
+                    matched = OPERATORS[oper](columns.quantity, int(value))
+                except (KeyError, TypeError, ValueError):
+                    return None
+            elif attr == "product_id":
+                try:
+                    matched = columns.product_id == int(values)
+                except (TypeError, ValueError):
+                    return None
+            elif attr in EQUALITY:
+                matched = self._compare(columns, attr, "=", values)
+            else:
+                return None
+            if matched is None:
+                return None
+            mask &= matched
+        positions = numpy.flatnonzero(mask)
+        sort = by_filters.get("sort")
+        if not sort:
+            # already in primary key order
+            return positions
+        named = {name for name, _ in sort}
+        if "name" in named:
+            return None
+        order = [(name, descending) for name, descending in sort]
+        order.extend((name, False) for name in ("product_id", "condition") if name not in named)
+        keys = [getattr(columns, name)[positions].astype(numpy.int64) for name, _ in order]
+        keys = [-key if descending else key for key, (_, descending) in zip(keys, order)]
+        return positions[numpy.lexsort(keys[::-1])]
+
+    def _filter_mask(self, columns, parsed):
+        matched = numpy.zeros(len(columns), dtype=numpy.bool_)
+        for group in parsed:
+            group_mask = numpy.ones(len(columns), dtype=numpy.bool_)
+            for term in group:
+                term_mask = self._compare(columns, term.field, term.op, term.value)
+                if term_mask is None:
+                    return None
+                group_mask &= term_mask
+            matched |= group_mask
+        return matched
+
+    def _compare(self, columns, field, op, value):
+        """Returns the mask of the rows whose field compares to value, None if unsupported"""
+        array = getattr(columns, field)
+        if field == "name":
+            if op not in ("=", "!=", "in"):
+                return None
+            code = columns.codes.get
+            value = tuple(code(each, -1) for each in value) if op == "in" else code(value, -1)
+        elif field == "condition":
+            code = self.conditions.index
+            value = tuple(code(each) for each in value) if op == "in" else code(value)
+        if op == "in":
+            return numpy.isin(array, value)
+        if op == "between":
+            low, high = value
+            return (array >= low) & (array <= high)
+        return OPERATORS[op](array, value)
+
+    def stats(self):
+        """Returns the size, age and counters of the snapshot"""
+        columns = self._columns
+        return {"rows": 0 if columns is None else len(columns),
+                "bytes": 0 if columns is None else columns.nbytes,
+                "age": None if self._refreshed_at is None else round(self.clock() - self._refreshed_at, 3),
+                "refreshes": self.refreshes, "full_loads": self.full_loads,
+                "served": self.served, "fallbacks": self.fallbacks}
@@ -0,0 +1,131 @@
+"""
+Inventory CLI Commands
+
+Maintenance commands available through ``flask inventory <command>``
+"""
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import AppGroup
+from service import partitioning
+from service import search as name_search
+from service.bulk import ON_CONFLICT, ImportConflictError, export_csv, import_csv
+from service.models import DataValidationError, IdempotencyKey, Inventory, InventoryCheckpoint, db
+
+inventory_cli = AppGroup("inventory", help="Inventory maintenance commands.")
+
+
+def find_record(product_id, condition):
+    """Finds a record or fails the command"""
+    try:
+        condition = Inventory.Condition.parse(condition)
+    except ValueError as error:
+        raise click.BadParameter(f"Unknown condition '{condition}'") from error
+    record = Inventory.find((product_id, condition.name))
+    if not record:
+        raise click.ClickException(f"Product with id '{product_id}' was not found.")
+    return record
+
+
+@inventory_cli.command("shard")
+@click.argument("product_id", type=int)
+@click.argument("condition")
+@click.argument("shard_count", type=int)
+def shard(product_id, condition, shard_count):
+    """Split the quantity of a hot record over SHARD_COUNT shards (0 to merge)"""
+    record = find_record(product_id, condition)
+    try:
+        record.set_shard_count(shard_count)
+    except DataValidationError as error:
+        raise click.BadParameter(str(error)) from error
+    click.echo(f"{record} now uses {record.shard_count} shards "
+               f"holding {record.available_quantity()} items")
+
+
+@inventory_cli.command("rebalance-shards")
+def rebalance_shards():
+    """Even out the quantity across the shards of every sharded record"""
+    count = Inventory.rebalance_all_shards()
+    click.echo(f"Rebalanced {count} sharded records")
+
+
+@inventory_cli.command("purge-idempotency-keys")
+def purge_idempotency_keys():
+    """Delete expired Idempotency-Key records"""
+    count = IdempotencyKey.purge_expired()
+    click.echo(f"Purged {count} expired idempotency keys")
+
+
+@inventory_cli.command("checkpoint")
+@click.option("--keep-days", type=int, default=None,
+              help="Also delete checkpoints older than this many days, except the last of them.")
+def checkpoint(keep_days):
+    """Snapshot every record so as-of queries replay less history"""
+    count = InventoryCheckpoint.take()
+    click.echo(f"Checkpointed {count} records")
+    if keep_days is not None:
+        pruned = InventoryCheckpoint.prune(datetime.utcnow() - timedelta(days=keep_days))
+        click.echo(f"Pruned {pruned} checkpointed records")
+
+
+@inventory_cli.command("import")
+@click.argument("csv_file", type=click.File("r", encoding="utf-8"))
+@click.option("--on-conflict", type=click.Choice(ON_CONFLICT), default="error", show_default=True,
+              help="What to do with records that already exist.")
+@click.option("--batch-size", type=int, default=5000, show_default=True,
+              help="Rows loaded into the staging table at once.")
+def import_records(csv_file, on_conflict, batch_size):
+    """Import inventory records from CSV_FILE"""
+    try:
+        report = import_csv(csv_file, on_conflict, batch_size)
+    except (DataValidationError, ImportConflictError) as error:
+        raise click.ClickException(str(error)) from error
+    click.echo(f"Imported {report['imported']} of {report['read']} rows "
+               f"({report['rows_per_second']} rows/s), rejected {report['rejected']}")
+    for reject in report["rejected_rows"]:
+        click.echo(f"  line {reject['line']}: {reject['error']}", err=True)
+
+
+@inventory_cli.command("export")
+@click.argument("csv_file", type=click.File("w", encoding="utf-8"), default="-")
+@click.option("--product-id", type=int, help="Only export this product.")
+@click.option("--name", help="Only export records with this name.")
+@click.option("--condition", type=click.Choice([c.value for c in Inventory.Condition]),
+              help="Only export records in this condition.")
+@click.option("--quantity", type=int, help="Only export records with this quantity.")
+@click.option("--operator", type=click.Choice(["=", "<", "<=", ">", ">="]), default="=", show_default=True,
+              help="How --quantity is compared.")
+@click.option("--active/--inactive", default=None, help="Only export active or inactive records.")
+@click.option("--chunk-size", type=int, default=1000, show_default=True,
+              help="Rows fetched at once when COPY is not available.")
+def export_records(csv_file, product_id, name, condition, quantity, operator, active, chunk_size):
+    """Export inventory records to CSV_FILE (default: standard output)"""
+    filters = {"product_id": product_id, "name": name, "active": active}
+    if condition:
+        filters["condition"] = Inventory.Condition(condition)
+    if quantity is not None:
+        filters["quantity"] = (quantity, operator)
+    for chunk in export_csv({k: v for k, v in filters.items() if v is not None}, chunk_size):
+        csv_file.write(chunk)
+
+
+@inventory_cli.command("partition")
+@click.option("--by", "scheme", type=click.Choice(partitioning.SCHEMES + ("none",)), required=True,
+              help="Hash partition on product_id, list partition on condition, or none.")
+@click.option("--partitions", type=int, default=8, show_default=True,
+              help="Number of hash partitions.")
+def partition(scheme, partitions):
+    """Rebuild the inventory table with a partitioning scheme (PostgreSQL)"""
+    if db.engine.dialect.name != "postgresql":
+        raise click.ClickException("Partitioning needs PostgreSQL")
+    scheme = None if scheme == "none" else scheme
+    try:
+        with db.engine.begin() as connection:
+            copied = partitioning.migrate(connection, Inventory.__table__, scheme, partitions,
+                                          after_rebuild=name_search.POSTGRESQL_DDL[1:])
+    except ValueError as error:
+        raise click.BadParameter(str(error)) from error
+    click.echo(f"Rebuilt inventory {scheme or 'unpartitioned'} with {copied} records")
+    with db.engine.connect() as connection:
+        for name, rows in partitioning.describe(connection)[1]:
+            click.echo(f"  {name}: ~{rows} records")
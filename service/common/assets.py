@@ -0,0 +1,86 @@
+"""
+Static Asset Build
+
+This module precompresses the admin UI at build time. Every CSS and JS
+file under service/static is copied to service/static/dist under a
+content-hashed name (e.g. js/rest_api.1a2b3c4d5e.js) next to .gz and .br
+variants, and index.html is rewritten to reference the hashed names.
+Hashed assets never change, so they can be served with year-long cache
+headers, while index.html itself is revalidated on every visit.
+
+It has no dependency on the rest of the service so that it can run in a
+Docker build without a database:
+
+  python service/common/assets.py
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+DIST = "dist"
+MANIFEST = "manifest.json"
+ENTRY_POINT = "index.html"
+COMPRESSIBLE = (".css", ".js", ".html", ".json", ".svg", ".txt")
+
+
+def hashed_name(path, data):
+    """Returns path with the first 10 hex digits of the content hash inserted"""
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}"
+
+
+def write_variants(dest, data):
+    """Writes dest plus the .gz and .br variants that are actually smaller"""
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    with open(dest, "wb") as handle:
+        handle.write(data)
+    if not dest.endswith(COMPRESSIBLE):
+        return
+    variants = {".gz": gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        variants[".br"] = brotli.compress(data, quality=11)
+    for ext, compressed in variants.items():
+        if len(compressed) < len(data):
+            with open(dest + ext, "wb") as handle:
+                handle.write(compressed)
+
+
+def build_assets(static_folder):
+    """Builds static_folder/dist and returns the manifest of hashed names"""
+    dist_folder = os.path.join(static_folder, DIST)
+    shutil.rmtree(dist_folder, ignore_errors=True)
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = [name for name in dirs if os.path.join(root, name) != dist_folder]
+        for name in sorted(files):
+            path = os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, "/")
+            if path == ENTRY_POINT:
+                continue
+            with open(os.path.join(root, name), "rb") as handle:
+                data = handle.read()
+            manifest[path] = hashed_name(path, data)
+            write_variants(os.path.join(dist_folder, manifest[path]), data)
+
+    with open(os.path.join(static_folder, ENTRY_POINT), encoding="utf-8") as handle:
+        html = handle.read()
+    for path, hashed in manifest.items():
+        html = html.replace(f"static/{path}", f"static/{DIST}/{hashed}")
+    write_variants(os.path.join(dist_folder, ENTRY_POINT), html.encode("utf-8"))
+
+    with open(os.path.join(dist_folder, MANIFEST), "w", encoding="utf-8") as handle:
+        json.dump(manifest, handle, indent=2, sort_keys=True)
+    return manifest
+
+
+if __name__ == "__main__":
+    FOLDER = sys.argv[1] if len(sys.argv) > 1 else os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static")
+    print(f"Built {len(build_assets(FOLDER))} assets into {os.path.join(FOLDER, DIST)}")
@@ -0,0 +1,134 @@
+"""
+Response Compression
+
+This module negotiates gzip or brotli compression of API responses
+through the Accept-Encoding request header. Responses smaller than
+COMPRESS_MIN_SIZE bytes are left alone, streamed responses are compressed
+chunk by chunk with a flush after every chunk so events still reach the
+client immediately, and file responses are skipped because static assets
+are precompressed at build time (see service.common.assets).
+"""
+import mimetypes
+import os
+import zlib
+
+from flask import request, send_from_directory
+from werkzeug.utils import safe_join
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+SKIPPED_STATUS = (204, 206, 304)
+PRECOMPRESSED = {"br": ".br", "gzip": ".gz"}
+
+
+def available_encodings():
+    """Returns the encodings this process can produce, best first"""
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def negotiate(offered):
+    """Returns the best of the offered encodings the client accepts, or None"""
+    return request.accept_encodings.best_match(offered)
+
+
+class Compressor:
+    """Incremental gzip or brotli compressor"""
+
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=min(level, 11))
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+
+    def compress(self, data):
+        """Compresses a chunk, flushing it so it can be sent right away"""
+        if self.encoding == "br":
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """Returns the end of the compressed stream"""
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+def compress_stream(chunks, compressor):
+    """Compresses a streamed response body chunk by chunk"""
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            if chunk:
+                yield compressor.compress(chunk)
+        yield compressor.finish()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def compress_response(response, min_size, level):
+    """Compresses a response in place when the client accepts it"""
+    if (response.direct_passthrough or "Content-Encoding" in response.headers
+            or response.status_code in SKIPPED_STATUS or response.status_code < 200):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate(available_encodings())
+    if encoding is None:
+        return response
+
+    compressor = Compressor(encoding, level)
+    if response.is_streamed:
+        response.response = compress_stream(response.response, compressor)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(compressor.compress(data) + compressor.finish())
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def send_precompressed(directory, filename, max_age):
+    """Sends a file, or its precompressed .br/.gz sibling when the client accepts it
+
+    Args:
+        directory (str): folder the file is served from
+        filename (str): path of the file inside directory
+        max_age (int): seconds the file may be cached, 0 to always revalidate
+    """
+    path = safe_join(directory, filename)
+    offered = [encoding for encoding, ext in PRECOMPRESSED.items()
+               if path is not None and os.path.isfile(path + ext)]
+    encoding = negotiate(offered) if offered else None
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    response = send_from_directory(
+        directory, filename + PRECOMPRESSED[encoding] if encoding else filename,
+        mimetype=mimetype, max_age=max_age
+    )
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    if max_age:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def init_compression(app):
+    """Compresses every response of the app according to its configuration"""
+    @app.after_request
+    def compress(response):  # pylint: disable=unused-variable
+        if not app.config["COMPRESS_RESPONSES"]:
+            return response
+        return compress_response(response, app.config["COMPRESS_MIN_SIZE"],
+                                 app.config["COMPRESS_LEVEL"])
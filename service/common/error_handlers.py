@@ -19,6 +19,7 @@ Module: error_handlers
 """
 from flask import jsonify
 from service.models import DataValidationError, OutOfRangeError, InactiveRecordError
+from service.bulk import ImportConflictError
 from service import app
 from . import status
 
@@ -44,6 +45,12 @@ def request_inactive_record_error(error):
     return bad_request(error)
 
 
+@app.errorhandler(ImportConflictError)
+def request_import_conflict_error(error):
+    """Handles imports of records that already exist"""
+    return resource_conflict(error)
+
+
 @app.errorhandler(status.HTTP_400_BAD_REQUEST)
 def bad_request(error):
     """Handles bad requests with 400_BAD_REQUEST"""
@@ -57,6 +64,18 @@ def bad_request(error):
     )
 
 
+@app.errorhandler(status.HTTP_401_UNAUTHORIZED)
+def unauthorized(error):
+    """Handles requests without valid credentials with 401_UNAUTHORIZED"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_401_UNAUTHORIZED, error="Unauthorized", message=message),
+        status.HTTP_401_UNAUTHORIZED,
+        {"WWW-Authenticate": "Bearer"},
+    )
+
+
 @app.errorhandler(status.HTTP_404_NOT_FOUND)
 def not_found(error):
     """Handles resources not found with 404_NOT_FOUND"""
@@ -0,0 +1,73 @@
+"""
+Response Representations
+
+This module registers the media types the API can answer with, chosen
+through the Accept request header:
+
+  application/json                        - one object per record (default)
+  application/vnd.inventory.columnar+json - lists as one array per field
+  application/msgpack                     - MessagePack (needs msgpack)
+
+The columnar layout turns ``[{"product_id": 1, ...}, {"product_id": 2, ...}]``
+into ``{"product_id": [1, 2], ...}`` so field names are not repeated for
+every row of a list response.
+"""
+import json
+
+from flask import make_response
+from flask_restx.representations import output_json
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack is optional
+    msgpack = None
+
+JSON = "application/json"
+COLUMNAR_JSON = "application/vnd.inventory.columnar+json"
+MSGPACK = "application/msgpack"
+
+
+def to_columns(data):
+    """Converts a list of records into one list per field
+
+    Anything other than a list of dictionaries is returned unchanged.
+    """
+    if not isinstance(data, list) or not all(isinstance(row, dict) for row in data):
+        return data
+    if not data:
+        return {}
+    return {field: [row.get(field) for row in data] for field in data[0]}
+
+
+def _respond(body, code, headers, mimetype):
+    response = make_response(body, code)
+    response.headers.extend(headers or {})
+    response.mimetype = mimetype
+    response.vary.add("Accept")
+    return response
+
+
+def output_vary_json(data, code, headers=None):
+    """Makes the default JSON response, marked as negotiated on Accept"""
+    response = output_json(data, code, headers)
+    response.vary.add("Accept")
+    return response
+
+
+def output_columnar(data, code, headers=None):
+    """Makes a compact JSON response with list data laid out in columns"""
+    body = json.dumps(to_columns(data), separators=(",", ":")) + "\n"
+    return _respond(body, code, headers, COLUMNAR_JSON)
+
+
+def output_msgpack(data, code, headers=None):
+    """Makes a MessagePack response"""
+    return _respond(msgpack.packb(data), code, headers, MSGPACK)
+
+
+def init_representations(api):
+    """Registers the supported response media types on a flask-restx Api"""
+    api.representations[JSON] = output_vary_json
+    api.representations[COLUMNAR_JSON] = output_columnar
+    if msgpack is not None:
+        api.representations[MSGPACK] = output_msgpack
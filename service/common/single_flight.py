@@ -0,0 +1,61 @@
+"""
+Single Flight
+
+This module lets concurrent callers asking for the same thing share one
+in-flight computation. The first caller for a key (the leader) runs the
+function; callers arriving while it is running wait for and receive the
+leader's result instead of running it again.
+"""
+import threading
+
+
+class _Call:  # pylint: disable=too-few-public-methods
+    """A computation that is currently running for a key"""
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one execution"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, func):
+        """Returns func(), sharing the execution with concurrent callers of key"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        """Returns how many calls were executed and how many were coalesced"""
+        return {"executed": self.executed, "coalesced": self.coalesced,
+                "in_flight": len(self._calls)}
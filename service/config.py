@@ -12,5 +12,100 @@ DATABASE_URI = os.getenv(
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Read replicas for the read-only routes (comma separated URIs), see service/replicas.py
+DATABASE_REPLICA_URIS = [uri.strip() for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri.strip()]
+REPLICA_READ_YOUR_WRITES_SECONDS = float(os.getenv("REPLICA_READ_YOUR_WRITES_SECONDS", "5"))
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "1"))
+REPLICA_LAG_CHECK_SECONDS = float(os.getenv("REPLICA_LAG_CHECK_SECONDS", "2"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
+
+# Server-Sent Events stream of quantity changes
+STREAM_HEARTBEAT_SECONDS = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))
+STREAM_MAX_SECONDS = float(os.getenv("STREAM_MAX_SECONDS", "300"))
+STREAM_MAX_KEYS = int(os.getenv("STREAM_MAX_KEYS", "500"))
+STREAM_RETRY_MS = int(os.getenv("STREAM_RETRY_MS", "3000"))
+# open streams per worker process; each holds a thread of a gthread worker for up to STREAM_MAX_SECONDS
+STREAM_MAX_PER_WORKER = int(os.getenv("STREAM_MAX_PER_WORKER", "2"))
+
+# count=estimate on the list endpoint counts exactly below this many rows
+COUNT_ESTIMATE_MIN = int(os.getenv("COUNT_ESTIMATE_MIN", "1000"))
+
+# Multi-get of many keys with POST /api/inventory/lookup
+LOOKUP_MAX_KEYS = int(os.getenv("LOOKUP_MAX_KEYS", "1000"))
+# keys per IN query; SQLite allows 999 parameters before 3.32 and each key takes two
+LOOKUP_CHUNK_SIZE = int(os.getenv("LOOKUP_CHUNK_SIZE", "250"))
+
+# Group commit of concurrent checkout/reorder requests
+CHECKOUT_BATCHING = os.getenv("CHECKOUT_BATCHING", "False").lower() in ("1", "true", "yes")
+CHECKOUT_BATCH_WINDOW_MS = float(os.getenv("CHECKOUT_BATCH_WINDOW_MS", "2"))
+CHECKOUT_BATCH_MAX_SIZE = int(os.getenv("CHECKOUT_BATCH_MAX_SIZE", "64"))
+
+# Idempotency-Key handling for mutating routes
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 60 * 60)))
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "60"))
+IDEMPOTENCY_PURGE_SECONDS = int(os.getenv("IDEMPOTENCY_PURGE_SECONDS", "300"))
+
+# Share identical read queries running concurrently in a worker
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "True").lower() in ("1", "true", "yes")
+
+# Cache of list results, invalidated when the records they were read from change; opt-in,
+# since other workers' writes may reach it only after RESULT_CACHE_TTL_SECONDS
+RESULT_CACHE = os.getenv("RESULT_CACHE", "False").lower() in ("1", "true", "yes")
+RESULT_CACHE_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_SECONDS", "5"))
+RESULT_CACHE_STALE_SECONDS = float(os.getenv("RESULT_CACHE_STALE_SECONDS", "30"))
+RESULT_CACHE_MAX_ROWS = int(os.getenv("RESULT_CACHE_MAX_ROWS", "100000"))
+
+# Per-worker NumPy copy of the inventory answering list filters (needs numpy)
+COLUMNAR_SNAPSHOT = os.getenv("COLUMNAR_SNAPSHOT", "False").lower() in ("1", "true", "yes")
+COLUMNAR_REFRESH_SECONDS = float(os.getenv("COLUMNAR_REFRESH_SECONDS", "5"))
+COLUMNAR_FULL_REFRESH_SECONDS = float(os.getenv("COLUMNAR_FULL_REFRESH_SECONDS", "300"))
+
+# Stock of every record in a memory-mapped table shared by the workers of a host
+STOCK_TABLE = os.getenv("STOCK_TABLE", "False").lower() in ("1", "true", "yes")
+STOCK_TABLE_SLOTS = int(os.getenv("STOCK_TABLE_SLOTS", "65536"))
+STOCK_TABLE_REFRESH_SECONDS = float(os.getenv("STOCK_TABLE_REFRESH_SECONDS", "1"))
+STOCK_TABLE_MAX_STALENESS_SECONDS = float(os.getenv("STOCK_TABLE_MAX_STALENESS_SECONDS", "5"))
+
+# On-demand profiling through /admin/profile and the X-Profile header; disabled without a token
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+PROFILING_MAX_SECONDS = float(os.getenv("PROFILING_MAX_SECONDS", "20"))
+PROFILING_INTERVAL_MS = float(os.getenv("PROFILING_INTERVAL_MS", "10"))
+
+# Negotiated gzip/brotli compression of API responses
+COMPRESS_RESPONSES = os.getenv("COMPRESS_RESPONSES", "True").lower() in ("1", "true", "yes")
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+
+# Bulk CSV import and export
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "5000"))
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+# exports sent at once per worker process; each holds a thread of a gthread worker until it is sent
+EXPORT_MAX_PER_WORKER = int(os.getenv("EXPORT_MAX_PER_WORKER", "2"))
+
+# Inventory table partitioning on PostgreSQL: "hash" (product_id), "list" (condition) or ""
+INVENTORY_PARTITIONING = os.getenv("INVENTORY_PARTITIONING", "")
+INVENTORY_PARTITIONS = int(os.getenv("INVENTORY_PARTITIONS", "8"))
+
+# Admission control: adaptive per-process concurrency limit with a bounded queue
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "True").lower() in ("1", "true", "yes")
+ADMISSION_LIMIT = int(os.getenv("ADMISSION_LIMIT", "16"))
+ADMISSION_MIN_LIMIT = int(os.getenv("ADMISSION_MIN_LIMIT", "2"))
+ADMISSION_MAX_LIMIT = int(os.getenv("ADMISSION_MAX_LIMIT", "64"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "32"))
+ADMISSION_MAX_WAIT_MS = float(os.getenv("ADMISSION_MAX_WAIT_MS", "2000"))
+ADMISSION_TARGET_DB_MS = float(os.getenv("ADMISSION_TARGET_DB_MS", "50"))
+ADMISSION_WINDOW_SECONDS = float(os.getenv("ADMISSION_WINDOW_SECONDS", "1"))
+ADMISSION_RETRY_AFTER_SECONDS = float(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", "1"))
+
+# Per-client token bucket rate limiting: "shm" (shared by the workers of a host), "memory" or a redis:// URL;
+# opt-in, since behind proxies every client shares a bucket unless TRUSTED_PROXY_HOPS is set
+RATE_LIMIT = os.getenv("RATE_LIMIT", "False").lower() in ("1", "true", "yes")
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "shm")
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "20"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "200"))
+# empty for a file in /dev/shm named after the user id
+RATE_LIMIT_SHM_PATH = os.getenv("RATE_LIMIT_SHM_PATH", "")
+# number of proxies in front of the service that append the client address to X-Forwarded-For
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
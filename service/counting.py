@@ -0,0 +1,61 @@
+"""
+Row Counts
+
+Counts behind the count=exact|estimate argument of the list endpoint.
+
+An exact count is a COUNT(*) with the filters of the list, which
+PostgreSQL answers from an index (an index-only scan once the table is
+vacuumed) without transferring any row.
+
+An estimate costs next to nothing: on PostgreSQL it is the row count the
+planner keeps for the table (summed over its partitions) when nothing is
+filtered, and the rows the planner expects from the filtered query
+otherwise. SQLite keeps no such statistics, so the estimate of an
+unfiltered count is the highest rowid, which ignores deleted rows, and
+filtered counts are exact.
+"""
+from sqlalchemy import func, select, text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+PG_TABLE_ROWS = text(
+    "SELECT sum(reltuples) FROM pg_class "
+    "WHERE reltuples >= 0 AND (oid = CAST(:table AS regclass) "
+    "OR oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = CAST(:table AS regclass)))"
+)
+
+
+class Explain(Executable, ClauseElement):
+    """EXPLAIN (FORMAT JSON) of a statement"""
+
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, "postgresql")
+def _compile_explain(element, compiler, **kwargs):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kwargs)
+
+
+def exact(session, table, criteria):
+    """Returns the number of rows of table matching criteria"""
+    return session.execute(select(func.count()).select_from(table).where(*criteria)).scalar()
+
+
+def estimate(session, table, criteria):
+    """Returns an estimate of the number of rows of table matching criteria
+
+    Returns None when the database cannot estimate it.
+    """
+    dialect = session.connection().dialect.name
+    if dialect == "postgresql":
+        if not criteria:
+            rows = session.execute(PG_TABLE_ROWS, {"table": table.name}).scalar()
+            return None if rows is None else int(rows)
+        plan = session.execute(Explain(select(1).select_from(table).where(*criteria))).scalar()
+        return int(plan[0]["Plan"]["Plan Rows"])
+    if dialect == "sqlite" and not criteria:
+        return session.execute(select(func.coalesce(func.max(text("rowid")), 0)).select_from(table)).scalar()
+    return None
@@ -0,0 +1,210 @@
+"""
+Filter Expressions
+
+The list endpoint takes a filter expression in its ``filter`` argument:
+
+  condition in (new, refurbished) and quantity in 10..50 or active = false
+
+A term compares a field with a value (=, !=, <, <=, >, >=), a list of
+values (in (a, b)) or a closed range (in low..high). Terms joined by
+``and`` must all match and groups joined by ``or`` are alternatives, with
+``and`` binding tighter, so every filter is an OR of AND groups. Values
+are typed by the field they are compared with; quote values containing
+spaces, commas or parentheses ('oak desk', with '' for a quote).
+
+``sort`` names the columns to order by, a leading - sorting one in
+descending order: ``sort=-quantity,name``.
+
+Parsing is cached, so a filter repeated by many clients is tokenized once.
+Parsed filters are tuples compiled to criteria whose values are bound
+parameters (lists use a single expanding parameter), which SQLAlchemy and
+the database cache by the shape of the statement rather than its values;
+compiled criteria are cached too for columns that live as long as the app.
+"""
+import functools
+import operator
+import re
+from collections import namedtuple
+
+from sqlalchemy import and_, or_
+
+CACHE_SIZE = 256
+MAX_TERMS = 32
+KEYWORDS = ("and", "or", "in")
+OPERATORS = {
+    "=": operator.eq, "!=": operator.ne, "<": operator.lt,
+    "<=": operator.le, ">": operator.gt, ">=": operator.ge,
+}
+TOKEN = re.compile(r"\s*(?:'((?:[^']|'')*)'|(!=|<=|>=|=|<|>|\(|\)|,)|([^\s(),'=<>!]+))")
+
+# op is one of OPERATORS, "in" (value is a tuple) or "between" (value is a (low, high) tuple)
+Term = namedtuple("Term", "field op value")
+
+
+class FilterError(ValueError):
+    """ Used for filter expressions that cannot be parsed """
+
+
+def _tokens(text):
+    """Splits a filter into (kind, text) tokens, kind being a keyword, a symbol or "value" """
+    tokens, position, text = [], 0, text.strip()
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if match is None:
+            raise FilterError(f"Unexpected '{text[position:]}' in filter")
+        quoted, symbol, word = match.groups()
+        if quoted is not None:
+            tokens.append(("value", quoted.replace("''", "'")))
+        elif symbol is not None:
+            tokens.append((symbol, symbol))
+        elif word.lower() in KEYWORDS:
+            tokens.append((word.lower(), word))
+        else:
+            tokens.append(("value", word))
+        position = match.end()
+    return tokens
+
+
+def _converter(field):
+    """Returns a function turning the text of a value into the type of field"""
+    if field.choices is not None:
+        members = {}
+        for member in field.choices:
+            members[member.name.lower()] = members[str(member.value).lower()] = member
+        return lambda text: members[text.lower()]
+    if field.kind is bool:
+        return lambda text: {"true": True, "false": False}[text.lower()]
+    return field.kind
+
+
+class _Parser:
+    """Recursive descent over the tokens of one filter"""
+
+    def __init__(self, text, schema):
+        self.tokens = _tokens(text)
+        self.position = 0
+        self.fields = {field.name: field for field in schema}
+
+    def peek(self):
+        """Returns the kind of the next token, None at the end"""
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+    def take(self, *kinds):
+        """Returns the text of the next token, which must be of one of kinds"""
+        kind = self.peek()
+        if kind not in kinds:
+            found = f"'{self.tokens[self.position][1]}'" if kind else "the end"
+            expected = " or ".join("a value" if each == "value" else f"'{each}'" for each in kinds)
+            raise FilterError(f"Expected {expected} but found {found} in filter")
+        self.position += 1
+        return self.tokens[self.position - 1][1]
+
+    def expression(self):
+        """expression = group *("or" group)"""
+        groups = [self.group()]
+        while self.peek() == "or":
+            self.take("or")
+            groups.append(self.group())
+        if self.peek() is not None:
+            self.take("and", "or")
+        if sum(len(group) for group in groups) > MAX_TERMS:
+            raise FilterError(f"A filter can have at most {MAX_TERMS} terms")
+        return tuple(groups)
+
+    def group(self):
+        """group = term *("and" term)"""
+        terms = [self.term()]
+        while self.peek() == "and":
+            self.take("and")
+            terms.append(self.term())
+        return tuple(terms)
+
+    def term(self):
+        """term = field op value / field "in" "(" value *("," value) ")" / field "in" low..high"""
+        name = self.take("value")
+        field = self.fields.get(name)
+        if field is None:
+            raise FilterError(f"Unknown filter field '{name}'")
+        op = self.take("in", *OPERATORS)
+        if op != "in":
+            return Term(name, op, self.value(field))
+        if self.peek() == "value":
+            low, separator, high = self.take("value").partition("..")
+            if not separator or field.kind is bool or field.choices is not None:
+                raise FilterError(f"Expected a list or a low..high range of {name}")
+            low, high = self.convert(field, low), self.convert(field, high)
+            if low > high:
+                raise FilterError(f"The range of {name} is empty")
+            return Term(name, "between", (low, high))
+        self.take("(")
+        values = [self.value(field)]
+        while self.peek() == ",":
+            self.take(",")
+            values.append(self.value(field))
+        self.take(")")
+        return Term(name, "in", tuple(dict.fromkeys(values)))
+
+    def value(self, field):
+        """Returns the next token converted to the type of field"""
+        return self.convert(field, self.take("value"))
+
+    @staticmethod
+    def convert(field, text):
+        """Converts text to the type of field"""
+        try:
+            return _converter(field)(text)
+        except (KeyError, ValueError) as error:
+            raise FilterError(f"Invalid {field.name} '{text}' in filter") from error
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def parse(text, schema):
+    """Parses a filter expression over the Fields of schema
+
+    Returns:
+        tuple: the OR of groups, each a tuple of Terms that must all match
+
+    Raises:
+        FilterError: when the expression is not valid
+    """
+    return _Parser(text, schema).expression()
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def parse_sort(text, sortable):
+    """Parses a sort argument such as "-quantity,name"
+
+    Returns:
+        tuple: (column name, descending) pairs
+
+    Raises:
+        FilterError: when a column cannot be sorted on
+    """
+    order = []
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        name = item.lstrip("-+")
+        if name not in sortable:
+            raise FilterError(f"Cannot sort on '{name}', only on {', '.join(sortable)}")
+        order.append((name, item.startswith("-")))
+    return tuple(order)
+
+
+def compile_filter(parsed, columns):
+    """Returns the criterion selecting the rows of columns that match a parsed filter"""
+    groups = []
+    for group in parsed:
+        terms = []
+        for term in group:
+            column = getattr(columns, term.field)
+            if term.op == "in":
+                terms.append(column.in_(term.value))
+            elif term.op == "between":
+                terms.append(column.between(*term.value))
+            else:
+                terms.append(OPERATORS[term.op](column, term.value))
+        groups.append(and_(*terms))
+    return or_(*groups) if len(groups) > 1 else groups[0]
+
+
+# for columns that live as long as the app, like those of a mapped class
+compile_cached = functools.lru_cache(maxsize=CACHE_SIZE)(compile_filter)
@@ -0,0 +1,155 @@
+"""
+Idempotency Keys
+
+Mutating routes decorated with ``@idempotent`` honor an ``Idempotency-Key``
+request header. The first request with a key claims it in the
+idempotency_key table and stores its response; retries with the same key
+get the stored response replayed instead of being applied again.
+
+The request runs in a single transaction with its stored response (see
+IdempotencyKey.held), so a process dying half way leaves neither, and a
+retry of a request still running, however long, is answered with 409.
+The status, body and headers of the response are stored and replayed.
+
+Completed responses are also kept in a small per-process cache so that
+replays usually avoid the database entirely.
+"""
+import functools
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import abort, current_app, request
+from service.common import status
+from service.models import IdempotencyKey
+
+HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+HELD_KEY = "inventory.idempotency_key"
+
+
+class ResponseCache:
+    """Bounded LRU of completed responses keyed by idempotency key"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns (fingerprint, status_code, response) or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= datetime.utcnow():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1:]
+
+    def put(self, record):
+        """Caches a completed IdempotencyKey"""
+        with self._lock:
+            self._entries[record.key] = (record.expires_at, record.fingerprint,
+                                         record.status_code, record.response)
+            self._entries.move_to_end(record.key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Empties the cache"""
+        with self._lock:
+            self._entries.clear()
+
+
+cache = ResponseCache(max_entries=10000)
+_last_purge = [time.monotonic()]
+
+
+def request_fingerprint():
+    """Hashes what makes two requests with the same key the same request"""
+    digest = hashlib.sha256()
+    digest.update(request.method.encode())
+    digest.update(request.path.encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def replay(fingerprint, stored_fingerprint, status_code, response):
+    """Returns the stored response of a completed request"""
+    if fingerprint != stored_fingerprint:
+        abort(status.HTTP_409_CONFLICT,
+              f"{HEADER} was already used for a different request.")
+    if status_code is None:
+        abort(status.HTTP_409_CONFLICT,
+              f"A request with this {HEADER} is still in progress.")
+    stored = json.loads(response)
+    return stored["body"], status_code, {**stored["headers"], REPLAYED_HEADER: "true"}
+
+
+def split_result(result):
+    """Splits a flask-restx handler result into (body, status_code, headers)"""
+    if isinstance(result, tuple):
+        headers = dict(result[2]) if len(result) > 2 else {}
+        return result[0], result[1] if len(result) > 1 else status.HTTP_200_OK, headers
+    return result, status.HTTP_200_OK, {}
+
+
+def holding():
+    """Returns whether the current request holds an idempotency key"""
+    return HELD_KEY in request.environ
+
+
+def purge_if_due():
+    """Deletes expired keys at most once per IDEMPOTENCY_PURGE_SECONDS"""
+    now = time.monotonic()
+    if now - _last_purge[0] >= current_app.config["IDEMPOTENCY_PURGE_SECONDS"]:
+        _last_purge[0] = now
+        IdempotencyKey.purge_expired()
+
+
+def idempotent(func):
+    """Makes a mutating route safe to retry with an Idempotency-Key header"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(HEADER)
+        if key is None:
+            return func(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            abort(status.HTTP_400_BAD_REQUEST,
+                  f"{HEADER} must be between 1 and {MAX_KEY_LENGTH} characters.")
+        fingerprint = request_fingerprint()
+
+        cached = cache.get(key)
+        if cached is not None:
+            return replay(fingerprint, *cached)
+
+        purge_if_due()
+        record, claimed = IdempotencyKey.claim(
+            key, fingerprint, current_app.config["IDEMPOTENCY_LOCK_SECONDS"])
+        if record is None:
+            abort(status.HTTP_409_CONFLICT,
+                  f"A request with this {HEADER} is still in progress.")
+        if not claimed:
+            if record.completed:
+                cache.put(record)
+            return replay(fingerprint, record.fingerprint, record.status_code, record.response)
+
+        request.environ[HELD_KEY] = key
+        try:
+            with record.held():
+                result = func(*args, **kwargs)
+                body, status_code, headers = split_result(result)
+                record.complete(status_code, json.dumps({"body": body, "headers": headers}),
+                                current_app.config["IDEMPOTENCY_TTL_SECONDS"])
+        except Exception:
+            record.release()
+            raise
+        cache.put(record)
+        return result
+    return wrapper
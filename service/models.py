@@ -4,15 +4,33 @@ Models for Inventory
 All of the models are stored in this module
 """
 import logging
-from datetime import datetime
+import math
+import random
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 import enum
-from flask_sqlalchemy import SQLAlchemy
+from itertools import chain
+from sqlalchemy import and_, case, event, exists, func, literal, or_, select, text, true, tuple_, union_all, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
 from flask import Flask
+from service.common.single_flight import SingleFlight
+from service.notifications import broadcaster, register_session_events
+from service import counting, filters, partitioning
+from service.columnar import ColumnarSnapshot, available as columnar_available
+from service.stock_table import SharedStockTable
+from service.result_cache import ALL, ResultCache
+from service import search as name_search
+from service.replicas import RoutingSQLAlchemy, read_engine, router as replica_router
+from service.validation import Field, Validator
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+# Shares identical read queries running concurrently in this process
+read_flights = SingleFlight()
 
 
 def init_db(app):
@@ -20,6 +38,19 @@ def init_db(app):
     Inventory.init_db(app)
 
 
+def dispose_connections(close=True):
+    """Empties the connection pools so that connections are not shared across a fork
+
+    Called by the gunicorn master before it forks workers (close=True) and
+    again in each worker (close=False, which forgets the inherited
+    connections without closing sockets the parent may still use).
+    """
+    with Inventory.app.app_context():
+        db.session.remove()
+        db.get_engine(Inventory.app).dispose(close=close)
+    replica_router.dispose(close=close)
+
+
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
 
@@ -32,6 +63,17 @@ class OutOfRangeError(Exception):
     """ Used for an data validation errors when deserializing """
 
 
+class _AvailableColumns:  # pylint: disable=too-few-public-methods
+    """The columns of a model, its quantity being the available quantity of each row"""
+
+    def __init__(self, model):
+        self._model = model
+        self.quantity = model.quantity_expression()
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+
 class Inventory(db.Model):
     """
     Class that represents a Inventory
@@ -43,6 +85,13 @@ class Inventory(db.Model):
         REFURBISHED = 'refurbished'
         RETURN = 'return'
 
+        @classmethod
+        def parse(cls, text):
+            """Returns the condition for either a name ('NEW') or a value ('new')"""
+            if text.upper() in cls.__members__:
+                return cls[text.upper()]
+            return cls(text)
+
     app = None
 
     # Table Schema
@@ -54,10 +103,37 @@ class Inventory(db.Model):
     # reorder_quantity = db.Column(db.Integer, nullable=False, default=0)
     # restock_level = db.Column(db.Integer, nullable=False, default=0)
     active = db.Column(db.Boolean, nullable=False, default=True)
+    # 0 means quantity lives in this row, otherwise it is split over InventoryShard rows
+    shard_count = db.Column(db.Integer, nullable=False, default=0)
+    # 0 means unlocated, otherwise quantity is the rollup of InventoryLocation rows
+    location_count = db.Column(db.Integer, nullable=False, default=0)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow,
                            onupdate=datetime.utcnow)
 
+    # indexes letting filters and sorts on these columns avoid a full scan
+    __table_args__ = (
+        db.Index("ix_inventory_name", "name"),
+        db.Index("ix_inventory_quantity", "quantity"),
+    )
+    # the columns a list can be sorted on, all indexed
+    SORTABLE = ("product_id", "condition", "name", "quantity")
+
+    # the location the last checkout was allocated from, not persisted
+    allocated_from = None
+    # built by available_columns once the shards are mapped
+    _available_columns = None
+
+    # The fields clients send, validated by deserialize and documented by the API models
+    FIELDS = (
+        Field("product_id", int, "The unique id assigned internally by service", key=True),
+        Field("condition", str, "The condition type", key=True, choices=Condition),
+        Field("name", str, "The name of the Inventory"),
+        Field("quantity", int, "Quantity of inventory type", minimum=0),
+        Field("active", bool, "Active status inventory"),
+    )
+    validator = Validator(FIELDS)
+
     def __repr__(self):
         stmt = f"<Inventory '{self.name}' product_id=[{self.product_id}] "
         stmt += f"condition=[{self.condition.name}]>"
@@ -69,6 +145,7 @@ class Inventory(db.Model):
         """
         logger.info("Creating %s", self.name)
         db.session.add(self)
+        self.stage_change()
         db.session.commit()
 
     def update(self, new_data):
@@ -76,7 +153,13 @@ class Inventory(db.Model):
         if new_data.active is not None:
             self.active = new_data.active
         if new_data.quantity is not None:
-            self.quantity = new_data.quantity
+            if self.location_count:
+                raise DataValidationError("The quantity of a record stocked in locations "
+                                          "is set per location.")
+            if self.shard_count:
+                InventoryShard.distribute(self, new_data.quantity)
+            else:
+                self.quantity = new_data.quantity
         self.name = new_data.name or self.name
         # if new_data.reorder_quantity is not None:
         #     self.reorder_quantity = new_data.reorder_quantity
@@ -84,12 +167,18 @@ class Inventory(db.Model):
         #     self.restock_level = new_data.restock_level
         self.updated_at = datetime.utcnow()
         logger.info("Saving %s", self.name)
+        self.stage_change()
         db.session.commit()
 
     def delete(self):
         """ Removes a Inventory from the data store """
         logger.info("Deleting %s", self.name)
+        if self.shard_count:
+            InventoryShard.remove_all(self)
+        if self.location_count:
+            InventoryLocation.remove_all(self)
         db.session.delete(self)
+        self.stage_change(deleted=True)
         db.session.commit()
 
     def serialize(self):
@@ -98,74 +187,128 @@ class Inventory(db.Model):
             "product_id": self.product_id,
             "name": self.name,
             "condition": self.condition.value,
-            "quantity": self.quantity,
+            "quantity": self.available_quantity(),
             # "reorder_quantity": self.reorder_quantity,
             # "restock_level": self.restock_level,
             "active": self.active
         }
 
+    def stock_event(self, deleted=False):
+        """ Describes the current stock of this record for subscribers """
+        condition = self.condition or self.Condition.NEW
+        if not isinstance(condition, self.Condition):
+            condition = self.Condition[condition]
+        return {
+            "product_id": self.product_id,
+            "condition": condition.value,
+            "quantity": 0 if deleted else self.available_quantity() or 0,
+            "active": False if deleted else self.active is not False,
+            "deleted": deleted
+        }
+
+    def available_quantity(self):
+        """ Returns the quantity, summing the shards of a sharded record """
+        if not self.shard_count:
+            return self.quantity
+        return InventoryShard.total(self)
+
+    def stage_change(self, deleted=False):
+        """ Records the new state of this record in the current transaction
+
+        Appends it to the stock history and queues a stock event that is
+        delivered when the session commits.
+        """
+        event = self.stock_event(deleted)
+        db.session.add(InventoryHistory.of(self.name, event))
+        broadcaster.stage(db.session, event)
+
+    @classmethod
+    def quantity_expression(cls):
+        """ Returns a SQL expression of the available quantity of each row """
+        shards = InventoryShard.__table__
+        shard_total = select(func.coalesce(func.sum(shards.c.quantity), 0)).where(
+            shards.c.product_id == cls.product_id,
+            shards.c.condition == cls.condition
+        ).scalar_subquery()
+        return case((cls.shard_count > 0, shard_total), else_=cls.quantity)
+
+    @classmethod
+    def available_columns(cls):
+        """ Returns the columns filters and sorts compare, quantity being quantity_expression()
+
+        The same object is returned every time, so filters compiled
+        against it are cached like those compiled against the class.
+        """
+        if cls._available_columns is None:
+            cls._available_columns = _AvailableColumns(cls)
+        return cls._available_columns
+
     def deserialize(self, data):
-        """ Wrapper for deserializing an Inventory from a dictionary
+        """ Deserializes an Inventory from a dictionary
 
         Args:
             data (dict): A dictionary containing the resource data
         """
-        try:
-            if not isinstance(data, dict) or data == {}:
-                raise TypeError
-            self.deserialize_util(data)
-        # except KeyError as error:
-        #     raise DataValidationError(
-        #         f'Invalid Inventory: missing {error.args[0]}'
-        #     ) from error
-        except TypeError as error:
+        for field, value in self.validated(data).items():
+            setattr(self, field, value)
+        return self
+
+    @classmethod
+    def validated(cls, data):
+        """ Returns the clean values of the fields in a dictionary
+
+        Raises DataValidationError when a value has the wrong type, or
+        OutOfRangeError when every type is right but a value is out of
+        range; either way the message lists every problem found.
+        """
+        if not isinstance(data, dict) or data == {}:
             raise DataValidationError(
                 'Invalid Inventory: body of request contained bad or no data\n'
-                f'Error message: {error}'
-            ) from error
-        except ValueError as error:
+                'Error message: expected a JSON object'
+            )
+        values, issues = cls.validator.validate(data)
+        if not issues:
+            return values
+        message = "; ".join(issue.message for issue in issues)
+        if all(issue.out_of_range for issue in issues):
             raise OutOfRangeError(
                 'Invalid Inventory: body of request contained values'
                 ' out of range\n'
-                f'Error message: {error}'
-            ) from error
-        return self
+                f'Error message: {message}'
+            )
+        raise DataValidationError(
+            'Invalid Inventory: body of request contained bad or no data\n'
+            f'Error message: {message}'
+        )
 
-    def deserialize_util(self, data):
-        """ Deserializing an Inventory from a dictionary
+    def checkout(self, data):
+        """ Checkout ordered_quantity from record
 
         Args:
             data (dict): A dictionary containing the resource data
         """
-        self.check_primary_key_valid(data)
-        if data.get("name"):
-            if isinstance(data.get("name"), str):
-                self.name = data.get("name")
-            else:
-                raise TypeError
-
-        if data.get("active") is not None:
-            if isinstance(data.get("active"), bool):
-                self.active = data.get("active")
-            else:
-                raise TypeError
+        self.apply_checkout(data)
+        logger.info("Saving %s", self.name)
+        self.stage_change()
+        db.session.commit()
 
-        for field in ["quantity"]:
-            if data.get(field):
-                if not isinstance(data.get(field), int):
-                    raise TypeError
-                if data.get(field) < 0:
-                    raise ValueError
-                setattr(self, field, data.get(field))
-
-    def checkout(self, data):
-        """ Checkout ordered_quantity from record
+    def apply_checkout(self, data):
+        """ Removes ordered_quantity from record without committing
 
         Args:
             data (dict): A dictionary containing the resource data
         """
         ordered_quantity = data.get('ordered_quantity')
         self.validate_ordered_quantity(ordered_quantity)
+        self.allocated_from = None
+        if self.shard_count:
+            InventoryShard.take(self, ordered_quantity)
+            return
+        if self.location_count:
+            # lock the record before its location rows, in the order set_location_stock takes them
+            self.adjust_rollup(-ordered_quantity)
+            self.allocated_from = InventoryLocation.allocate(self, ordered_quantity, data)
+            return
         try:
             if ordered_quantity > self.quantity:
                 raise ValueError
@@ -173,20 +316,123 @@ class Inventory(db.Model):
             raise OutOfRangeError(f'Quantity specified ({ordered_quantity}) '
                                   'is more than quantity of record '
                                   f'({self.quantity}).') from error
-
-        new_record = Inventory()
-        new_record.quantity = self.quantity - ordered_quantity
-        self.update(new_record)
+        self.quantity -= ordered_quantity
+        self.updated_at = datetime.utcnow()
 
     def reorder(self, data):
         """ Reorder ordered_quantity from record
 
+        Args:
+            data (dict): A dictionary containing the resource data
+        """
+        self.apply_reorder(data)
+        self.stage_change()
+        db.session.commit()
+
+    def apply_reorder(self, data):
+        """ Adds ordered_quantity to record without committing
+
         Args:
             data (dict): A dictionary containing the resource data
         """
         ordered_quantity = data.get('ordered_quantity')
         self.validate_ordered_quantity(ordered_quantity)
-        self.quantity += ordered_quantity
+        self.allocated_from = None
+        if self.location_count:
+            if not isinstance(data.get("location"), str):
+                raise DataValidationError("The location receiving the stock is missing.")
+            InventoryLocation.give(self, ordered_quantity, data["location"])
+            self.adjust_rollup(ordered_quantity)
+            return
+        if self.shard_count:
+            InventoryShard.give(self, ordered_quantity)
+        else:
+            self.quantity += ordered_quantity
+
+    def set_shard_count(self, shard_count):
+        """ Splits the quantity of a hot record over shard_count sub-rows
+
+        Checkouts on a sharded record update a random shard instead of
+        this row, so concurrent orders no longer serialize on one lock.
+        A shard_count of 0 or 1 folds the shards back into this row.
+
+        Args:
+            shard_count (int): Number of shards to split the quantity over
+        """
+        if not isinstance(shard_count, int) or shard_count < 0:
+            raise DataValidationError("Shard count must be a non-negative int.")
+        db.session.refresh(self, with_for_update=True)
+        if self.location_count:
+            raise DataValidationError("A record stocked in locations cannot be sharded.")
+        if shard_count > 1:
+            # the shards of a sharded record are summed once locked, as checkouts skip this row
+            total = None if self.shard_count else self.quantity
+            self.quantity = 0
+            self.shard_count = shard_count
+            InventoryShard.distribute(self, total)
+        else:
+            if self.shard_count:
+                self.quantity = InventoryShard.drain(self)
+            self.shard_count = 0
+        logger.info("Using %d shards for %s", self.shard_count, self.name)
+        self.stage_change()
+        db.session.commit()
+
+    def adjust_rollup(self, amount):
+        """ Adds amount to the total quantity of a record stocked in locations
+
+        The addition happens in SQL so concurrent transactions do not
+        overwrite each other's changes.
+        """
+        self.quantity = Inventory.quantity + amount
+        self.updated_at = datetime.utcnow()
+        db.session.flush()
+
+    def set_location_stock(self, location, quantity):
+        """ Sets the quantity this record has in one location
+
+        The first location replaces the quantity the record had; from then
+        on its quantity is the total over its locations.
+
+        Args:
+            location (str): the code of the Location
+            quantity (int): the quantity in stock there
+        """
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 0:
+            raise DataValidationError("Quantity must be a non-negative int.")
+        if Location.find(location) is None:
+            raise DataValidationError(f"Location '{location}' does not exist.")
+        db.session.refresh(self, with_for_update=True)
+        if self.shard_count:
+            raise DataValidationError("A sharded record cannot be stocked in locations.")
+        InventoryLocation.put(self, location, quantity)
+        self.refresh_rollup()
+
+    def remove_location(self, location):
+        """ Removes the stock this record has in one location
+
+        Returns:
+            bool: False if the record had no stock row for the location
+        """
+        db.session.refresh(self, with_for_update=True)
+        if not InventoryLocation.remove(self, location):
+            return False
+        self.refresh_rollup()
+        return True
+
+    def refresh_rollup(self):
+        """ Recomputes the total and the location count from the location rows """
+        self.location_count = InventoryLocation.of(self).count()
+        self.quantity = InventoryLocation.total(self)
+        self.updated_at = datetime.utcnow()
+        self.stage_change()
+        db.session.commit()
+
+    def rebalance_shards(self):
+        """ Evens out the quantity across the shards of a sharded record """
+        db.session.refresh(self, with_for_update=True)
+        if self.shard_count:
+            InventoryShard.distribute(self)
         db.session.commit()
 
     def validate_ordered_quantity(self, ordered_quantity):
@@ -214,17 +460,11 @@ class Inventory(db.Model):
         Returns:
             bool: True if PK is valid else False
         """
-        pid_check = True if data.get("product_id") is not None else False
-        cond_check = True if data.get("condition") is not None else False
-        if pid_check and cond_check:
-            if isinstance(data.get("product_id"), int) and isinstance(data.get("condition"), str):
-                self.product_id = data.get("product_id")
-                self.condition = self.Condition(data.get("condition"))
-                return True
-            else:
-                return False
-        else:
+        values, _ = self.validator.validate(data)
+        if "product_id" not in values or "condition" not in values:
             return False
+        self.product_id, self.condition = values["product_id"], values["condition"]
+        return True
 
     @classmethod
     def init_db(cls, app: Flask):
@@ -234,7 +474,30 @@ class Inventory(db.Model):
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
+        partitioning.configure(cls.__table__, app.config.get("INVENTORY_PARTITIONING"),
+                               app.config.get("INVENTORY_PARTITIONS", 8))
         db.create_all()  # make our sqlalchemy tables
+        for index in cls.__table__.indexes:
+            # tables created before the index was added
+            index.create(db.engine, checkfirst=True)
+        partitioning.check(db.engine, app.config.get("INVENTORY_PARTITIONING"))
+        name_search.init_search(db.engine)
+        if db.session.query(InventoryCheckpoint.taken_at).first() is None:
+            # as-of queries need a baseline of the records that predate the history
+            InventoryCheckpoint.take()
+        broadcaster.init_app(db.engine)
+        register_session_events(db.session)
+        init_result_cache(app)
+        init_columnar_snapshot(app)
+        init_stock_table(app)
+
+    @classmethod
+    def rebalance_all_shards(cls):
+        """ Rebalances every sharded record and returns how many there were """
+        records = cls.query.filter(cls.shard_count > 0).all()
+        for record in records:
+            record.rebalance_shards()
+        return len(records)
 
     @classmethod
     def all(cls):
@@ -247,8 +510,159 @@ class Inventory(db.Model):
         """ Finds a Inventory by it's ID and condition """
         by_id, by_condition = by_params
         logger.info("Processing lookup for id %s and condition %s ...", by_id, by_condition)
+        try:
+            # a typed key lets a partitioned table prune to a single partition
+            by_id = int(by_id)
+        except (TypeError, ValueError):
+            return None
         return cls.query.get((by_id, by_condition))
 
+    @classmethod
+    def find_coalesced(cls, by_params):
+        """ Finds a Inventory, sharing the query with concurrent identical lookups
+
+        The returned record is detached from the session and meant for reading.
+        """
+        by_id, by_condition = by_params
+        try:
+            by_id = int(by_id)
+        except (TypeError, ValueError):
+            return None
+        records = cls._coalesced(
+            ("find", str(by_id), str(by_condition)),
+            lambda: cls._rows(cls.product_id == by_id, cls.condition == by_condition)
+        )
+        return records[0] if records else None
+
+    @classmethod
+    def find_shared(cls, by_params, not_before=None):
+        """ Finds an Inventory in the stock table shared by the workers of the host
+
+        The returned record is detached from the session and meant for
+        reading. Returns None when the table cannot answer, e.g. when it
+        was not refreshed since not_before (a UNIX time), and the record
+        is then read from the database.
+        """
+        by_id, by_condition = by_params
+        condition = cls.Condition.__members__.get(by_condition)
+        if condition is None:
+            return None
+        try:
+            by_id = int(by_id)
+        except (TypeError, ValueError):
+            return None
+        found = stock_table.lookup(by_id, condition, not_before)
+        if found is None:
+            return None
+        name, quantity, active, updated_at = found
+        # the shards are already summed into quantity
+        record = cls(product_id=by_id, name=name, condition=condition, quantity=quantity, active=active,
+                     shard_count=0, updated_at=datetime.utcfromtimestamp(updated_at))
+        make_transient_to_detached(record)
+        return record
+
+    @classmethod
+    def find_many(cls, keys, chunk_size=250):
+        """ Finds the Inventories of many (product_id, condition) keys
+
+        Each chunk_size keys are fetched with a single
+        WHERE (product_id, condition) IN (...) query, which also sums the
+        shards of sharded records. The returned records are detached from
+        the session and meant for reading.
+
+        Returns:
+            tuple: the records found in the order of keys, and the keys not found
+        """
+        keys = list(dict.fromkeys(keys))
+        typed = {}
+        for key in keys:
+            try:
+                # typed keys let a partitioned table prune to the partitions of the chunk
+                typed[key] = (int(key[0]), key[1])
+            except (TypeError, ValueError):
+                continue
+        lookups = list(dict.fromkeys(typed.values()))
+        quantity = cls.quantity_expression().label("quantity")
+        found = {}
+        for start in range(0, len(lookups), chunk_size):
+            chunk = lookups[start:start + chunk_size]
+            rows = db.session.query(cls.product_id, cls.name, cls.condition, quantity, cls.active).filter(
+                tuple_(cls.product_id, cls.condition).in_(chunk)
+            ).all()
+            for row in rows:
+                # the shards are already summed into quantity
+                record = cls(shard_count=0, **row._asdict())
+                make_transient_to_detached(record)
+                found[(record.product_id, record.condition)] = record
+        return ([found[typed[key]] for key in keys if typed.get(key) in found],
+                [key for key in keys if typed.get(key) not in found])
+
+    @classmethod
+    def find_by_general_filter_coalesced(cls, by_filters, cached=False):
+        """ Returns find_by_general_filter(by_filters), sharing the query with
+        concurrent identical requests, and with later ones through the
+        result cache when cached is True
+
+        The returned records are detached from the session and meant for reading.
+        """
+        key = ("filter",) + tuple(sorted(by_filters.items(), key=lambda item: item[0]))
+        # a list of one condition only goes stale when records of that condition change
+        condition = by_filters.get("condition")
+        partitions = (condition.name,) if isinstance(condition, cls.Condition) else ALL
+        return cls._coalesced(key, lambda: cls._filter_rows(by_filters),
+                              partitions if cached else None)
+
+    @classmethod
+    def find_in_snapshot(cls, by_filters):
+        """ Returns find_by_general_filter(by_filters) from the columnar snapshot
+
+        The returned records are detached from the session and meant for
+        reading. Returns None when the snapshot is not loaded or cannot
+        answer the filters, which are then left to the database.
+        """
+        rows = columnar_snapshot.select(by_filters)
+        if rows is None:
+            return None
+        records = []
+        for product_id, name, condition, quantity, active in rows:
+            # the shards are already summed into quantity
+            record = cls(product_id=product_id, name=name, condition=condition,
+                         quantity=quantity, active=active, shard_count=0)
+            make_transient_to_detached(record)
+            records.append(record)
+        return records
+
+    @classmethod
+    def _coalesced(cls, key, fetch_rows, partitions=None):
+        # reads on a replica and on the primary may differ, so they do not share
+        key = (read_engine(),) + key
+        if partitions is None:
+            rows = read_flights.do(key, fetch_rows)
+        else:
+            # the changes of the other processes invalidate the cache once this one listens
+            broadcaster.ensure_observed()
+            rows = cached_results.get(key, lambda: read_flights.do(key, fetch_rows), partitions)
+        if rows == "Invalid":
+            return rows
+        records = []
+        for row in rows:
+            record = cls(**row._asdict())
+            make_transient_to_detached(record)
+            records.append(record)
+        return records
+
+    @classmethod
+    def _rows(cls, *criteria, order_by=()):
+        """ Runs a query returning plain rows that can be shared across threads """
+        return db.session.query(*cls.__table__.columns).filter(*criteria).order_by(*order_by).all()
+
+    @classmethod
+    def _filter_rows(cls, by_filters):
+        criteria = cls.general_filter_criteria(by_filters)
+        if criteria is None:
+            return "Invalid"
+        return cls._rows(*criteria, order_by=cls.general_filter_order(by_filters))
+
     @classmethod
     def find_by_general_filter(cls, by_filters):
         """Returns all Inventories by all the filters
@@ -257,23 +671,850 @@ class Inventory(db.Model):
             :return: a collection of Inventories that satisfy all the filter parameters
             :rtype: list
         """
-        __query = db.session.query(cls)
+        criteria = cls.general_filter_criteria(by_filters)
+        if criteria is None:
+            return "Invalid"
+        results = db.session.query(cls).filter(*criteria).order_by(
+            *cls.general_filter_order(by_filters)
+        ).all()
+        return results
+
+    @classmethod
+    def count(cls, by_filters, estimate=False, estimate_min=0):
+        """Counts the Inventories matching find_by_general_filter filters
+            :param by_filters: contains all the filter parameters and their values
+            :param estimate: whether an estimate from the planner statistics will do
+            :param estimate_min: estimates below this are replaced with an exact count
+            :return: the count and whether it is an estimate, or "Invalid"
+            :rtype: tuple
+        """
+        criteria = cls.general_filter_criteria(by_filters)
+        if criteria is None:
+            return "Invalid"
+        if estimate:
+            rows = counting.estimate(db.session, cls.__table__, criteria)
+            if rows is not None and rows >= estimate_min:
+                return rows, True
+        return counting.exact(db.session, cls.__table__, criteria), False
+
+    @classmethod
+    def search(cls, value, by_filters=None, limit=name_search.DEFAULT_PAGE_SIZE, offset=0):
+        """Returns the Inventories whose name starts with or resembles value
+
+        Names starting with value come first, then names ranked by trigram
+        similarity, so misspelled searches still find the record.
+            :param value: the text searched for
+            :param by_filters: find_by_general_filter filters the results must also satisfy
+            :param limit: the maximum number of results
+            :param offset: the number of results skipped, for pagination
+            :return: a page of matching Inventories, or "Invalid" for an invalid filter
+            :rtype: list
+        """
+        logger.info("Searching names for %s ...", value)
+        criteria = cls.general_filter_criteria(by_filters or {})
+        if criteria is None:
+            return "Invalid"
+        if db.engine.dialect.name == "postgresql":
+            prefix = cls.name.ilike(name_search.like_prefix(value), escape="\\")
+            return (
+                db.session.query(cls)
+                .filter(or_(prefix, cls.name.op("%")(value)), *criteria)
+                .order_by(prefix.desc(), func.similarity(cls.name, value).desc(),
+                          cls.name, cls.product_id, cls.condition)
+                .offset(offset).limit(limit).all()
+            )
+
+        # rank a bounded set of candidates the way pg_trgm would
+        size = max(name_search.MAX_CANDIDATES, offset + limit)
+        if db.engine.dialect.name == "sqlite":
+            # LIKE on the trigram table is indexed but takes no ESCAPE, so
+            # wildcards in value only widen the candidates; rank() rechecks
+            table = name_search.FTS_TABLE
+            candidates = [f"SELECT * FROM (SELECT rowid FROM {table} WHERE name LIKE :prefix LIMIT :size)"]
+            match = name_search.fts_query(value)
+            if match:
+                candidates.append(f"SELECT * FROM (SELECT rowid FROM {table} "
+                                  f"WHERE {table} MATCH :match ORDER BY rank LIMIT :size)")
+            criteria.append(text(f"inventory.rowid IN ({' UNION '.join(candidates)})").bindparams(
+                prefix=value + "%", size=size, **({"match": match} if match else {})))
+        else:
+            criteria.append(cls.name.ilike("%" + name_search.like_prefix(value), escape="\\"))
+        ranked = []
+        for record in db.session.query(cls).filter(*criteria).limit(2 * size):
+            key = name_search.rank(value, record.name)
+            if key is not None:
+                ranked.append((key, record.name, record.product_id, record.condition.name, record))
+        ranked.sort(key=lambda item: item[:4])
+        return [item[-1] for item in ranked[offset:offset + limit]]
+
+    @classmethod
+    def find_as_of(cls, as_of, by_filters=None):
+        """Returns the Inventories as they were at a point in time
+            :param as_of: the UTC time of the snapshot
+            :param by_filters: find_by_general_filter filters applied to the snapshot
+            :return: transient Inventories (not tied to the session), or "Invalid"
+            :rtype: list
+        """
+        logger.info("Processing inventory as of %s ...", as_of)
+        history = InventoryHistory.__table__
+        checkpoints = InventoryCheckpoint.__table__
+        checkpoint_at = InventoryCheckpoint.latest_before(as_of)
+
+        # the last history entry of every record changed since the checkpoint
+        changed = [history.c.recorded_at <= as_of]
+        if checkpoint_at is not None:
+            changed.append(history.c.recorded_at > checkpoint_at - InventoryCheckpoint.OVERLAP)
+        ranked = select(
+            history.c.product_id, history.c.condition, history.c.name, history.c.quantity,
+            history.c.active, history.c.deleted,
+            func.row_number().over(
+                partition_by=[history.c.product_id, history.c.condition],
+                order_by=[history.c.recorded_at.desc(), history.c.id.desc()]
+            ).label("rank")
+        ).where(*changed).cte("ranked")
+        states = [select(ranked.c.product_id, ranked.c.condition, ranked.c.name, ranked.c.quantity,
+                         ranked.c.active, ranked.c.deleted).where(ranked.c.rank == 1)]
+        if checkpoint_at is not None:
+            # plus the records that did not change since
+            states.append(select(
+                checkpoints.c.product_id, checkpoints.c.condition, checkpoints.c.name,
+                checkpoints.c.quantity, checkpoints.c.active, literal(False).label("deleted")
+            ).where(
+                checkpoints.c.taken_at == checkpoint_at,
+                ~exists().where(and_(ranked.c.rank == 1,
+                                     ranked.c.product_id == checkpoints.c.product_id,
+                                     ranked.c.condition == checkpoints.c.condition))
+            ))
+        snapshot = union_all(*states).subquery("snapshot")
+
+        criteria = cls.general_filter_criteria(by_filters or {}, snapshot.c)
+        if criteria is None:
+            return "Invalid"
+        rows = db.session.execute(
+            select(snapshot.c.product_id, snapshot.c.condition, snapshot.c.name,
+                   snapshot.c.quantity, snapshot.c.active)
+            .where(snapshot.c.deleted.is_(False), *criteria)
+            .order_by(*cls.general_filter_order(by_filters or {}, snapshot.c) or
+                      (snapshot.c.product_id, snapshot.c.condition))
+        )
+        return [cls(**row._asdict()) for row in rows]
+
+    @classmethod
+    def general_filter_criteria(cls, by_filters, columns=None):
+        """Builds the WHERE criteria used by find_by_general_filter
+            :param by_filters: contains all the filter parameters and their values; "filter"
+                is an expression parsed by filters.parse and "sort" is left to general_filter_order
+            :type available: dictionary
+            :param columns: the columns filtered, available_columns() by default
+            :return: the criteria, or None if a quantity, its operator or product_id is invalid
+            :rtype: list
+        """
+        # the quantity column of a sharded record is 0, its stock is in the shards
+        available = cls.available_columns()
+        columns = available if columns is None else columns
+        criteria = []
         for attr, values in by_filters.items():
-            if attr == "quantity":
+            if attr == "sort":
+                continue
+            if attr == "filter":
+                compile_filter = filters.compile_cached if columns is available else filters.compile_filter
+                criteria.append(compile_filter(values, columns))
+            elif attr == "quantity":
                 (value, oper) = values
-                dict_oper = {
-                    "=": getattr(cls, attr) == value, "<=": getattr(cls, attr) <= value,
-                    ">=": getattr(cls, attr) >= value, "<": getattr(cls, attr) < value,
-                    ">": getattr(cls, attr) > value
-                    }
                 try:
-                    filt = dict_oper[oper]
-                    __query = __query.filter(filt)
-                except KeyError:
-                    logger.info("Invalid operator %s ...", oper)
-                    return "Invalid"
+                    criteria.append(filters.OPERATORS[oper](columns.quantity, int(value)))
+                except (KeyError, TypeError, ValueError):
+                    logger.info("Invalid quantity %s or operator %s ...", value, oper)
+                    return None
+            elif attr == "product_id":
+                try:
+                    criteria.append(columns.product_id == int(values))
+                except (TypeError, ValueError):
+                    logger.info("Invalid product_id %s ...", values)
+                    return None
             else:
-                __query = __query.filter(getattr(cls, attr) == values)
-            # now we can run the query
-        results = __query.all()
-        return results
+                criteria.append(getattr(columns, attr) == values)
+        return criteria
+
+    @classmethod
+    def general_filter_order(cls, by_filters, columns=None):
+        """Builds the ORDER BY of a "sort" parsed by filters.parse_sort
+
+        The primary key breaks ties, so pages of a sorted list are stable.
+        Returns an empty list when by_filters has no sort.
+        """
+        columns = cls.available_columns() if columns is None else columns
+        sort = by_filters.get("sort")
+        if not sort:
+            return []
+        order = [getattr(columns, name).desc() if descending else getattr(columns, name)
+                 for name, descending in sort]
+        named = {name for name, _ in sort}
+        order.extend(getattr(columns, name) for name in ("product_id", "condition") if name not in named)
+        return order
+
+
+class InventoryShard(db.Model):
+    """
+    Class that represents one shard of the quantity of a sharded Inventory
+    """
+
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    condition = db.Column(Inventory.__table__.c.condition.type, primary_key=True)
+    shard = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.ForeignKeyConstraint(
+            ["product_id", "condition"],
+            ["inventory.product_id", "inventory.condition"],
+            ondelete="CASCADE"
+        ),
+    )
+
+    def __repr__(self):
+        return f"<InventoryShard product_id=[{self.product_id}] shard=[{self.shard}]>"
+
+    @classmethod
+    def of(cls, record):
+        """ Returns a query over the shards of an Inventory record """
+        return cls.query.filter(cls.product_id == record.product_id,
+                                cls.condition == record.condition)
+
+    @classmethod
+    def total(cls, record):
+        """ Sums the quantity over the shards of an Inventory record """
+        return cls.of(record).with_entities(
+            db.func.coalesce(db.func.sum(cls.quantity), 0)
+        ).scalar()
+
+    @classmethod
+    def take(cls, record, amount):
+        """ Removes amount from a random shard, falling back to its siblings
+
+        Only when no single shard holds enough are the shards locked and
+        drained together.
+        """
+        shards = list(range(record.shard_count))
+        random.shuffle(shards)
+        for shard in shards:
+            updated = cls.of(record).filter(
+                cls.shard == shard, cls.quantity >= amount
+            ).update({cls.quantity: cls.quantity - amount}, synchronize_session=False)
+            if updated:
+                return
+        rows = cls.of(record).order_by(cls.shard).with_for_update().all()
+        total = sum(row.quantity for row in rows)
+        if amount > total:
+            raise OutOfRangeError(f'Quantity specified ({amount}) '
+                                  'is more than quantity of record '
+                                  f'({total}).')
+        for row in rows:
+            taken = min(row.quantity, amount)
+            row.quantity -= taken
+            amount -= taken
+
+    @classmethod
+    def give(cls, record, amount):
+        """ Adds amount to a random shard """
+        cls.of(record).filter(
+            cls.shard == random.randrange(record.shard_count)
+        ).update({cls.quantity: cls.quantity + amount}, synchronize_session=False)
+
+    @classmethod
+    def distribute(cls, record, total=None):
+        """ Spreads total evenly over shard_count shards of an Inventory record
+
+        The shards are locked first and, without a total, their own sum is
+        spread, so checkouts that committed meanwhile are not overwritten.
+        """
+        rows = {}
+        locked = cls.of(record).with_for_update().populate_existing().all()
+        if total is None:
+            total = sum(row.quantity for row in locked)
+        for row in locked:
+            if row.shard < record.shard_count:
+                rows[row.shard] = row
+            else:
+                db.session.delete(row)
+        share, remainder = divmod(total, record.shard_count)
+        for shard in range(record.shard_count):
+            row = rows.get(shard)
+            if row is None:
+                row = cls(product_id=record.product_id, condition=record.condition, shard=shard)
+                db.session.add(row)
+            row.quantity = share + (1 if shard < remainder else 0)
+
+    @classmethod
+    def drain(cls, record):
+        """ Locks and deletes every shard of an Inventory record, returning their sum """
+        total = sum(row.quantity for row in cls.of(record).with_for_update().populate_existing().all())
+        cls.remove_all(record)
+        return total
+
+    @classmethod
+    def remove_all(cls, record):
+        """ Deletes every shard of an Inventory record """
+        cls.of(record).delete(synchronize_session="fetch")
+
+
+class Location(db.Model):
+    """
+    Class that represents a warehouse or other place stock is kept
+    """
+
+    EARTH_RADIUS_KM = 6371.0
+
+    code = db.Column(db.String(63), primary_key=True)
+    name = db.Column(db.String(63), nullable=False)
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
+
+    def __repr__(self):
+        return f"<Location '{self.code}'>"
+
+    def serialize(self):
+        """ Serializes a Location into a dictionary """
+        return {"code": self.code, "name": self.name,
+                "latitude": self.latitude, "longitude": self.longitude}
+
+    def deserialize(self, data):
+        """ Sets the name and coordinates of a Location from a dictionary """
+        if not isinstance(data, dict) or not isinstance(data.get("name"), str):
+            raise DataValidationError("Invalid Location: name is required")
+        coordinates = [data.get("latitude"), data.get("longitude")]
+        if any(value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)))
+               for value in coordinates) or (None in coordinates and coordinates != [None, None]):
+            raise DataValidationError("Invalid Location: latitude and longitude must both be numbers")
+        if coordinates[0] is not None and (abs(coordinates[0]) > 90 or abs(coordinates[1]) > 180):
+            raise DataValidationError("Invalid Location: coordinates are out of range")
+        self.name = data["name"]
+        self.latitude, self.longitude = coordinates
+        return self
+
+    def distance_to(self, latitude, longitude):
+        """ Returns the great-circle distance in km, or None without coordinates """
+        if self.latitude is None:
+            return None
+        lat1, lon1, lat2, lon2 = map(math.radians, (self.latitude, self.longitude, latitude, longitude))
+        hav = (math.sin((lat2 - lat1) / 2) ** 2
+               + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+        return 2 * self.EARTH_RADIUS_KM * math.asin(math.sqrt(hav))
+
+    def save(self):
+        """ Creates or updates a Location """
+        db.session.merge(self)
+        db.session.commit()
+
+    @classmethod
+    def find(cls, code):
+        """ Finds a Location by its code """
+        return cls.query.get(code)
+
+    @classmethod
+    def all(cls):
+        """ Returns all of the Locations """
+        return cls.query.order_by(cls.code).all()
+
+    @classmethod
+    def nearest(cls, latitude, longitude):
+        """ Returns the codes of the Locations with coordinates, nearest first """
+        located = [(location.distance_to(latitude, longitude), location.code)
+                   for location in cls.query.filter(cls.latitude.isnot(None))]
+        return [code for _, code in sorted(located)]
+
+
+class InventoryLocation(db.Model):
+    """
+    Class that represents the quantity of an Inventory kept in one Location
+    """
+
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    condition = db.Column(Inventory.__table__.c.condition.type, primary_key=True)
+    location = db.Column(db.String(63), db.ForeignKey("location.code"), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.ForeignKeyConstraint(
+            ["product_id", "condition"],
+            ["inventory.product_id", "inventory.condition"],
+            ondelete="CASCADE"
+        ),
+    )
+
+    def __repr__(self):
+        return f"<InventoryLocation product_id=[{self.product_id}] location=[{self.location}]>"
+
+    def serialize(self):
+        """ Serializes the stock of one location into a dictionary """
+        return {"location": self.location, "quantity": self.quantity}
+
+    @classmethod
+    def of(cls, record):
+        """ Returns a query over the locations of an Inventory record """
+        return cls.query.filter(cls.product_id == record.product_id,
+                                cls.condition == record.condition)
+
+    @classmethod
+    def total(cls, record):
+        """ Sums the quantity over the locations of an Inventory record """
+        return cls.of(record).with_entities(
+            db.func.coalesce(db.func.sum(cls.quantity), 0)
+        ).scalar()
+
+    @classmethod
+    def allocate(cls, record, amount, data):
+        """ Removes amount from the one location the order is shipped from
+
+        The location is data["location"] when given; otherwise the nearest
+        location to data["latitude"]/data["longitude"] that holds enough, or
+        failing coordinates the one holding the most. Picking the location
+        and taking the stock is a single UPDATE.
+
+        Returns:
+            str: the code of the location the amount was taken from
+        """
+        location = data.get("location")
+        latitude, longitude = data.get("latitude"), data.get("longitude")
+        if location is not None and not isinstance(location, str):
+            raise DataValidationError("Location must be a location code.")
+        order = [cls.quantity.desc()]
+        if location is None and latitude is not None:
+            try:
+                codes = Location.nearest(float(latitude), float(longitude))
+            except (TypeError, ValueError) as error:
+                raise DataValidationError("Latitude and longitude must be numbers.") from error
+            if codes:
+                order.insert(0, case({code: rank for rank, code in enumerate(codes)},
+                                     value=cls.location, else_=len(codes)))
+        candidates = cls.of(record).filter(cls.quantity >= amount)
+        if location is not None:
+            candidates = candidates.filter(cls.location == location)
+        target = candidates.with_entities(cls.location).order_by(*order).limit(1).scalar_subquery()
+
+        taken = cls.of(record).filter(cls.location == target, cls.quantity >= amount)
+        if db.engine.dialect.name == "postgresql":
+            row = db.session.execute(
+                update(cls).where(taken.whereclause)
+                .values(quantity=cls.quantity - amount).returning(cls.location)
+                .execution_options(synchronize_session=False)
+            ).first()
+            chosen = row.location if row else None
+        else:
+            # without RETURNING, read the target first; SQLite runs one writer at a time
+            chosen = db.session.query(target).scalar()
+            if chosen is not None and not cls.of(record).filter(
+                    cls.location == chosen, cls.quantity >= amount
+            ).update({cls.quantity: cls.quantity - amount}, synchronize_session=False):
+                chosen = None
+        if chosen is None:
+            where = f"location '{location}'" if location is not None else "any single location"
+            raise OutOfRangeError(f"Quantity specified ({amount}) is more than the quantity in {where}.")
+        return chosen
+
+    @classmethod
+    def give(cls, record, amount, location):
+        """ Adds amount to the stock of a record in a location """
+        if not cls.of(record).filter(cls.location == location).update(
+                {cls.quantity: cls.quantity + amount}, synchronize_session=False):
+            raise DataValidationError(f"Product is not stocked in location '{location}'.")
+
+    @classmethod
+    def put(cls, record, location, quantity):
+        """ Sets the stock of a record in a location, adding the location if needed """
+        row = cls.of(record).filter(cls.location == location).with_for_update().first()
+        if row is None:
+            row = cls(product_id=record.product_id, condition=record.condition, location=location)
+            db.session.add(row)
+        row.quantity = quantity
+        db.session.flush()
+
+    @classmethod
+    def remove(cls, record, location):
+        """ Deletes the stock row of a record in a location, returning if there was one """
+        removed = cls.of(record).filter(cls.location == location).delete(synchronize_session="fetch")
+        db.session.flush()
+        return bool(removed)
+
+    @classmethod
+    def remove_all(cls, record):
+        """ Deletes every location row of an Inventory record """
+        cls.of(record).delete(synchronize_session="fetch")
+
+
+class IdempotencyKey(db.Model):
+    """
+    Class that represents the stored outcome of an idempotent request
+    """
+
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    # None while the first request holding the key is still running
+    status_code = db.Column(db.Integer, nullable=True)
+    response = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<IdempotencyKey '{self.key}' status_code=[{self.status_code}]>"
+
+    @property
+    def completed(self):
+        """ True once the response of the request has been stored """
+        return self.status_code is not None
+
+    def expired(self, now=None):
+        """ True when the key can no longer be replayed or waited on """
+        return self.expires_at <= (now or datetime.utcnow())
+
+    def complete(self, status_code, response, ttl_seconds):
+        """ Stores the response and keeps it for ttl_seconds """
+        self.status_code = status_code
+        self.response = response
+        self.expires_at = datetime.utcnow() + timedelta(seconds=ttl_seconds)
+        db.session.commit()
+
+    def release(self):
+        """ Gives the key up so that the request can be retried """
+        db.session.rollback()
+        db.session.delete(self)
+        db.session.commit()
+
+    @contextmanager
+    def held(self):
+        """ Runs the request holding the key in one transaction with its outcome
+
+        The key row is locked first and the commits made inside the block
+        only release SAVEPOINTs, so what the request changed and the
+        response stored by complete() commit together when the block ends.
+        Until then the lock tells retries the request is still running.
+        """
+        session = db.session()
+        # an UPDATE locks the row and, unlike a SELECT, also opens the transaction
+        # on SQLite, whose driver would otherwise begin it with the SAVEPOINT
+        IdempotencyKey.query.filter_by(key=self.key).update(
+            {IdempotencyKey.fingerprint: IdempotencyKey.fingerprint}, synchronize_session=False)
+        session.begin_nested()
+
+        def next_savepoint(_session, transaction):
+            if transaction.nested and transaction.parent is not None and transaction.parent.is_active:
+                session.begin_nested()
+
+        event.listen(session, "after_transaction_end", next_savepoint)
+        try:
+            yield self
+        except BaseException:
+            event.remove(session, "after_transaction_end", next_savepoint)
+            session.rollback()
+            raise
+        event.remove(session, "after_transaction_end", next_savepoint)
+        while session.in_nested_transaction():
+            session.commit()
+        session.commit()
+
+    def abandoned(self):
+        """ True when the request that claimed the key is gone without completing it
+
+        A running request locks its key (see held), so a key that can be
+        locked was left by a process that died. Only PostgreSQL can tell;
+        elsewhere a claim is kept until it is purged.
+        """
+        if db.engine.dialect.name != "postgresql":
+            return False
+        locked = IdempotencyKey.query.filter_by(key=self.key).with_for_update(skip_locked=True).first()
+        return locked is not None and not locked.completed
+
+    @classmethod
+    def find(cls, key):
+        """ Finds an unexpired IdempotencyKey """
+        record = cls.query.get(key)
+        if record is None or record.expired():
+            return None
+        return record
+
+    @classmethod
+    def claim(cls, key, fingerprint, lock_seconds):
+        """ Reserves a key for a new request
+
+        Returns:
+            IdempotencyKey: the new claim, or the record already holding the key
+            bool: True if the key was claimed by this call
+        """
+        now = datetime.utcnow()
+        existing = cls.query.get(key)
+        if existing is not None:
+            if not existing.expired(now):
+                return existing, False
+            # a request that outlives its lock may still be running: its key is
+            # only taken over once the request is known to be gone
+            if not existing.completed and not existing.abandoned():
+                db.session.rollback()
+                return existing, False
+            db.session.delete(existing)
+            db.session.flush()
+        record = cls(key=key, fingerprint=fingerprint,
+                     expires_at=now + timedelta(seconds=lock_seconds))
+        db.session.add(record)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # a concurrent request claimed the key first
+            db.session.rollback()
+            return cls.query.get(key), False
+        return record, True
+
+    @classmethod
+    def purge_expired(cls, abandoned_after=timedelta(days=1)):
+        """ Deletes expired keys and returns how many there were
+
+        Keys of requests that never completed are kept for abandoned_after,
+        long after the request could still be running.
+        """
+        now = datetime.utcnow()
+        count = cls.query.filter(
+            cls.expires_at <= now,
+            or_(cls.status_code.isnot(None), cls.created_at <= now - abandoned_after)
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+
+class InventoryHistory(db.Model):
+    """
+    Class that represents one state of an Inventory in the append-only stock history
+    """
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
+    product_id = db.Column(db.Integer, nullable=False)
+    condition = db.Column(Inventory.__table__.c.condition.type, nullable=False)
+    name = db.Column(db.String(63), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    active = db.Column(db.Boolean, nullable=False)
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
+    recorded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        # serves both the history of one record and as-of range scans
+        db.Index("ix_inventory_history_key_recorded_at", "product_id", "condition", "recorded_at"),
+        db.Index("ix_inventory_history_recorded_at", "recorded_at"),
+    )
+
+    def __repr__(self):
+        return (f"<InventoryHistory product_id=[{self.product_id}] condition=[{self.condition.name}] "
+                f"quantity=[{self.quantity}] recorded_at=[{self.recorded_at}]>")
+
+    @classmethod
+    def of(cls, name, event):
+        """ Makes the history entry of a stock event """
+        return cls(product_id=event["product_id"], condition=Inventory.Condition(event["condition"]),
+                   name=name, quantity=event["quantity"], active=event["active"],
+                   deleted=event["deleted"], recorded_at=datetime.utcnow())
+
+    def serialize(self):
+        """ Serializes a history entry into a dictionary """
+        return {
+            "recorded_at": self.recorded_at.isoformat(),
+            "name": self.name,
+            "quantity": self.quantity,
+            "active": self.active,
+            "deleted": self.deleted
+        }
+
+    @classmethod
+    def find_range(cls, product_id, condition, since=None, until=None, limit=100):
+        """ Returns the history of one record, oldest first
+
+        Args:
+            product_id (int): the product of the record
+            condition (str): the condition name of the record ('NEW')
+            since (datetime): only entries recorded at or after this time
+            until (datetime): only entries recorded before this time
+            limit (int): the maximum number of entries
+        """
+        try:
+            product_id = int(product_id)
+        except (TypeError, ValueError):
+            return []
+        query = cls.query.filter(cls.product_id == product_id, cls.condition == condition)
+        if since is not None:
+            query = query.filter(cls.recorded_at >= since)
+        if until is not None:
+            query = query.filter(cls.recorded_at < until)
+        return query.order_by(cls.recorded_at, cls.id).limit(limit).all()
+
+
+class InventoryCheckpoint(db.Model):
+    """
+    Class that represents one record in a full snapshot of the inventory
+
+    As-of queries start from the latest checkpoint before the requested
+    time and only replay the history recorded since, instead of the whole
+    history.
+    """
+
+    # history this long before a checkpoint is replayed too, to cover
+    # transactions that were still running while the snapshot was taken
+    OVERLAP = timedelta(minutes=1)
+
+    taken_at = db.Column(db.DateTime, primary_key=True)
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    condition = db.Column(Inventory.__table__.c.condition.type, primary_key=True)
+    name = db.Column(db.String(63), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    active = db.Column(db.Boolean, nullable=False)
+
+    def __repr__(self):
+        return f"<InventoryCheckpoint taken_at=[{self.taken_at}] product_id=[{self.product_id}]>"
+
+    @classmethod
+    def take(cls):
+        """ Snapshots every record and returns how many were copied """
+        now = datetime.utcnow()
+        inventory = Inventory.__table__
+        snapshot = select(literal(now), inventory.c.product_id, inventory.c.condition, inventory.c.name,
+                          Inventory.quantity_expression(), inventory.c.active)
+        count = db.session.execute(cls.__table__.insert().from_select(
+            ["taken_at", "product_id", "condition", "name", "quantity", "active"], snapshot
+        )).rowcount
+        db.session.commit()
+        logger.info("Checkpointed %d records at %s", count, now)
+        return count
+
+    @classmethod
+    def latest_before(cls, as_of):
+        """ Returns when the last checkpoint up to as_of was taken, or None """
+        return db.session.query(func.max(cls.taken_at)).filter(cls.taken_at <= as_of).scalar()
+
+    @classmethod
+    def prune(cls, before):
+        """ Deletes the checkpoints taken before a time, keeping the latest of them """
+        keep = cls.latest_before(before)
+        if keep is None:
+            return 0
+        count = cls.query.filter(cls.taken_at < keep).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+
+######################################################################
+#  R E S U L T   C A C H E
+######################################################################
+
+# Cached list rows, versioned per condition
+cached_results = ResultCache(partitions=[condition.name for condition in Inventory.Condition])
+
+CACHE_PENDING_KEY = "pending_result_invalidations"
+CACHED_TABLES = frozenset(table.name for table in (
+    Inventory.__table__, InventoryShard.__table__, InventoryLocation.__table__
+))
+
+
+def init_result_cache(app):
+    """Configures the result cache and hooks its invalidation onto the session"""
+    cached_results.ttl = app.config.get("RESULT_CACHE_TTL_SECONDS", cached_results.ttl)
+    cached_results.stale = app.config.get("RESULT_CACHE_STALE_SECONDS", cached_results.stale)
+    cached_results.max_rows = app.config.get("RESULT_CACHE_MAX_ROWS", cached_results.max_rows)
+    cached_results.init_app(app.app_context, db.session.remove)
+    if not event.contains(db.session, "after_flush", _stage_flushed_changes):
+        event.listen(db.session, "after_flush", _stage_flushed_changes)
+        event.listen(db.session, "do_orm_execute", _stage_executed_changes)
+        event.listen(db.session, "after_commit", _invalidate_committed_changes)
+        event.listen(db.session, "after_soft_rollback", _discard_staged_changes)
+    if broadcaster.uses_listen_notify():
+        # changes committed by the other processes, heard once the cache is first read
+        broadcaster.observe(_invalidate_notified_change)
+
+
+def stage_result_invalidation(session, partitions=ALL):
+    """Invalidates the cached results of partitions once session commits"""
+    pending = session.info.setdefault(CACHE_PENDING_KEY, set())
+    if partitions is ALL:
+        pending.add(ALL)
+    else:
+        pending.update(partitions)
+
+
+def _partition(condition):
+    # a condition is a member, or its name before the record is flushed
+    return condition.name if isinstance(condition, Inventory.Condition) else condition
+
+
+def _stage_flushed_changes(session, flush_context):  # pylint: disable=unused-argument
+    for instance in chain(session.new, session.dirty, session.deleted):
+        if isinstance(instance, (Inventory, InventoryShard, InventoryLocation)):
+            partition = _partition(instance.condition)
+            stage_result_invalidation(session, (partition,) if partition in cached_results.partitions else ALL)
+
+
+def _stage_executed_changes(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement, "table", None)
+        if getattr(table, "name", None) in CACHED_TABLES:
+            stage_result_invalidation(orm_execute_state.session)
+
+
+def _invalidate_committed_changes(session):
+    # savepoint releases also fire after_commit; wait for the real commit
+    if session.in_nested_transaction():
+        return
+    pending = session.info.pop(CACHE_PENDING_KEY, None)
+    if pending:
+        cached_results.invalidate(ALL if ALL in pending else tuple(pending))
+
+
+def _discard_staged_changes(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop(CACHE_PENDING_KEY, None)
+
+
+def _invalidate_notified_change(stock_event):
+    cached_results.invalidate((Inventory.Condition(stock_event["condition"]).name,))
+
+
+######################################################################
+#  C O L U M N A R   S N A P S H O T
+######################################################################
+columnar_snapshot = ColumnarSnapshot(conditions=list(Inventory.Condition))
+
+
+def init_columnar_snapshot(app):
+    """Configures the columnar snapshot lists are answered from when COLUMNAR_SNAPSHOT is set"""
+    columnar_snapshot.interval = app.config.get("COLUMNAR_REFRESH_SECONDS", columnar_snapshot.interval)
+    columnar_snapshot.full_interval = app.config.get("COLUMNAR_FULL_REFRESH_SECONDS",
+                                                     columnar_snapshot.full_interval)
+    columnar_snapshot.init_app(_snapshot_rows, app.app_context, db.session.remove)
+    if app.config.get("COLUMNAR_SNAPSHOT") and not columnar_available():
+        logger.warning("COLUMNAR_SNAPSHOT needs numpy, lists are read from the database")
+
+
+######################################################################
+#  S H A R E D   S T O C K   T A B L E
+######################################################################
+stock_table = SharedStockTable(conditions=list(Inventory.Condition))
+
+
+def init_stock_table(app):
+    """Configures the stock table single-record reads are answered from when STOCK_TABLE is set"""
+    stock_table.slots = app.config.get("STOCK_TABLE_SLOTS", stock_table.slots)
+    stock_table.interval = app.config.get("STOCK_TABLE_REFRESH_SECONDS", stock_table.interval)
+    stock_table.max_staleness = app.config.get("STOCK_TABLE_MAX_STALENESS_SECONDS", stock_table.max_staleness)
+    stock_table.init_app(_snapshot_rows, app.app_context, db.session.remove)
+
+
+def _snapshot_rows(since):
+    """Returns the number of inventory rows and the rows updated at or after since
+
+    Sharded rows are always returned, their shards changing without
+    updating them. One statement reads both, so the count matches the rows.
+    """
+    table = Inventory.__table__
+    total = select(func.count().label("total")).select_from(table).subquery("total")
+    changed = select(table.c.product_id, table.c.name, table.c.condition,
+                     Inventory.quantity_expression().label("quantity"), table.c.active, table.c.updated_at)
+    if since is not None:
+        changed = changed.where(or_(table.c.updated_at >= since, table.c.shard_count > 0))
+    changed = changed.subquery("changed")
+    rows = db.session.execute(
+        select(total.c.total, changed).select_from(total.outerjoin(changed, true()))
+    ).all()
+    return rows[0][0], [tuple(row[1:]) for row in rows if row.product_id is not None]
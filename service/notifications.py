@@ -0,0 +1,257 @@
+"""
+Stock Notifications
+
+This module fans quantity changes out to Server-Sent Event subscribers.
+
+Every worker process owns a single StockBroadcaster. On PostgreSQL the
+model stages a ``pg_notify`` inside the mutating transaction and one
+background thread per process LISTENs on the channel, so all workers see
+every committed change through one database connection. On any other
+database (e.g. SQLite in development) events are published in-process
+right after the session commits.
+"""
+import json
+import logging
+import os
+import select
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import Text, cast, event, func, text
+from sqlalchemy import select as sql_select
+
+logger = logging.getLogger("flask.app")
+
+CHANNEL = "inventory_stock"
+PENDING_KEY = "pending_stock_events"
+
+
+class Subscription:
+    """A single client's interest in a set of (product_id, condition) keys
+
+    Only the latest event per key is kept, so a slow client can never make
+    the queue grow past the number of keys it subscribed to.
+    """
+
+    def __init__(self, broadcaster, keys):
+        self.broadcaster = broadcaster
+        self.keys = frozenset(keys)
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        self.closed = False
+
+    def push(self, stock_event):
+        """Queues an event, replacing any undelivered event for the same key"""
+        key = (stock_event["product_id"], stock_event["condition"])
+        with self._cond:
+            self._pending.pop(key, None)
+            self._pending[key] = stock_event
+            self._cond.notify()
+
+    def wait(self, timeout):
+        """Returns the pending events, blocking up to timeout seconds for one"""
+        with self._cond:
+            if not self._pending and not self.closed:
+                self._cond.wait(timeout)
+            events = list(self._pending.values())
+            self._pending.clear()
+        return events
+
+    def close(self):
+        """Detaches the subscription from its broadcaster"""
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+        self.broadcaster.unsubscribe(self)
+
+
+class StockBroadcaster:
+    """Per-process fan-out of stock events to subscriptions"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_key = {}
+        self._count = 0
+        self._listener = None
+        self._listener_pid = None
+        self._observers = []
+        self.engine = None
+
+    @property
+    def subscriber_count(self):
+        """Number of open subscriptions in this process"""
+        return self._count
+
+    def init_app(self, engine):
+        """Binds the broadcaster to the engine used by the models"""
+        self.engine = engine
+
+    def uses_listen_notify(self):
+        """True when events travel through PostgreSQL LISTEN/NOTIFY"""
+        return self.engine is not None and self.engine.dialect.name == "postgresql"
+
+    def subscribe(self, keys):
+        """Registers a new subscription for the given keys"""
+        subscription = Subscription(self, keys)
+        with self._lock:
+            for key in subscription.keys:
+                self._by_key.setdefault(key, set()).add(subscription)
+            self._count += 1
+        if self.uses_listen_notify():
+            self._ensure_listener()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Removes a subscription; safe to call more than once"""
+        with self._lock:
+            removed = False
+            for key in subscription.keys:
+                subscribers = self._by_key.get(key)
+                if subscribers and subscription in subscribers:
+                    subscribers.discard(subscription)
+                    removed = True
+                    if not subscribers:
+                        del self._by_key[key]
+            if removed:
+                self._count -= 1
+
+    def observe(self, callback):
+        """Calls callback(stock_event) for every event published in this process
+
+        On PostgreSQL the events of the other processes only arrive once
+        ensure_observed has started the listener of this process.
+        """
+        with self._lock:
+            if callback not in self._observers:
+                self._observers.append(callback)
+
+    def ensure_observed(self):
+        """Starts the listener of this process on PostgreSQL if anyone observes events
+
+        Called where the observed state is read rather than when observing
+        starts, so a master that preloads the app never starts a listener
+        (and opens its connection) before forking the workers.
+        """
+        if self._observers and self.uses_listen_notify():
+            self._ensure_listener()
+
+    def publish(self, stock_event):
+        """Delivers an event to every subscription interested in its key"""
+        key = (stock_event["product_id"], stock_event["condition"])
+        with self._lock:
+            subscribers = list(self._by_key.get(key, ()))
+            observers = list(self._observers)
+        for observer in observers:
+            observer(stock_event)
+        for subscription in subscribers:
+            subscription.push(stock_event)
+
+    def stage(self, session, stock_event):
+        """Attaches an event to the session's current transaction
+
+        The event is only delivered if the transaction commits.
+        """
+        if self.uses_listen_notify():
+            session.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                {"channel": CHANNEL, "payload": json.dumps(stock_event)},
+            )
+        else:
+            session.info.setdefault(PENDING_KEY, []).append(stock_event)
+
+    def stage_rows(self, session, rows):
+        """Attaches the events of the rows of a SELECT to the session's current transaction
+
+        rows selects the fields of stock events (product_id, condition as
+        its value, quantity, active and deleted); on PostgreSQL every row
+        is notified by a single statement, without reading the rows.
+        """
+        if self.uses_listen_notify():
+            events = rows.subquery()
+            payload = func.json_build_object(*[part for column in events.c for part in (column.name, column)])
+            session.execute(sql_select(func.count(func.pg_notify(CHANNEL, cast(payload, Text)))))
+        else:
+            for row in session.execute(rows):
+                session.info.setdefault(PENDING_KEY, []).append(dict(row._mapping))
+
+    def flush_pending(self, session):
+        """Publishes in-process events staged on a committed session"""
+        for stock_event in session.info.pop(PENDING_KEY, []):
+            self.publish(stock_event)
+
+    @staticmethod
+    def discard_pending(session):
+        """Drops in-process events staged on a rolled back session"""
+        session.info.pop(PENDING_KEY, None)
+
+    ######################################################################
+    # PostgreSQL listener
+    ######################################################################
+    def _ensure_listener(self):
+        # a listener serves the process that started it, never a child forked from it
+        pid = os.getpid()
+        if self._listener_pid == pid and self._listener.is_alive():
+            return
+        with self._lock:
+            if self._listener_pid == pid and self._listener.is_alive():
+                return
+            self._listener = threading.Thread(
+                target=self._listen_forever, name="stock-listener", daemon=True
+            )
+            self._listener_pid = pid
+            self._listener.start()
+
+    def _listen_forever(self):
+        backoff = 1
+        while True:
+            try:
+                self._listen()
+                backoff = 1
+            except Exception as error:  # pylint: disable=broad-except
+                logger.warning("Stock listener failed: %s; retrying in %ss", error, backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+    def _listen(self):
+        raw = self.engine.raw_connection()
+        try:
+            conn = raw.connection
+            conn.set_isolation_level(0)  # autocommit, required for LISTEN
+            conn.cursor().execute(f"LISTEN {CHANNEL}")
+            logger.info("Listening for stock changes on channel %s", CHANNEL)
+            while True:
+                if select.select([conn], [], [], 5) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    self.publish(json.loads(notify.payload))
+        finally:
+            raw.invalidate()
+
+
+broadcaster = StockBroadcaster()
+
+
+def _after_commit(session):
+    # savepoint releases also fire after_commit; wait for the real commit
+    if not session.in_nested_transaction():
+        broadcaster.flush_pending(session)
+
+
+def _after_soft_rollback(session, previous_transaction):
+    if not previous_transaction.nested:
+        broadcaster.discard_pending(session)
+
+
+def register_session_events(session):
+    """Hooks in-process delivery onto the commit/rollback of a scoped session"""
+    if not event.contains(session, "after_commit", _after_commit):
+        event.listen(session, "after_commit", _after_commit)
+        event.listen(session, "after_soft_rollback", _after_soft_rollback)
+
+
+def format_sse(stock_event, event_id):
+    """Formats a stock event as a Server-Sent Events message"""
+    return f"id: {event_id}\nevent: stock\ndata: {json.dumps(stock_event)}\n\n"
@@ -0,0 +1,164 @@
+"""
+Inventory Table Partitioning
+
+PostgreSQL can split the inventory table into partitions, either hashed
+on product_id or listed by condition, so that vacuum, index rebuilds and
+scans work on one partition at a time. Lookups by the primary key (and
+filters on condition for list partitioning) are pruned to one partition.
+
+New databases are created partitioned when INVENTORY_PARTITIONING is set
+(see configure). Existing tables are converted, in either direction, with
+
+  flask inventory partition --by hash --partitions 16
+
+which rebuilds the table in a single transaction. Other databases have
+no partitioning and ignore the setting.
+"""
+import logging
+
+from sqlalchemy import event, text
+
+logger = logging.getLogger("flask.app")
+
+SCHEMES = ("hash", "list")
+TABLE = "inventory"
+REBUILT = "inventory_rebuilt"
+
+
+def partition_by(scheme):
+    """Returns the PARTITION BY clause of a scheme"""
+    if scheme == "hash":
+        return "HASH (product_id)"
+    if scheme == "list":
+        return "LIST (condition)"
+    raise ValueError(f"Unknown partitioning scheme '{scheme}'")
+
+
+def partition_ddl(parent, scheme, partitions, conditions, prefix=None):
+    """Returns the CREATE TABLE statements of the partitions of parent
+
+    Args:
+        parent (str): the partitioned table
+        scheme (str): 'hash' or 'list'
+        partitions (int): the number of hash partitions
+        conditions (list): the condition names, one list partition each
+        prefix (str): the name the partition names start with, parent by default
+    """
+    prefix = prefix or parent
+    if scheme == "hash":
+        return [f"CREATE TABLE {prefix}_p{remainder} PARTITION OF {parent} "
+                f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"
+                for remainder in range(partitions)]
+    return [f"CREATE TABLE {prefix}_{name.lower()} PARTITION OF {parent} FOR VALUES IN ('{name}')"
+            for name in conditions] + [f"CREATE TABLE {prefix}_default PARTITION OF {parent} DEFAULT"]
+
+
+def configure(table, scheme, partitions):
+    """Makes create_all create table partitioned on PostgreSQL
+
+    Only affects tables that do not exist yet; use migrate for the others.
+    """
+    if not scheme:
+        return
+    if partitions < 1:
+        raise ValueError("The number of partitions must be at least 1")
+    table.dialect_options["postgresql"]["partition_by"] = partition_by(scheme)
+    table.info["partitioning"] = (scheme, partitions)
+    if not event.contains(table, "after_create", _create_partitions):
+        event.listen(table, "after_create", _create_partitions)
+
+
+def _create_partitions(target, connection, **kwargs):  # pylint: disable=unused-argument
+    if connection.dialect.name != "postgresql":
+        return
+    scheme, partitions = target.info["partitioning"]
+    conditions = list(target.c.condition.type.enums)
+    for statement in partition_ddl(target.name, scheme, partitions, conditions):
+        connection.execute(text(statement))
+    logger.info("Created %s partitioned table %s", scheme, target.name)
+
+
+def describe(connection):
+    """Returns the scheme and the (partition, estimated rows) of the inventory table
+
+    The scheme is None when the table is not partitioned.
+    """
+    strategy = connection.execute(text(
+        "SELECT partstrat FROM pg_partitioned_table WHERE partrelid = CAST(:table AS regclass)"
+    ), {"table": TABLE}).scalar()
+    if strategy is None:
+        return None, []
+    rows = connection.execute(text(
+        "SELECT child.relname, child.reltuples FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = CAST(:table AS regclass) ORDER BY child.relname"
+    ), {"table": TABLE}).all()
+    return {"h": "hash", "l": "list"}.get(strategy, strategy), [(name, max(int(count), 0)) for name, count in rows]
+
+
+def check(engine, scheme):
+    """Warns when the inventory table is not partitioned as configured"""
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.connect() as connection:
+        current = describe(connection)[0]
+    if current != (scheme or None):
+        logger.warning("The inventory table is partitioned by %s, not %s: run 'flask inventory partition'",
+                       current or "nothing", scheme or "nothing")
+
+
+def migrate(connection, table, scheme, partitions, after_rebuild=()):
+    """Rebuilds the inventory table with a new partitioning scheme
+
+    Runs in the caller's transaction: the table is locked, copied into a
+    replacement, and swapped in with its primary key, indexes and the
+    foreign keys of the tables referencing it.
+
+    Args:
+        connection: a PostgreSQL connection inside a transaction
+        table (Table): the inventory Table, whose indexes are recreated
+        scheme (str): 'hash', 'list', or None for an unpartitioned table
+        partitions (int): the number of hash partitions
+        after_rebuild (list): further SQL to run on the new table, e.g. search indexes
+
+    Returns:
+        int: the number of rows copied
+    """
+    if connection.dialect.name != "postgresql":
+        raise ValueError("Partitioning needs PostgreSQL")
+    clause = f" PARTITION BY {partition_by(scheme)}" if scheme else ""
+    if scheme == "hash" and partitions < 1:
+        raise ValueError("The number of partitions must be at least 1")
+    execute = connection.execute
+
+    execute(text(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE"))
+    execute(text(f"DROP TABLE IF EXISTS {REBUILT}"))
+    execute(text(f"CREATE TABLE {REBUILT} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS){clause}"))
+    partition_names = []
+    if scheme:
+        conditions = list(table.c.condition.type.enums)
+        for statement in partition_ddl(REBUILT, scheme, partitions, conditions, prefix=f"{REBUILT}_part"):
+            execute(text(statement))
+            partition_names.append(statement.split()[2])
+    copied = execute(text(f"INSERT INTO {REBUILT} SELECT * FROM {TABLE}")).rowcount
+
+    foreign_keys = execute(text(
+        "SELECT CAST(conrelid AS regclass), conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE confrelid = CAST(:table AS regclass) AND contype = 'f' AND conparentid = 0"
+    ), {"table": TABLE}).all()
+    for relation, name, _ in foreign_keys:
+        execute(text(f'ALTER TABLE {relation} DROP CONSTRAINT "{name}"'))
+    execute(text(f"DROP TABLE {TABLE}"))
+    execute(text(f"ALTER TABLE {REBUILT} RENAME TO {TABLE}"))
+    for name in partition_names:
+        execute(text(f"ALTER TABLE {name} RENAME TO {name.replace(f'{REBUILT}_part', TABLE, 1)}"))
+    execute(text(f"ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_pkey PRIMARY KEY (product_id, condition)"))
+    for index in table.indexes:
+        index.create(connection)
+    for statement in after_rebuild:
+        execute(text(statement))
+    for relation, name, definition in foreign_keys:
+        execute(text(f'ALTER TABLE {relation} ADD CONSTRAINT "{name}" {definition}'))
+    execute(text(f"ANALYZE {TABLE}"))
+    logger.info("Rebuilt %s as %s with %d rows", TABLE, scheme or "unpartitioned", copied)
+    return copied
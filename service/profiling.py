@@ -0,0 +1,205 @@
+"""
+On-demand Profiling
+
+Profiles a serving worker from the outside, for CPU hotspots that only
+show under production traffic, without redeploying with extra tooling.
+Both modes need the token in PROFILING_TOKEN as an
+"Authorization: Bearer <token>" header; without a token configured the
+endpoint answers 404 and the header is ignored.
+
+GET /admin/profile?seconds=10&interval_ms=10 samples the stacks of every
+other thread of the worker that answers it with sys._current_frames() and
+returns how often each stack was seen as collapsed stacks ("outer;inner
+count" lines, the input of flamegraph.pl and speedscope). The profiled
+code runs untouched: the only cost is the sampling thread walking the
+stacks while it holds the GIL, and the pause between samples grows so
+that this never takes more than MAX_OVERHEAD of the time. Sampling needs
+a threaded (gthread) worker, since a sync worker serves nothing else
+while it samples and a gevent worker only shows the running greenlet.
+
+A request sent with an "X-Profile" header (and the token) runs under
+cProfile and is answered with the pstats report of its functions, sorted
+by the header's value (cumulative, tottime or calls), instead of its
+response, whose status is sent in X-Profiled-Status. cProfile only traces
+the thread of that request. Streamed responses are profiled until their
+body starts.
+
+A worker runs one profile at a time, others are answered with 409 right
+away, and a profile covers the worker that accepted it, whose pid is sent
+in X-Profiled-Pid.
+"""
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Response, abort, request
+
+from service.common import status
+
+AUTH_SCHEME = "Bearer "
+PROFILE_HEADER = "X-Profile"
+PROFILED_STATUS_HEADER = "X-Profiled-Status"
+PID_HEADER = "X-Profiled-Pid"
+PROFILE_KEY = "inventory.profile"
+SORT_KEYS = ("cumulative", "tottime", "calls")
+REPORT_FUNCTIONS = 60
+# fraction of the time the sampling thread may spend walking stacks
+MAX_OVERHEAD = 0.01
+MIN_INTERVAL = 0.001
+MAX_DEPTH = 128
+
+
+def authorized(token):
+    """Returns whether the request carries the profiling token"""
+    header = request.headers.get("Authorization", "")
+    return bool(token) and header.startswith(AUTH_SCHEME) and hmac.compare_digest(
+        header[len(AUTH_SCHEME):].encode(), token.encode())
+
+
+def _short_path(path):
+    """Returns path relative to the sys.path entry it was imported from"""
+    for root in sorted((entry for entry in sys.path if entry), key=len, reverse=True):
+        if path.startswith(root.rstrip(os.sep) + os.sep):
+            return path[len(root.rstrip(os.sep)) + 1:]
+    return path
+
+
+class Profiler:
+    """Runs one profile at a time in this process
+
+    Args:
+        clock (callable): returns the current time in seconds
+        sleep (callable): waits for a number of seconds
+    """
+
+    def __init__(self, clock=time.monotonic, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self.profiles = self.rejected = 0
+
+    def acquire(self):
+        """Returns whether the caller may profile, counting the profiles turned away"""
+        if not self._lock.acquire(blocking=False):  # pylint: disable=consider-using-with
+            self.rejected += 1
+            return False
+        self.profiles += 1
+        return True
+
+    def release(self):
+        """Lets the next profile run"""
+        self._lock.release()
+
+    def sample(self, seconds, interval):
+        """Samples the stacks of the other threads of this process
+
+        Args:
+            seconds (float): how long to sample for
+            interval (float): seconds between samples, at least MIN_INTERVAL
+
+        Returns:
+            tuple: a Counter of the collapsed stacks, the number of samples
+                and the fraction of the time spent sampling, or None while
+                another profile is running
+        """
+        if not self.acquire():
+            return None
+        try:
+            return self._sample(seconds, max(interval, MIN_INTERVAL))
+        finally:
+            self.release()
+
+    def _sample(self, seconds, interval):
+        own = threading.get_ident()
+        labels = {}
+        stacks = Counter()
+        samples, busy = 0, 0.0
+        started = self.clock()
+        deadline = started + seconds
+        while True:
+            began = time.perf_counter()
+            for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_DEPTH:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = (f"{code.co_name} "
+                                                f"({_short_path(code.co_filename)}:{code.co_firstlineno})")
+                    stack.append(label)
+                    frame = frame.f_back
+                stacks[";".join(reversed(stack))] += 1
+            cost = time.perf_counter() - began
+            samples += 1
+            busy += cost
+            pause = max(interval, cost / MAX_OVERHEAD - cost)
+            if self.clock() + pause >= deadline:
+                break
+            self.sleep(pause)
+        return stacks, samples, busy / max(self.clock() - started, cost, 1e-9)
+
+    @staticmethod
+    def report(profile, sort="cumulative"):
+        """Returns the pstats report of a disabled cProfile.Profile"""
+        output = io.StringIO()
+        stats = pstats.Stats(profile, stream=output)
+        stats.sort_stats(sort if sort in SORT_KEYS else "cumulative").print_stats(REPORT_FUNCTIONS)
+        return output.getvalue()
+
+    def stats(self):
+        """Returns how many profiles ran and were turned away"""
+        return {"profiles": self.profiles, "rejected": self.rejected, "running": self._lock.locked()}
+
+
+profiler = Profiler()
+
+
+def collapsed(stacks):
+    """Returns the collapsed-stack text of a Counter of stacks, most seen first"""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def init_profiling(app):
+    """Runs requests flagged with the X-Profile header under cProfile
+
+    Call it before the other request hooks are added, so the profile
+    covers them and the response they produce.
+    """
+    @app.before_request
+    def start_profile():  # pylint: disable=unused-variable
+        token = app.config["PROFILING_TOKEN"]
+        if PROFILE_HEADER not in request.headers or not token:
+            return
+        if not authorized(token):
+            abort(status.HTTP_401_UNAUTHORIZED, "A valid profiling token is required.")
+        if not profiler.acquire():
+            abort(status.HTTP_409_CONFLICT, "Another profile is running in this worker.")
+        profile = request.environ[PROFILE_KEY] = cProfile.Profile()
+        profile.enable()
+
+    @app.after_request
+    def finish_profile(response):  # pylint: disable=unused-variable
+        profile = request.environ.pop(PROFILE_KEY, None)
+        if profile is None:
+            return response
+        profile.disable()
+        profiler.release()
+        return Response(profiler.report(profile, request.headers[PROFILE_HEADER].strip().lower()),
+                        mimetype="text/plain",
+                        headers={PROFILED_STATUS_HEADER: str(response.status_code), PID_HEADER: str(os.getpid())})
+
+    @app.teardown_request
+    def stop_profile(_error):  # pylint: disable=unused-variable
+        # after_request does not run when the request failed unhandled
+        profile = request.environ.pop(PROFILE_KEY, None)
+        if profile is not None:
+            profile.disable()
+            profiler.release()
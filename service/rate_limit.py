@@ -0,0 +1,260 @@
+"""
+Rate Limiting
+
+Each client gets a token bucket holding up to RATE_LIMIT_BURST tokens and
+refilled at RATE_LIMIT_PER_SECOND. Every request to a limited route takes
+as many tokens as the route costs (listing everything costs more than
+reading one record) and is refused with 429 when the bucket runs dry.
+Clients are told where they stand through the RateLimit-Limit,
+RateLimit-Remaining and RateLimit-Reset headers.
+
+Clients are identified by their X-Api-Key header, or by their address
+without one. Behind load balancers or ingress proxies, TRUSTED_PROXY_HOPS
+tells how many of them append to X-Forwarded-For, and the address they
+saw is used; entries a client sent itself are never trusted. The buckets
+live in a store chosen with RATE_LIMIT_STORE:
+
+  shm       - a memory-mapped file shared by the worker processes of a host
+              (RATE_LIMIT_SHM_PATH, by default one per user id)
+  memory    - the memory of one process
+  redis://  - a Redis server shared by every host (needs the redis package)
+"""
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from flask import jsonify, request
+from werkzeug.middleware.proxy_fix import ProxyFix
+from service.common import status
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - redis is optional
+    redis = None
+
+API_KEY_HEADER = "X-Api-Key"
+MAX_MEMORY_BUCKETS = 100000
+SHM_PATH = os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+                        f"inventory-rate-limit-{os.getuid()}")
+SHM_SLOTS = 65536
+SHM_PROBES = 8
+HEADERS_KEY = "inventory.rate_limit_headers"
+
+
+def refill(tokens, updated, now, rate, burst):
+    """Returns the tokens of a bucket once refilled up to now"""
+    return min(burst, tokens + max(0.0, now - updated) * rate)
+
+
+class MemoryStore:
+    """Buckets in the memory of this process, least recently used dropped first"""
+
+    def __init__(self, max_buckets=MAX_MEMORY_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, cost, rate, burst, now):
+        """Takes cost tokens from the bucket of key if it has them
+
+        Returns:
+            tuple: whether the tokens were taken, and the tokens left
+        """
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = refill(tokens, updated, now, rate, burst)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+            return allowed, tokens
+
+
+class SharedMemoryStore:
+    """Buckets in a memory-mapped file shared by the processes of a host
+
+    The file is a fixed table of (key digest, tokens, updated) slots found
+    by open addressing; when the probed slots are all taken the one idle
+    the longest is given to the new key. Access is serialized with an
+    fcntl lock on the file, and the mapping is reopened after a fork.
+    """
+
+    SLOT = struct.Struct("=Qdd")
+
+    def __init__(self, path=SHM_PATH, slots=SHM_SLOTS):
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+
+    def _open(self):
+        if self._pid == os.getpid():
+            return
+        size = self.slots * self.SLOT.size
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._pid = os.getpid()
+
+    def _slot(self, digest):
+        """Returns the offset of the slot of digest, claiming one if needed"""
+        stalest = None
+        for probe in range(SHM_PROBES):
+            offset = ((digest + probe) % self.slots) * self.SLOT.size
+            owner, _, updated = self.SLOT.unpack_from(self._map, offset)
+            if owner in (digest, 0):
+                return offset, owner == digest
+            if stalest is None or updated < stalest[1]:
+                stalest = (offset, updated)
+        return stalest[0], False
+
+    def take(self, key, cost, rate, burst, now):
+        """Takes cost tokens from the bucket of key if it has them
+
+        Returns:
+            tuple: whether the tokens were taken, and the tokens left
+        """
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+        with self._lock:
+            self._open()
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                offset, found = self._slot(digest)
+                tokens, updated = self.SLOT.unpack_from(self._map, offset)[1:] if found else (burst, now)
+                tokens = refill(tokens, updated, now, rate, burst)
+                allowed = tokens >= cost
+                if allowed:
+                    tokens -= cost
+                self.SLOT.pack_into(self._map, offset, digest, tokens, now)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        return allowed, tokens
+
+
+class RedisStore:  # pylint: disable=too-few-public-methods
+    """Buckets in Redis, updated atomically by a Lua script"""
+
+    SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local cost, rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= cost then
+  tokens = tokens - cost
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("RATE_LIMIT_STORE needs the redis package for a redis:// URL")
+        self._script = redis.Redis.from_url(url).register_script(self.SCRIPT)
+
+    def take(self, key, cost, rate, burst, now):
+        """Takes cost tokens from the bucket of key if it has them"""
+        allowed, tokens = self._script(keys=[f"inventory:rate-limit:{key}"], args=[cost, rate, burst, now])
+        return bool(allowed), float(tokens)
+
+
+def create_store(setting, shm_path=SHM_PATH):
+    """Returns the store named by RATE_LIMIT_STORE"""
+    if setting == "memory":
+        return MemoryStore()
+    if setting == "shm":
+        return SharedMemoryStore(shm_path)
+    if setting.startswith(("redis://", "rediss://")):
+        return RedisStore(setting)
+    raise ValueError(f"Unknown RATE_LIMIT_STORE '{setting}'")
+
+
+def client_key():
+    """Identifies the client of the current request"""
+    api_key = request.headers.get(API_KEY_HEADER)
+    if api_key:
+        return "key:" + hashlib.sha256(api_key.encode()).hexdigest()
+    return f"ip:{request.remote_addr}"
+
+
+class RateLimiter:
+    """Charges requests to the token bucket of their client"""
+
+    def __init__(self):
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def store(self, setting, shm_path=SHM_PATH):
+        """Returns the store for a RATE_LIMIT_STORE setting, creating it once"""
+        with self._lock:
+            if (setting, shm_path) not in self._stores:
+                self._stores[setting, shm_path] = create_store(setting, shm_path)
+            return self._stores[setting, shm_path]
+
+    def charge(self, config, key, cost):
+        """Takes the cost of a request from the bucket of key
+
+        Returns:
+            tuple: whether the request may proceed, and its RateLimit headers
+        """
+        rate, burst = config["RATE_LIMIT_PER_SECOND"], config["RATE_LIMIT_BURST"]
+        cost = min(cost, burst)
+        store = self.store(config["RATE_LIMIT_STORE"], config.get("RATE_LIMIT_SHM_PATH") or SHM_PATH)
+        allowed, tokens = store.take(key, cost, rate, burst, time.time())
+        headers = {
+            "RateLimit-Limit": str(int(burst)),
+            "RateLimit-Remaining": str(int(tokens)),
+            "RateLimit-Reset": str(math.ceil((burst - tokens) / rate)),
+        }
+        if not allowed:
+            headers["Retry-After"] = str(math.ceil((cost - tokens) / rate))
+        return allowed, headers
+
+
+limiter = RateLimiter()
+
+
+def trust_proxies(app):
+    """Takes the client address from the X-Forwarded-For entries of TRUSTED_PROXY_HOPS proxies"""
+    hops = app.config["TRUSTED_PROXY_HOPS"]
+    if hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops)
+
+
+def init_rate_limits(app, costs):
+    """Rate limits the routes in costs ({endpoint: tokens, or a function of the request})"""
+    @app.before_request
+    def charge():  # pylint: disable=unused-variable
+        cost = costs.get(request.endpoint)
+        if cost is None or not app.config["RATE_LIMIT"]:
+            return None
+        cost = cost(request) if callable(cost) else cost
+        allowed, headers = limiter.charge(app.config, client_key(), cost)
+        request.environ[HEADERS_KEY] = headers
+        if allowed:
+            return None
+        app.logger.warning("Rate limited %s on %s %s", client_key(), request.method, request.path)
+        return (jsonify(status=status.HTTP_429_TOO_MANY_REQUESTS, error="Too Many Requests",
+                        message="Rate limit exceeded, please retry later."),
+                status.HTTP_429_TOO_MANY_REQUESTS, headers)
+
+    @app.after_request
+    def add_headers(response):  # pylint: disable=unused-variable
+        for name, value in request.environ.get(HEADERS_KEY, {}).items():
+            response.headers.setdefault(name, value)
+        return response
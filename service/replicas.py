@@ -0,0 +1,204 @@
+"""
+Read Replicas
+
+Read-only routes decorated with ``@replica_read`` run their queries on a
+read replica when DATABASE_REPLICA_URIS lists any. Everything else, and
+every flush, goes to the primary database.
+
+A client that has just changed something must see its change, so a
+successful POST, PUT, PATCH or DELETE sets a short-lived cookie and that
+client's reads go to the primary until the cookie expires
+(REPLICA_READ_YOUR_WRITES_SECONDS). Replicas lagging more than
+REPLICA_MAX_LAG_SECONDS behind, or that cannot be reached, are skipped;
+with no replica left the read falls back to the primary. Replica lag is
+measured at most every REPLICA_LAG_CHECK_SECONDS, so keep the maximum lag
+plus the check interval below the read-your-writes window.
+"""
+import functools
+import itertools
+import logging
+import math
+import threading
+import time
+
+from flask import current_app, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, orm, text
+from sqlalchemy.exc import SQLAlchemyError
+
+logger = logging.getLogger("flask.app")
+
+COOKIE = "inventory_wrote_at"
+# request.environ keys; not flask.g, which outlives requests under the app context init_db pushes
+READ_KEY = "inventory.replica_read"
+ENGINE_KEY = "inventory.replica_engine"
+MUTATING_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+# seconds the replica is behind; 0 when it has replayed everything it received
+LAG_QUERY = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+    "THEN 0 ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+
+class Replica:
+    """A replica engine and its last measured lag"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.lag = 0.0
+        self.checked_at = -math.inf
+        self._lock = threading.Lock()
+
+    def measure(self):
+        """Returns how many seconds the replica is behind, infinite when unreachable"""
+        try:
+            with self.engine.connect() as connection:
+                if connection.dialect.name != "postgresql":
+                    return 0.0
+                return float(connection.execute(LAG_QUERY).scalar() or 0)
+        except SQLAlchemyError as error:
+            logger.warning("Replica %s is unavailable: %s",
+                           self.engine.url.render_as_string(hide_password=True), error)
+            return math.inf
+
+    def current_lag(self, interval):
+        """Returns the lag, measuring it again when older than interval seconds
+
+        Only one thread measures at a time; the others use the last value.
+        """
+        if time.monotonic() - self.checked_at >= interval and self._lock.acquire(blocking=False):
+            try:
+                self.lag = self.measure()
+                self.checked_at = time.monotonic()
+            finally:
+                self._lock.release()
+        return self.lag
+
+
+class ReplicaRouter:
+    """Chooses the database each replica read goes to"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._uris = ()
+        self._replicas = []
+        self._turn = itertools.count()
+        self._counts = {"replica": 0, "primary": 0, "fallback": 0}
+
+    def replicas(self, config):
+        """Returns the replicas of the configuration, creating their engines"""
+        uris = tuple(config["DATABASE_REPLICA_URIS"])
+        with self._lock:
+            if uris != self._uris:
+                for replica in self._replicas:
+                    replica.engine.dispose()
+                options = config.get("SQLALCHEMY_ENGINE_OPTIONS") or {}
+                self._replicas = [Replica(create_engine(uri, **options)) for uri in uris]
+                self._uris = uris
+            return self._replicas
+
+    def dispose(self, close=True):
+        """Empties the connection pools of the replicas, e.g. in a forked child"""
+        with self._lock:
+            for replica in self._replicas:
+                replica.engine.dispose(close=close)
+
+    def choose(self, config, wrote_at=None):
+        """Returns the engine of a replica able to serve a read, or None for the primary
+
+        Args:
+            config (dict): the app configuration
+            wrote_at (float): when the client last wrote (time.time()), if known
+        """
+        replicas = self.replicas(config)
+        if not replicas:
+            return None
+        if wrote_at is not None and time.time() - wrote_at < config["REPLICA_READ_YOUR_WRITES_SECONDS"]:
+            self._count("primary")
+            return None
+        first = next(self._turn)
+        for offset in range(len(replicas)):
+            replica = replicas[(first + offset) % len(replicas)]
+            if replica.current_lag(config["REPLICA_LAG_CHECK_SECONDS"]) <= config["REPLICA_MAX_LAG_SECONDS"]:
+                self._count("replica")
+                return replica.engine
+        self._count("fallback")
+        return None
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def stats(self):
+        """Returns how many reads went to a replica, to the primary, or fell back to it"""
+        with self._lock:
+            return dict(self._counts, lag_seconds=[replica.lag for replica in self._replicas])
+
+
+router = ReplicaRouter()
+
+
+def wrote_at():
+    """Returns when the client of the current request last wrote, or None"""
+    try:
+        return float(request.cookies[COOKIE])
+    except (KeyError, ValueError):
+        return None
+
+
+def read_engine():
+    """Returns the replica engine serving the current request, or None for the primary
+
+    The choice is made once per request so all its queries see the same database.
+    """
+    if not has_request_context() or not request.environ.get(READ_KEY):
+        return None
+    if ENGINE_KEY not in request.environ:
+        request.environ[ENGINE_KEY] = router.choose(current_app.config, wrote_at())
+    return request.environ[ENGINE_KEY]
+
+
+def replica_read(function):
+    """Lets the queries of a read-only route run on a replica"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        request.environ[READ_KEY] = True
+        return function(*args, **kwargs)
+    return wrapper
+
+
+class RoutingSession(SignallingSession):  # pylint: disable=too-many-ancestors
+    """Session sending the queries of replica reads to the chosen replica"""
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing:
+            engine = read_engine()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy whose sessions route replica reads"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def init_replicas(app):
+    """Pins clients that write to the primary for the read-your-writes window"""
+    @app.after_request
+    def remember_writes(response):  # pylint: disable=unused-variable
+        # a read-only POST (like a lookup) does not pin the client; the shared
+        # stock table (service/stock_table.py) is not read until refreshed after the write,
+        # nor the result cache until its rows expire
+        if ((app.config["DATABASE_REPLICA_URIS"] or app.config.get("STOCK_TABLE") or app.config.get("RESULT_CACHE"))
+                and request.method in MUTATING_METHODS
+                and not request.environ.get(READ_KEY) and response.status_code < 400):
+            seconds = max(app.config["REPLICA_READ_YOUR_WRITES_SECONDS"],
+                          app.config.get("STOCK_TABLE_MAX_STALENESS_SECONDS", 0),
+                          app.config.get("RESULT_CACHE_TTL_SECONDS", 0) + app.config.get("RESULT_CACHE_STALE_SECONDS", 0))
+            response.set_cookie(COOKIE, f"{time.time():.3f}", httponly=True, samesite="Lax",
+                                max_age=math.ceil(seconds))
+        return response
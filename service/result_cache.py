@@ -0,0 +1,156 @@
+"""
+Result Cache
+
+Caches the rows of list queries by their normalized filters, so that the
+many clients repeating the same list request are answered from memory.
+
+Entries are invalidated by version counters rather than by searching the
+cache: every committed change bumps the version of its partition (the
+condition of the changed record, or every partition for changes that may
+touch any record), and an entry is only served while the versions of the
+partitions it was read from are unchanged. An entry filtered on one
+condition thus survives changes to records in the other conditions.
+
+Changes committed by this process bump the versions when they commit.
+Changes committed by other processes, bulk imports included, are seen
+through the stock notifications on PostgreSQL; otherwise they show up
+once the entry expires. Fresh entries are served for ttl seconds; for
+stale seconds after that the stale rows are still served while one
+background refresh replaces them. The cache holds at most max_rows rows,
+dropping the least recently used entries first.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger("flask.app")
+
+ALL = None
+
+
+class _Entry:  # pylint: disable=too-few-public-methods
+    """The rows of one query and the versions they were read at"""
+
+    __slots__ = ("rows", "stamp", "stored_at", "refreshing")
+
+    def __init__(self, rows, stamp, stored_at):
+        self.rows = rows
+        self.stamp = stamp
+        self.stored_at = stored_at
+        self.refreshing = False
+
+
+class ResultCache:  # pylint: disable=too-many-instance-attributes
+    """LRU cache of query rows invalidated by per-partition versions"""
+
+    def __init__(self, partitions=(), ttl=5.0, stale=30.0, max_rows=100000, clock=time.monotonic):
+        self.partitions = tuple(partitions)
+        self.ttl = ttl
+        self.stale = stale
+        self.max_rows = max_rows
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._rows = 0
+        self._global_version = 0
+        self._versions = dict.fromkeys(self.partitions, 0)
+        self._context = None
+        self.hits = self.stale_hits = self.misses = self.evictions = self.invalidations = 0
+
+    def init_app(self, context, teardown=None):
+        """Sets the context manager factory and teardown that background refreshes run with"""
+        self._context = (context, teardown)
+
+    def stamp(self, partitions=ALL):
+        """Returns the versions of partitions (every partition for ALL)"""
+        names = self.partitions if partitions is ALL else partitions
+        return (self._global_version,) + tuple(self._versions[name] for name in names)
+
+    def invalidate(self, partitions=ALL):
+        """Bumps the versions of partitions, making the entries read from them stale"""
+        with self._lock:
+            self.invalidations += 1
+            if partitions is ALL:
+                self._global_version += 1
+                return
+            for name in partitions:
+                self._versions[name] += 1
+
+    def get(self, key, load, partitions=ALL):
+        """Returns the rows of key, calling load() to read them when not cached
+
+        Args:
+            key (tuple): the normalized query
+            load (callable): reads the rows; must return a list of immutable rows
+            partitions (tuple): the partitions the rows are read from, ALL by default
+        """
+        now = self.clock()
+        with self._lock:
+            stamp = self.stamp(partitions)
+            entry = self._entries.get(key)
+            if entry is not None and entry.stamp == stamp:
+                age = now - entry.stored_at
+                if age < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry.rows
+                if age < self.ttl + self.stale and self._context is not None:
+                    self._entries.move_to_end(key)
+                    self.stale_hits += 1
+                    if not entry.refreshing:
+                        entry.refreshing = True
+                        threading.Thread(target=self._refresh, args=(key, load, partitions),
+                                         name="result-cache-refresh", daemon=True).start()
+                    return entry.rows
+            self.misses += 1
+        rows = load()
+        self._store(key, rows, stamp)
+        return rows
+
+    def _refresh(self, key, load, partitions):
+        context, teardown = self._context
+        try:
+            with context():
+                try:
+                    stamp = self.stamp(partitions)
+                    self._store(key, load(), stamp)
+                finally:
+                    if teardown is not None:
+                        teardown()
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Refreshing cached results failed: %s", error)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.refreshing = False
+
+    def _store(self, key, rows, stamp):
+        if not isinstance(rows, list) or len(rows) > self.max_rows:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._rows -= len(old.rows)
+            self._entries[key] = _Entry(rows, stamp, self.clock())
+            self._rows += len(rows)
+            while self._rows > self.max_rows:
+                _, evicted = self._entries.popitem(last=False)
+                self._rows -= len(evicted.rows)
+                self.evictions += 1
+
+    def clear(self):
+        """Drops every entry"""
+        with self._lock:
+            self._entries.clear()
+            self._rows = 0
+
+    def stats(self):
+        """Returns the hit rate and the counters of the cache"""
+        with self._lock:
+            served = self.hits + self.stale_hits
+            lookups = served + self.misses
+            return {"hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses,
+                    "hit_rate": round(served / lookups, 4) if lookups else 0.0,
+                    "evictions": self.evictions, "invalidations": self.invalidations,
+                    "entries": len(self._entries), "rows": self._rows}
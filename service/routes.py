@@ -1,17 +1,105 @@
 """
 Inventory
 """
+import codecs
 import logging
+import math
+import os
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlencode
 
-from flask import jsonify, request, abort
+from flask import Response, jsonify, request, abort
 from flask_restx import Resource, fields, reqparse, inputs
-from service.models import Inventory
+from werkzeug.exceptions import ServiceUnavailable
+from service.models import (Inventory, InventoryHistory, InventoryLocation, Location, cached_results,
+                            columnar_snapshot, read_flights, stock_table)
+from service import admission, filters, idempotency, profiling, rate_limit
+from service.batching import group_committer
+from service.bulk import export_csv, import_csv
+from service.idempotency import idempotent
+from service.notifications import broadcaster, format_sse
+from service.replicas import init_replicas, replica_read, router as replica_router, wrote_at
+from service.search import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from service.validation import api_fields
 from .common import status  # HTTP Status Codes
+from .common.assets import DIST, ENTRY_POINT
+from .common.compression import init_compression, send_precompressed
+from .common.representations import init_representations
 
 # Import Flask application
 from . import app, api
 
 app.url_map.strict_slashes = False
+# first, so a profiled request covers the other hooks
+profiling.init_profiling(app)
+init_compression(app)
+init_representations(api)
+init_replicas(app)
+
+
+def list_cost(req):
+    """Rate limit cost of a request to the inventory collection"""
+    if req.method not in ("GET", "HEAD"):
+        return 1
+    if req.method == "HEAD" and "count" in req.args:
+        return 1
+    # an unfiltered list reads the whole table
+    return 2 if set(req.args) - {"page", "per_page", "sort"} else 10
+
+
+def lookup_cost(req):
+    """Rate limit cost of a multi-get, about a token per 50 keys"""
+    data = req.get_json(silent=True)
+    keys = data.get("keys") if isinstance(data, dict) else None
+    return max(1, len(keys) // 50) if isinstance(keys, list) else 1
+
+
+rate_limit.trust_proxies(app)
+# tokens each request takes from its client's bucket; checked before admission so
+# clients over their limit never take a slot
+rate_limit.init_rate_limits(app, {
+    "inventory_collection": list_cost,
+    "inventory_resource": 1,
+    "inventory_product": 1,
+    "inventory_lookup": lookup_cost,
+    "inventory_checkout": 1,
+    "inventory_reorder": 1,
+    "inventory_location_collection": 1,
+    "inventory_location_resource": 1,
+    "inventory_history_resource": 2,
+    "inventory_stream": 5,
+    "inventory_import": 20,
+    "inventory_export": 20,
+    "location_collection": 1,
+    "location_resource": 1,
+})
+# routes not listed here (health, metrics, the profiler, docs, assets, the stock stream) are never queued
+admission.init_admission(app, {
+    "inventory_checkout": admission.CRITICAL,
+    "inventory_reorder": admission.CRITICAL,
+    "inventory_resource": admission.NORMAL,
+    "inventory_product": admission.NORMAL,
+    "inventory_lookup": admission.NORMAL,
+    "inventory_location_resource": admission.NORMAL,
+    "inventory_location_collection": admission.NORMAL,
+    "location_resource": admission.NORMAL,
+    "location_collection": admission.NORMAL,
+    "inventory_collection:POST": admission.NORMAL,
+    "inventory_collection": admission.LOW,
+    "inventory_history_resource": admission.LOW,
+    "inventory_import": admission.LOW,
+    "inventory_export": admission.LOW,
+})
+
+LOCATION_HEADER = "Inventory-Location"
+COUNT_HEADER = "X-Total-Count"
+COUNT_ESTIMATE_HEADER = "X-Total-Count-Estimate"
+HISTORY_LIMIT = 100
+MAX_HISTORY_LIMIT = 10000
+
+# content-hashed assets never change so they can be cached for a year
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
 
 
 @app.route("/health", methods=["GET"])
@@ -21,6 +109,43 @@ def health():
     return jsonify(status="OK"), status.HTTP_200_OK
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """ Per-process performance counters """
+    return jsonify(single_flight=read_flights.stats(), result_cache=cached_results.stats(),
+                   columnar=columnar_snapshot.stats(), stock_table=stock_table.stats(),
+                   replicas=replica_router.stats(), profiling=profiling.profiler.stats(),
+                   admission=admission.controller.stats(), streams=admission.streams.stats(),
+                   exports=admission.exports.stats()), status.HTTP_200_OK
+
+
+@app.route("/admin/profile", methods=["GET"])
+def profile():
+    """ Samples the stacks of this worker and returns them collapsed """
+    token = app.config["PROFILING_TOKEN"]
+    if not token:
+        abort(status.HTTP_404_NOT_FOUND, "Profiling is disabled.")
+    if not profiling.authorized(token):
+        abort(status.HTTP_401_UNAUTHORIZED, "A valid profiling token is required.")
+    max_seconds = app.config["PROFILING_MAX_SECONDS"]
+    seconds = request.args.get("seconds", min(10.0, max_seconds), type=float)
+    interval_ms = request.args.get("interval_ms", app.config["PROFILING_INTERVAL_MS"], type=float)
+    if seconds is None or not 0 < seconds <= max_seconds:
+        abort(status.HTTP_400_BAD_REQUEST, f"seconds must be above 0 and at most {max_seconds:g}.")
+    if interval_ms is None or not 1 <= interval_ms <= 1000:
+        abort(status.HTTP_400_BAD_REQUEST, "interval_ms must be between 1 and 1000.")
+    app.logger.info("Sampling the stacks of worker %d for %gs", os.getpid(), seconds)
+    sampled = profiling.profiler.sample(seconds, interval_ms / 1000)
+    if sampled is None:
+        abort(status.HTTP_409_CONFLICT, "Another profile is running in this worker.")
+    stacks, samples, overhead = sampled
+    return Response(profiling.collapsed(stacks), mimetype="text/plain", headers={
+        profiling.PID_HEADER: str(os.getpid()),
+        "X-Profile-Samples": str(samples),
+        "X-Profile-Overhead": f"{overhead:.4f}",
+    })
+
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -28,52 +153,96 @@ def health():
 def index():
     """ Root URL response """
     app.logger.info("Request for Root URL")
+    dist_folder = os.path.join(app.static_folder, DIST)
+    if os.path.isfile(os.path.join(dist_folder, ENTRY_POINT)):
+        return send_precompressed(dist_folder, ENTRY_POINT, max_age=0)
     return app.send_static_file("index.html")
 
 
+@app.route("/static/dist/<path:filename>")
+def static_asset(filename):
+    """ Serves precompressed, content-hashed static assets """
+    return send_precompressed(os.path.join(app.static_folder, DIST), filename,
+                              max_age=ASSET_MAX_AGE)
+
+
 # Define the model so that the docs reflect what can be sent
-create_model = api.model('Inventory', {
-    'name': fields.String(
-        required=True,
-        description='The name of the Inventory'
-    ),
-    'condition': fields.String(
-        required=True,
-        description='The condition type',
-        enum=Inventory.Condition._member_names_
-    ),
-    'quantity': fields.Integer(
-        required=True,
-        description='Quantity of inventory type'
-    ),
-    # 'reorder_quantity': fields.Integer(
-    #     description='The reorder quantity of the Inventory'
-    # ),
-    # 'restock_level': fields.Integer(
-    #     description='The restock_level of the Inventory'
-    # ),
-    'active': fields.Boolean(
-        required=True,
-        description='Active status inventory'
-    )
-})
+# Generated from the same Fields that validate request bodies
+create_model = api.model('Inventory', api_fields(
+    Inventory.FIELDS, ("name", "condition", "quantity", "active"), required=True
+))
 
 inventory_model = api.inherit(
     'InventoryModel',
     create_model,
-    {
-        'product_id': fields.Integer(
-            readOnly=True,
-            description='The unique id assigned internally by service'),
-    }
+    api_fields(Inventory.FIELDS, ("product_id",), readOnly=True)
 )
 
 
+location_model = api.model('Location', {
+    'code': fields.String(readOnly=True, description='The code of the Location'),
+    'name': fields.String(required=True, description='The name of the Location'),
+    'latitude': fields.Float(required=False, description='Latitude used to find the nearest Location'),
+    'longitude': fields.Float(required=False, description='Longitude used to find the nearest Location'),
+})
+
+location_stock_model = api.model('LocationStock', {
+    'location': fields.String(readOnly=True, description='The code of the Location'),
+    'quantity': fields.Integer(required=True, description='The quantity kept in the Location'),
+})
+
+history_model = api.model('InventoryHistory', {
+    'recorded_at': fields.String(description='When the state was recorded (UTC, ISO 8601)'),
+    'name': fields.String(description='The name of the Inventory'),
+    'quantity': fields.Integer(description='The quantity available'),
+    'active': fields.Boolean(description='Is the Inventory active?'),
+    'deleted': fields.Boolean(description='Was the Inventory deleted?'),
+})
+
+lookup_key_model = api.model('LookupKey', api_fields(
+    Inventory.FIELDS, ("product_id", "condition"), required=True
+))
+
+lookup_model = api.model('Lookup', {
+    'keys': fields.List(fields.Nested(lookup_key_model), required=True,
+                        description='The (product_id, condition) keys to fetch'),
+})
+
+lookup_result_model = api.model('LookupResult', {
+    'records': fields.List(fields.Nested(inventory_model), description='The records found, in key order'),
+    'missing': fields.List(fields.Nested(lookup_key_model), description='The keys not found'),
+})
+
+
 # query string arguments
 inventory_args = reqparse.RequestParser()
 inventory_args.add_argument(
     'status', type=inputs.boolean, required=False, help='List Inventory by status'
 )
+inventory_args.add_argument(
+    'as_of', type=str, required=False, help='List the inventory as it was at this ISO 8601 time'
+)
+inventory_args.add_argument(
+    'q', type=str, required=False, help='Search names by prefix, tolerating typos'
+)
+inventory_args.add_argument(
+    'filter', type=str, required=False,
+    help="Filter expression, e.g. condition in (new, return) and quantity in 10..50 or active = false"
+)
+inventory_args.add_argument(
+    'sort', type=str, required=False,
+    help=f"Columns to sort on, - for descending, e.g. -quantity,name ({', '.join(Inventory.SORTABLE)})"
+)
+inventory_args.add_argument(
+    'count', type=str, required=False, choices=('exact', 'estimate'),
+    help='Send the number of matching records in X-Total-Count, or an estimate in X-Total-Count-Estimate'
+)
+inventory_args.add_argument(
+    'page', type=int, required=False, help='Page of search results, starting at 1'
+)
+inventory_args.add_argument(
+    'per_page', type=int, required=False, help=f'Search results per page (max {MAX_PAGE_SIZE})'
+)
 
 
 ######################################################################
@@ -93,13 +262,20 @@ class InventoryResource(Resource):
     @api.doc('get_inventory')
     @api.response(404, 'Pet not found')
     @api.marshal_with(inventory_model)
+    @replica_read
     def get(self, product_id, condition):
         """
         Retrieve a single Inventory
         This endpoint will return a Inventory based on it's id and condition
         """
         app.logger.info("Finding the given record inside InventoryResource")
-        inventory = Inventory.find((product_id, condition))
+        inventory = None
+        if app.config["STOCK_TABLE"]:
+            inventory = Inventory.find_shared((product_id, condition), not_before=wrote_at())
+        if inventory is None and app.config["SINGLE_FLIGHT"]:
+            inventory = Inventory.find_coalesced((product_id, condition))
+        elif inventory is None:
+            inventory = Inventory.find((product_id, condition))
         if not inventory:
             abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
         app.logger.info("Returning product: %s", inventory.name)
@@ -113,6 +289,7 @@ class InventoryResource(Resource):
     @api.response(404, 'Inventory not found')
     @api.expect(inventory_model)
     @api.marshal_with(inventory_model)
+    @idempotent
     def put(self, product_id, condition):
         """Update the record of an existing product in the Inventory database"""
         app.logger.info("Update an inventory record inside InventoryResource")
@@ -133,6 +310,7 @@ class InventoryResource(Resource):
     # ------------------------------------------------------------------
     @api.doc('delete_inventory')
     @api.response(204, 'Inventory deleted')
+    @idempotent
     def delete(self, product_id, condition):
         """Delete a record on the basis of the specified
         product_id and condition"""
@@ -147,6 +325,260 @@ class InventoryResource(Resource):
         return "", status.HTTP_204_NO_CONTENT
 
 
+######################################################################
+#  PATH: /inventory/{product_id}
+######################################################################
+@api.route('/inventory/<int:product_id>')
+@api.param('product_id', 'The Inventory identifier')
+class InventoryProduct(Resource):
+    """Every condition of a product
+
+    GET /inventory/<product_id> - Returns the Inventories of the product in every condition
+    """
+    @api.doc('get_product')
+    @api.response(404, 'Product not found')
+    @api.marshal_list_with(inventory_model)
+    @replica_read
+    def get(self, product_id):
+        """
+        Retrieve a product in every condition
+        """
+        app.logger.info("Request for product %s in every condition", product_id)
+        records, _ = Inventory.find_many([(product_id, condition) for condition in Inventory.Condition])
+        if not records:
+            abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+        return [record.serialize() for record in records], status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /inventory/lookup
+######################################################################
+@api.route('/inventory/lookup')
+class InventoryLookup(Resource):
+    """Multi-get of many records
+
+    POST /inventory/lookup - Returns the Inventories of a list of keys
+    """
+    @api.doc('lookup_inventory')
+    @api.response(400, 'The keys were missing or not valid')
+    @api.expect(lookup_model)
+    @api.marshal_with(lookup_result_model)
+    @replica_read
+    def post(self):
+        """
+        Retrieve many Inventories by key
+        The records found are returned in the order of the keys, and the keys
+        that were not found are listed as missing
+        """
+        check_content_type("application/json")
+        keys = parse_lookup_keys(request.get_json())
+        app.logger.info("Looking up %d keys", len(keys))
+        records, missing = Inventory.find_many(keys, app.config["LOOKUP_CHUNK_SIZE"])
+        return {
+            "records": [record.serialize() for record in records],
+            "missing": [{"product_id": product_id, "condition": condition.value}
+                        for product_id, condition in missing],
+        }, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /locations
+######################################################################
+@api.route('/locations')
+class LocationCollection(Resource):
+    """Warehouses and other places stock is kept"""
+    @api.doc('list_locations')
+    @api.marshal_list_with(location_model)
+    @replica_read
+    def get(self):
+        """Returns all the Locations"""
+        return [location.serialize() for location in Location.all()], status.HTTP_200_OK
+
+
+@api.route('/locations/<code>')
+@api.param('code', 'The Location code')
+class LocationResource(Resource):
+    """A single Location"""
+    @api.doc('get_location')
+    @api.response(404, 'Location not found')
+    @api.marshal_with(location_model)
+    @replica_read
+    def get(self, code):
+        """Returns a single Location"""
+        location = Location.find(code)
+        if not location:
+            abort(status.HTTP_404_NOT_FOUND, f"Location '{code}' was not found.")
+        return location.serialize(), status.HTTP_200_OK
+
+    @api.doc('put_location')
+    @api.response(400, 'The posted Location data was not valid')
+    @api.expect(location_model)
+    @api.marshal_with(location_model)
+    def put(self, code):
+        """Creates or updates a Location"""
+        app.logger.info("Request to save location %s", code)
+        check_content_type("application/json")
+        location = Location(code=code).deserialize(request.get_json())
+        location.save()
+        return location.serialize(), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /inventory/{product_id}/{condition}/locations
+######################################################################
+@api.route('/inventory/<product_id>/<condition>/locations')
+@api.param('product_id', 'The Inventory identifier')
+class InventoryLocationCollection(Resource):
+    """Stock of an Inventory per Location"""
+    @api.doc('list_inventory_locations')
+    @api.response(404, 'Inventory not found')
+    @api.marshal_list_with(location_stock_model)
+    @replica_read
+    def get(self, product_id, condition):
+        """Returns the quantity of an Inventory in each of its Locations"""
+        record = Inventory.find((product_id, condition))
+        if not record:
+            abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+        rows = InventoryLocation.of(record).order_by(InventoryLocation.location)
+        return [row.serialize() for row in rows], status.HTTP_200_OK
+
+
+@api.route('/inventory/<product_id>/<condition>/locations/<location>')
+@api.param('product_id', 'The Inventory identifier')
+@api.param('location', 'The Location code')
+class InventoryLocationResource(Resource):
+    """Stock of an Inventory in one Location"""
+    @api.doc('put_inventory_location')
+    @api.response(400, 'The quantity or the Location was not valid')
+    @api.response(404, 'Inventory not found')
+    @api.expect(location_stock_model)
+    @api.marshal_with(inventory_model)
+    @idempotent
+    def put(self, product_id, condition, location):
+        """
+        Sets the quantity of an Inventory in a Location
+        The quantity of the Inventory becomes the total over its Locations.
+        """
+        app.logger.info("Request to stock %s/%s in %s", product_id, condition, location)
+        check_content_type("application/json")
+        record = Inventory.find((product_id, condition))
+        if not record:
+            abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+        record.set_location_stock(location, (request.get_json() or {}).get("quantity"))
+        return record.serialize(), status.HTTP_200_OK
+
+    @api.doc('delete_inventory_location')
+    @api.response(204, 'Location stock deleted')
+    @idempotent
+    def delete(self, product_id, condition, location):
+        """Removes an Inventory and its stock from a Location"""
+        app.logger.info("Request to remove %s/%s from %s", product_id, condition, location)
+        record = Inventory.find((product_id, condition))
+        if record:
+            record.remove_location(location)
+        return "", status.HTTP_204_NO_CONTENT
+
+
+######################################################################
+#  PATH: /inventory/{product_id}/{condition}/history
+######################################################################
+@api.route('/inventory/<product_id>/<condition>/history')
+@api.param('product_id', 'The Inventory identifier')
+class InventoryHistoryResource(Resource):
+    """Stock history of a single Inventory"""
+    @api.doc('get_inventory_history')
+    @api.param('since', 'Only states recorded at or after this ISO 8601 time')
+    @api.param('until', 'Only states recorded before this ISO 8601 time')
+    @api.param('limit', f'The maximum number of states (default {HISTORY_LIMIT})')
+    @api.response(400, 'A parameter was not valid')
+    @api.response(404, 'The product id or condition was not valid')
+    @api.marshal_list_with(history_model)
+    @replica_read
+    def get(self, product_id, condition):
+        """
+        Returns the recorded states of an Inventory, oldest first
+        Every create, update, checkout, reorder, import and delete records one state.
+        """
+        app.logger.info("Request for the history of %s/%s", product_id, condition)
+        try:
+            product_id = int(product_id)
+        except ValueError:
+            abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+        try:
+            condition = Inventory.Condition.parse(condition)
+        except ValueError:
+            abort(status.HTTP_404_NOT_FOUND, f"Condition '{condition}' does not exist.")
+        since, until = (parse_timestamp(request.args[name], name) if request.args.get(name) else None
+                        for name in ("since", "until"))
+        limit = request.args.get("limit", HISTORY_LIMIT)
+        if not str(limit).isdigit() or not 1 <= int(limit) <= MAX_HISTORY_LIMIT:
+            abort(status.HTTP_400_BAD_REQUEST, f"limit must be between 1 and {MAX_HISTORY_LIMIT}.")
+        entries = InventoryHistory.find_range(product_id, condition.name, since, until, int(limit))
+        return [entry.serialize() for entry in entries], status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /inventory/stream
+######################################################################
+@api.route('/inventory/stream')
+@api.param('keys', 'Comma separated <product_id>:<condition> pairs to watch')
+class InventoryStream(Resource):
+    """Server-Sent Events stream of quantity changes
+
+    GET /inventory/stream?keys=1:new,2:return - Streams stock updates for the keys
+    """
+    @api.doc('stream_inventory')
+    @api.response(400, 'The keys parameter was missing or not valid')
+    @api.response(503, 'The worker has as many open streams as it may')
+    def get(self):
+        """
+        Subscribe to quantity changes
+        The current stock of each key is sent first, followed by an event
+        for every committed change until the stream expires
+        """
+        keys = parse_stock_keys(request.args.get("keys", ""))
+        retry_ms = app.config["STREAM_RETRY_MS"]
+        if not admission.streams.acquire(app.config["STREAM_MAX_PER_WORKER"]):
+            app.logger.warning("Refusing a stock stream: %s", admission.streams.stats())
+            raise ServiceUnavailable("Too many open streams, please retry later.",
+                                     retry_after=math.ceil(retry_ms / 1000))
+        try:
+            app.logger.info("Opening stock stream for %d keys", len(keys))
+            subscription = broadcaster.subscribe(keys)
+            snapshot = []
+            for product_id, condition in keys:
+                record = Inventory.find((product_id, Inventory.Condition(condition).name))
+                if record:
+                    snapshot.append(record.stock_event())
+        except Exception:
+            admission.streams.release()
+            raise
+
+        heartbeat = app.config["STREAM_HEARTBEAT_SECONDS"]
+        deadline = time.monotonic() + app.config["STREAM_MAX_SECONDS"]
+
+        def generate():
+            event_id = 0
+            yield f"retry: {retry_ms}\n\n"
+            events = snapshot
+            while True:
+                for stock_event in events:
+                    event_id += 1
+                    yield format_sse(stock_event, event_id)
+                if subscription.closed or time.monotonic() >= deadline:
+                    return
+                events = subscription.wait(heartbeat)
+                if not events:
+                    yield ": keep-alive\n\n"
+
+        response = Response(generate(), mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"
+        response.call_on_close(subscription.close)
+        response.call_on_close(admission.streams.release)
+        return response
+
+
 ######################################################################
 #  PATH: /inventory
 ######################################################################
@@ -159,47 +591,53 @@ class InventoryCollection(Resource):
     @api.doc('list_inventory')
     @api.expect(inventory_args, validate=True)
     @api.marshal_list_with(inventory_model)
+    @replica_read
     def get(self):
         """returns all the products in the inventory"""
-        records = []
-        feature_flag = False
-        req = {}
-
-        product_id = request.args.get("product_id")
-        name = request.args.get("name")
-        condition = request.args.get("condition")
-        quantity = request.args.get("quantity")
-        operator = request.args.get("operator")
-
-        active = request.args.get("active")
-        if active is not None:
-            if active == 'True':
-                active = True
-            else:
-                active = False
-        if product_id:
-            app.logger.info("Filtering by product_id: %s", product_id)
-            feature_flag = True
-            req["product_id"] = product_id
-        if name:
-            app.logger.info("Filtering by name: %s", name)
-            feature_flag = True
-            req["name"] = name
-        if condition:
-            app.logger.info("Filtering by condition:%s", condition)
-            condition = Inventory.Condition(condition)
-            feature_flag = True
-            req["condition"] = condition
-        if quantity:
-            app.logger.info("Filtering by quantity: %s", quantity)
-            feature_flag = True
-            req["quantity"] = (quantity, operator)
-        if active is not None:
-            app.logger.info("Filtering by available: %s", active)
-            feature_flag = True
-            req["active"] = active
-
-        if feature_flag:
+        records = None
+        req = filters_from_args(request.args)
+        feature_flag = bool(req)
+
+        query = request.args.get("q")
+        as_of = request.args.get("as_of")
+        if as_of and query:
+            abort(status.HTTP_400_BAD_REQUEST, "as_of cannot be combined with q.")
+        if query and "sort" in req:
+            abort(status.HTTP_400_BAD_REQUEST, "sort cannot be combined with q.")
+        count = request.args.get("count")
+        if count not in (None, "exact", "estimate"):
+            abort(status.HTTP_400_BAD_REQUEST, "count must be exact or estimate.")
+        if count and (as_of or query):
+            abort(status.HTTP_400_BAD_REQUEST, "count cannot be combined with as_of or q.")
+        if as_of:
+            records = Inventory.find_as_of(parse_timestamp(as_of, "as_of"), req)
+            if records == "Invalid":
+                abort(status.HTTP_400_BAD_REQUEST)
+            return [record.serialize() for record in records], status.HTTP_200_OK
+        if query:
+            return search_records(query, req)
+        headers = {}
+        if count:
+            counted = Inventory.count(req, count == "estimate", app.config["COUNT_ESTIMATE_MIN"])
+            if counted == "Invalid":
+                abort(status.HTTP_400_BAD_REQUEST)
+            rows, estimated = counted
+            headers[COUNT_ESTIMATE_HEADER if estimated else COUNT_HEADER] = str(rows)
+            if request.method == "HEAD":
+                # the count without the records
+                return [], status.HTTP_200_OK, headers
+        if app.config["COLUMNAR_SNAPSHOT"]:
+            records = Inventory.find_in_snapshot(req)
+        if records is not None:
+            app.logger.info("Request list of inventory records from the columnar snapshot")
+        elif app.config["SINGLE_FLIGHT"] or app.config["RESULT_CACHE"]:
+            app.logger.info("Request list of inventory records")
+            # a client that just wrote, maybe through another worker, reads past the cache
+            cached = app.config["RESULT_CACHE"] and wrote_at() is None
+            records = Inventory.find_by_general_filter_coalesced(req, cached=cached)
+            if records == "Invalid":
+                abort(status.HTTP_400_BAD_REQUEST)
+        elif feature_flag:
             records = Inventory.find_by_general_filter(req)
             if records == "Invalid":
                 abort(status.HTTP_400_BAD_REQUEST)
@@ -208,7 +646,7 @@ class InventoryCollection(Resource):
             records = Inventory.all()
         results = [record.serialize() for record in records]
         app.logger.info("Returning %d inventory records", len(results))
-        return results, status.HTTP_200_OK
+        return results, status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # ADD A NEW PRODUCT TO THE INVENTORY
@@ -217,6 +655,7 @@ class InventoryCollection(Resource):
     @api.response(400, 'The posted data was not valid')
     @api.expect(inventory_model)
     @api.marshal_with(inventory_model, code=201)
+    @idempotent
     def post(self):
         """
         Creates an inventory
@@ -248,6 +687,64 @@ class InventoryCollection(Resource):
         # return jsonify(inventory.serialize()), status.HTTP_201_CREATED, {"Location": location_url}
 
 
+######################################################################
+#  PATH: /inventory/import
+######################################################################
+@api.route('/inventory/import')
+class InventoryImport(Resource):
+    """Bulk import of inventory records from CSV"""
+    @api.doc('import_inventory')
+    @api.param('on_conflict', 'What to do with records that already exist: error, skip or update')
+    @api.response(400, 'The CSV header or on_conflict was not valid')
+    @api.response(409, 'Some records already exist')
+    @api.response(415, 'The body was not text/csv')
+    def post(self):
+        """
+        Imports records from a streamed CSV upload
+        The CSV needs a product_id,name,condition[,quantity,active] header row.
+        Invalid rows are rejected and reported without stopping the import.
+        """
+        app.logger.info("Request to import records from CSV")
+        check_content_type("text/csv")
+        report = import_csv(codecs.iterdecode(request.stream, "utf-8"),
+                            request.args.get("on_conflict", "error"),
+                            app.config["IMPORT_BATCH_SIZE"])
+        return report, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /inventory/export.csv
+######################################################################
+@api.route('/inventory/export.csv')
+class InventoryExport(Resource):
+    """Bulk export of inventory records as CSV"""
+    @api.doc('export_inventory')
+    @api.expect(inventory_args, validate=True)
+    @api.produces(['text/csv'])
+    @api.response(400, 'The quantity operator was not valid')
+    @api.response(503, 'The worker is sending as many exports as it may')
+    @replica_read
+    def get(self):
+        """
+        Streams the records as CSV
+        Takes the same filters as listing the inventory.
+        """
+        app.logger.info("Request to export records as CSV")
+        if not admission.exports.acquire(app.config["EXPORT_MAX_PER_WORKER"]):
+            app.logger.warning("Refusing an export: %s", admission.exports.stats())
+            raise ServiceUnavailable("Too many exports in progress, please retry later.",
+                                     retry_after=math.ceil(app.config["ADMISSION_RETRY_AFTER_SECONDS"]))
+        try:
+            chunks = export_csv(filters_from_args(request.args), app.config["EXPORT_CHUNK_SIZE"])
+        except Exception:
+            admission.exports.release()
+            raise
+        response = Response(chunks, mimetype="text/csv")
+        response.headers["Content-Disposition"] = "attachment; filename=inventory.csv"
+        response.call_on_close(admission.exports.release)
+        return response
+
+
 @api.route('/inventory/checkout/<product_id>/<condition>')
 class InventoryCheckout(Resource):
     # ------------------------------------------------------------------
@@ -258,15 +755,19 @@ class InventoryCheckout(Resource):
     @api.response(404, 'Inventory not found')
     @api.expect(inventory_model)
     @api.marshal_with(inventory_model)
+    @idempotent
     def put(self, product_id, condition):
         """Reduces quantity from inventory of a particular item based on the amount specified by user"""
         data = request.get_json()
+        # a keyed request commits with its stored response, apart from the batch
+        if app.config["CHECKOUT_BATCHING"] and not idempotency.holding():
+            return batched("checkout", product_id, condition, data)
         existing_record = Inventory.find((product_id, condition))
         if not existing_record:
             abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
         else:
             existing_record.checkout(data)
-            return existing_record.serialize(), status.HTTP_200_OK
+            return stock_response(existing_record.serialize(), existing_record.allocated_from)
 
 
 @api.route('/inventory/reorder/<product_id>/<condition>')
@@ -279,12 +780,16 @@ class InventoryReorder(Resource):
     @api.response(404, 'Inventory not found')
     @api.expect(inventory_model)
     @api.marshal_with(inventory_model)
+    @idempotent
     def put(self, product_id, condition):
         """Increases quantity from inventory of a particular item
         based on the amount specified by user"""
         app.logger.info(f"Reorder called for product id: {product_id}, condition: {condition}")
 
         data = request.get_json()
+        # a keyed request commits with its stored response, apart from the batch
+        if app.config["CHECKOUT_BATCHING"] and not idempotency.holding():
+            return batched("reorder", product_id, condition, data)
         existing_record = Inventory.find((product_id, condition))
         if not existing_record:
             abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
@@ -302,6 +807,129 @@ def init_db():
     Inventory.init_db(app)
 
 
+def batched(operation, product_id, condition, data):
+    """Applies a checkout or reorder through the group committer"""
+    result = group_committer.submit(operation, product_id, condition, data)
+    if result is None:
+        abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+    return stock_response(*result)
+
+
+def stock_response(record, allocated_from):
+    """Returns a checkout or reorder result, naming the location a checkout shipped from"""
+    headers = {LOCATION_HEADER: allocated_from} if allocated_from else {}
+    return record, status.HTTP_200_OK, headers
+
+
+def parse_stock_keys(raw_keys):
+    """Parses 'product_id:condition' pairs into a set of (int, condition value)"""
+    keys = set()
+    for item in filter(None, raw_keys.split(",")):
+        product_id, _, condition = item.strip().partition(":")
+        try:
+            condition = Inventory.Condition.parse(condition)
+            keys.add((int(product_id), condition.value))
+        except ValueError:
+            abort(status.HTTP_400_BAD_REQUEST, f"Invalid stream key '{item}'")
+    if not keys:
+        abort(status.HTTP_400_BAD_REQUEST, "At least one stream key is required")
+    if len(keys) > app.config["STREAM_MAX_KEYS"]:
+        abort(status.HTTP_400_BAD_REQUEST,
+              f"At most {app.config['STREAM_MAX_KEYS']} stream keys are allowed")
+    return keys
+
+
+def parse_lookup_keys(data):
+    """Parses the keys of a lookup body into (product_id, Condition) tuples"""
+    keys = data.get("keys") if isinstance(data, dict) else None
+    if not isinstance(keys, list) or not keys:
+        abort(status.HTTP_400_BAD_REQUEST, "A non-empty list of keys is required")
+    if len(keys) > app.config["LOOKUP_MAX_KEYS"]:
+        abort(status.HTTP_400_BAD_REQUEST,
+              f"At most {app.config['LOOKUP_MAX_KEYS']} keys are allowed")
+    parsed = []
+    for key in keys:
+        values, issues = Inventory.validator.validate(key) if isinstance(key, dict) else ({}, [])
+        if issues or "condition" not in values:
+            abort(status.HTTP_400_BAD_REQUEST, f"Invalid lookup key {key}")
+        parsed.append((values["product_id"], values["condition"]))
+    return parsed
+
+
+def filters_from_args(args):
+    """Returns the find_by_general_filter filters given as query arguments"""
+    req = {}
+    product_id = args.get("product_id")
+    name = args.get("name")
+    condition = args.get("condition")
+    quantity = args.get("quantity")
+    operator = args.get("operator")
+
+    active = args.get("active")
+    if active is not None:
+        if active == 'True':
+            active = True
+        else:
+            active = False
+    if product_id:
+        app.logger.info("Filtering by product_id: %s", product_id)
+        req["product_id"] = product_id
+    if name:
+        app.logger.info("Filtering by name: %s", name)
+        req["name"] = name
+    if condition:
+        app.logger.info("Filtering by condition:%s", condition)
+        condition = Inventory.Condition(condition)
+        req["condition"] = condition
+    if quantity:
+        app.logger.info("Filtering by quantity: %s", quantity)
+        req["quantity"] = (quantity, operator)
+    if active is not None:
+        app.logger.info("Filtering by available: %s", active)
+        req["active"] = active
+    try:
+        if args.get("filter"):
+            app.logger.info("Filtering by expression: %s", args["filter"])
+            req["filter"] = filters.parse(args["filter"], Inventory.FIELDS)
+        if args.get("sort"):
+            req["sort"] = filters.parse_sort(args["sort"], Inventory.SORTABLE)
+    except filters.FilterError as error:
+        abort(status.HTTP_400_BAD_REQUEST, str(error))
+    return req
+
+
+def search_records(query, req):
+    """Returns one page of Inventory.search results and a Link to the next"""
+    try:
+        page = int(request.args.get("page", 1))
+        per_page = int(request.args.get("per_page", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "page and per_page must be integers.")
+    if page < 1 or not 1 <= per_page <= MAX_PAGE_SIZE:
+        abort(status.HTTP_400_BAD_REQUEST,
+              f"page must be at least 1 and per_page between 1 and {MAX_PAGE_SIZE}.")
+    app.logger.info("Searching names for %s (page %d)", query, page)
+    records = Inventory.search(query, req, per_page, (page - 1) * per_page)
+    if records == "Invalid":
+        abort(status.HTTP_400_BAD_REQUEST)
+    headers = {}
+    if len(records) == per_page:
+        args = dict(request.args.items(), page=page + 1)
+        headers["Link"] = f'<{request.base_url}?{urlencode(args)}>; rel="next"'
+    return [record.serialize() for record in records], status.HTTP_200_OK, headers
+
+
+def parse_timestamp(value, name):
+    """Parses an ISO 8601 query argument into a naive UTC datetime"""
+    try:
+        timestamp = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, f"{name} must be an ISO 8601 timestamp.")
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
 def check_content_type(content_type):
     """Checks that the media type is correct"""
     if "Content-Type" not in request.headers:
@@ -0,0 +1,122 @@
+"""
+Name Search
+
+Helpers behind Inventory.search, which matches names by prefix and by
+trigram similarity so that typos still find the record.
+
+PostgreSQL answers both with the pg_trgm extension and a GIN index on
+inventory.name. SQLite keeps an FTS5 trigram index of the names in the
+inventory_name_fts table, maintained by triggers; it narrows the rows down
+to a few candidates which are then ranked here with the same similarity
+measure pg_trgm uses, so both databases order results alike.
+"""
+import re
+
+from sqlalchemy import text
+
+MIN_SIMILARITY = 0.3  # pg_trgm.similarity_threshold default
+MAX_CANDIDATES = 1000
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+FTS_TABLE = "inventory_name_fts"
+
+POSTGRESQL_DDL = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_inventory_name_trgm ON inventory USING gin (name gin_trgm_ops)",
+)
+
+SQLITE_DDL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    "name, content='inventory', content_rowid='rowid', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS inventory_name_fts_insert AFTER INSERT ON inventory BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, name) VALUES (new.rowid, new.name); END",
+    "CREATE TRIGGER IF NOT EXISTS inventory_name_fts_delete AFTER DELETE ON inventory BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name) VALUES ('delete', old.rowid, old.name); END",
+    "CREATE TRIGGER IF NOT EXISTS inventory_name_fts_update AFTER UPDATE OF name ON inventory BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name) VALUES ('delete', old.rowid, old.name); "
+    f"INSERT INTO {FTS_TABLE}(rowid, name) VALUES (new.rowid, new.name); END",
+)
+SQLITE_OBJECTS = (FTS_TABLE, "inventory_name_fts_insert", "inventory_name_fts_delete", "inventory_name_fts_update")
+# catches up with rows written while the triggers did not exist
+SQLITE_REBUILD = f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"
+
+_WORD = re.compile(r"[^\W_]+")
+
+
+def init_search(engine):
+    """Creates the name search index for the database behind engine"""
+    statements = {"postgresql": POSTGRESQL_DDL, "sqlite": SQLITE_DDL}.get(engine.dialect.name, ())
+    with engine.begin() as connection:
+        stale = engine.dialect.name == "sqlite" and _fts_stale(connection)
+        for statement in statements:
+            connection.execute(text(statement))
+        if stale:
+            connection.execute(text(SQLITE_REBUILD))
+
+
+def _fts_stale(connection):
+    """Tells whether the FTS index must be rebuilt to match the inventory
+
+    It must when the index or one of its triggers is missing, or when it does
+    not hold a row per record; the docsize shadow table has one per indexed
+    row, so counting both tables is cheap next to a rebuild.
+    """
+    names = ", ".join(f"'{name}'" for name in SQLITE_OBJECTS)
+    found = connection.execute(text(f"SELECT count(*) FROM sqlite_master WHERE name IN ({names})")).scalar()
+    if found < len(SQLITE_OBJECTS):
+        return True
+    indexed = connection.execute(text(f"SELECT count(*) FROM {FTS_TABLE}_docsize")).scalar()
+    return indexed != connection.execute(text("SELECT count(*) FROM inventory")).scalar()
+
+
+def trigrams(value):
+    """Returns the set of trigrams of a string the way pg_trgm extracts them
+
+    Every word is lower-cased and padded with two spaces in front and one
+    behind, so 'Cat' gives {'  c', ' ca', 'cat', 'at '}.
+    """
+    grams = set()
+    for word in _WORD.findall(value.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def similarity(first, second):
+    """Returns how many trigrams two strings share, from 0 to 1"""
+    first, second = trigrams(first), trigrams(second)
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+def like_prefix(value):
+    """Returns a LIKE pattern matching strings that start with value (escape '\\')"""
+    return re.sub(r"([\\%_])", r"\\\1", value) + "%"
+
+
+def fts_query(value):
+    """Returns an FTS5 query matching names that share a trigram with value
+
+    The trigram tokenizer indexes every 3 characters of the raw name, so the
+    query ORs those of the search text. Returns None for texts shorter than
+    three characters, which the trigram index cannot look up.
+    """
+    value = value.lower()
+    grams = sorted({value[i:i + 3] for i in range(len(value) - 2)})
+    if not grams:
+        return None
+    return " OR ".join('"' + gram.replace('"', '""') + '"' for gram in grams)
+
+
+def rank(value, name):
+    """Returns the sort key of a name for a search, or None when it does not match
+
+    Names starting with the search text come first, then the most similar.
+    """
+    score = similarity(value, name)
+    if name.lower().startswith(value.lower()):
+        return (0, -score)
+    if score >= MIN_SIMILARITY:
+        return (1, -score)
+    return None
@@ -0,0 +1,283 @@
+"""
+Shared Stock Table
+
+An opt-in table of the stock of every record in a memory-mapped file that
+the worker processes of a host share, so GET
+/inventory/<product_id>/<condition> is answered from memory without every
+worker keeping a cache of its own.
+
+The file holds a header and two regions of fixed-width slots of
+(product_id, quantity, updated_at, condition, active, name) found by open
+addressing on the key: 91 bytes a slot, 11.9 MB for two regions of 65536
+slots. One worker, the one holding an fcntl lock on the file, is the
+writer. Every interval it rewrites the region readers are not using with
+the rows updated since that region was last written (deletions are caught
+by counting the rows, as in service/columnar.py) and publishes it by
+bumping the generation in the header. Readers unpack their slot straight
+from the mapping and read the generation again afterwards, so a region
+being rewritten is never read. When the writer exits, another worker takes
+the lock over.
+
+A record is read from the table only if the table was published less than
+max_staleness seconds ago and after the client's last write (the
+read-your-writes cookie of service/replicas.py). Keys not in the table,
+names longer than a slot holds and regions that changed during the read
+are left to the database.
+"""
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from datetime import timezone
+
+from service.columnar import OVERLAP
+
+logger = logging.getLogger("flask.app")
+
+SHM_PATH = os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+                        "inventory-stock")
+MAGIC = b"INVSTK1\0"
+# magic, slots, generation (the readers use region generation % 2), published_at (time.time())
+HEADER = struct.Struct("=8sQQd")
+GENERATION = struct.Struct("=Q")
+GENERATION_OFFSET = 16
+PUBLISHED_AT = struct.Struct("=d")
+PUBLISHED_AT_OFFSET = 24
+# product_id, quantity, updated_at (UNIX time), condition (index + 1, 0 when free), active, name length, name
+SLOT = struct.Struct("=qqdB?B64s")
+NAME_SIZE = 64
+# a name too long for its slot
+LONG_NAME = 255
+PROBES = 16
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+class _Region:  # pylint: disable=too-few-public-methods
+    """What the writer knows about one region"""
+
+    def __init__(self):
+        self.watermark = None
+        self.stored = 0
+        # keys whose probed slots were all taken
+        self.unstorable = set()
+
+
+class SharedStockTable:  # pylint: disable=too-many-instance-attributes
+    """Stock of every record in a memory-mapped file read by every worker
+
+    Args:
+        conditions (list): the conditions of the records
+        path (str): the file shared by the workers
+        slots (int): the slots of each region, well above the number of records
+        interval (float): seconds between refreshes by the writer
+        max_staleness (float): seconds after which an unrefreshed table is not read
+        clock (callable): returns the current UNIX time
+    """
+
+    def __init__(self, conditions, path=SHM_PATH, slots=65536, interval=1.0, max_staleness=5.0,
+                 clock=time.time):
+        self.conditions = list(conditions)
+        self.path = path
+        self.slots = slots
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self.clock = clock
+        self._codes = {condition: code for code, condition in enumerate(self.conditions, 1)}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+        self._regions = None
+        self._load = None
+        self._context = None
+        self.hits = self.misses = self.stale = 0
+
+    @property
+    def size(self):
+        """The bytes of the header and both regions"""
+        return HEADER.size + 2 * self.slots * SLOT.size
+
+    def init_app(self, load, context=None, teardown=None):
+        """Sets how the writer reads rows and the context it refreshes in
+
+        Args:
+            load (callable): load(since) returns the number of rows in the
+                table and the (product_id, name, condition, quantity, active,
+                updated_at) rows updated at or after since, all of them for None
+            context (callable): returns the context manager a refresh runs
+                in; without one no writer is started
+            teardown (callable): called after each refresh
+        """
+        self._load = load
+        self._context = None if context is None else (context, teardown)
+
+    def _open(self):
+        """Maps the file once per process, a forked child mapping it again"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(fd).st_size < self.size:
+                # grown, never shrunk, under the processes mapping it
+                os.ftruncate(fd, self.size)
+            self._fd, self._map, self._regions = fd, mmap.mmap(fd, self.size), None
+            self._pid = os.getpid()
+            if self._context is not None:
+                threading.Thread(target=self._run, args=(self._map,), name="stock-table-writer",
+                                 daemon=True).start()
+
+    def close(self):
+        """Unmaps the file, giving up the writer's lock"""
+        with self._lock, self._write_lock:
+            if self._map is not None:
+                self._map.close()
+                os.close(self._fd)
+            self._pid = self._fd = self._map = self._regions = None
+
+    def _run(self, mapping):
+        while True:
+            time.sleep(self.interval)
+            if self._map is not mapping:
+                return
+            try:
+                if self.elect():
+                    self._refresh_in_context()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.warning("Refreshing the stock table failed: %s", error)
+
+    def _refresh_in_context(self):
+        context, teardown = self._context
+        with context():
+            try:
+                self.refresh()
+            finally:
+                if teardown is not None:
+                    teardown()
+
+    def elect(self):
+        """Returns whether this process is the writer, becoming it if no process is"""
+        self._open()
+        if self._regions is not None:
+            return True
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        # what the previous writer left is unknown
+        self._regions = [_Region(), _Region()]
+        logger.info("Process %d writes the shared stock table", os.getpid())
+        return True
+
+    def refresh(self):
+        """Rewrites the region the readers are not using and publishes it; writer only"""
+        with self._write_lock:
+            magic, slots, generation, _ = HEADER.unpack_from(self._map, 0)
+            if magic != MAGIC or slots != self.slots:
+                generation = 0
+                self._regions = [_Region(), _Region()]
+                HEADER.pack_into(self._map, 0, MAGIC, self.slots, generation, 0.0)
+            target = (generation + 1) % 2
+            region = self._regions[target]
+            started = self.clock()
+            full = region.watermark is None
+            if not full:
+                total, rows = self._load(region.watermark - OVERLAP)
+                self._write(target, region, rows)
+                # rows were deleted since the region was written
+                full = region.stored + len(region.unstorable) != total
+            if full:
+                total, rows = self._load(None)
+                self._clear(target)
+                self._regions[target] = region = _Region()
+                self._write(target, region, rows)
+            # the generation first: a reader may see the new region with the old time, never the reverse
+            GENERATION.pack_into(self._map, GENERATION_OFFSET, generation + 1)
+            PUBLISHED_AT.pack_into(self._map, PUBLISHED_AT_OFFSET, started)
+
+    def _base(self, region):
+        return HEADER.size + region * self.slots * SLOT.size
+
+    def _clear(self, region):
+        base = self._base(region)
+        self._map[base:base + self.slots * SLOT.size] = bytes(self.slots * SLOT.size)
+
+    def _probe(self, base, product_id, code):
+        """Returns the offset of the slot of a key and whether it holds the key, None when full"""
+        start = ((product_id * len(self._codes) + code) * HASH_MULTIPLIER) % (1 << 64)
+        for probe in range(PROBES):
+            offset = base + ((start + probe) % self.slots) * SLOT.size
+            slot_product_id, _, _, slot_code = SLOT.unpack_from(self._map, offset)[:4]
+            if slot_code == 0:
+                return offset, False
+            if slot_product_id == product_id and slot_code == code:
+                return offset, True
+        return None, False
+
+    def _write(self, target, region, rows):
+        base = self._base(target)
+        for product_id, name, condition, quantity, active, updated_at in rows:
+            code = self._codes[condition]
+            offset, found = self._probe(base, product_id, code)
+            if offset is None:
+                region.unstorable.add((product_id, code))
+                continue
+            if not found:
+                region.stored += 1
+            encoded = name.encode()
+            SLOT.pack_into(self._map, offset, product_id, quantity,
+                           updated_at.replace(tzinfo=timezone.utc).timestamp(), code, active,
+                           len(encoded) if len(encoded) <= NAME_SIZE else LONG_NAME, encoded[:NAME_SIZE])
+            if region.watermark is None or updated_at > region.watermark:
+                region.watermark = updated_at
+
+    def lookup(self, product_id, condition, not_before=None):
+        """Returns the stock of a record from the table
+
+        Args:
+            product_id (int): the product_id of the record
+            condition (Enum): the condition of the record
+            not_before (float): UNIX time the table must have been published after
+
+        Returns:
+            tuple: the name, quantity, active and updated_at (UNIX time) of
+                the record, or None when the table cannot answer
+        """
+        self._open()
+        magic, slots, generation, published_at = HEADER.unpack_from(self._map, 0)
+        if (magic != MAGIC or slots != self.slots or self.clock() - published_at > self.max_staleness
+                or (not_before is not None and published_at <= not_before)):
+            self.stale += 1
+            return None
+        code = self._codes[condition]
+        base = self._base(generation % 2)
+        start = ((product_id * len(self._codes) + code) * HASH_MULTIPLIER) % (1 << 64)
+        found = None
+        for probe in range(PROBES):
+            slot = SLOT.unpack_from(self._map, base + ((start + probe) % self.slots) * SLOT.size)
+            if slot[3] == 0:
+                break
+            if slot[0] == product_id and slot[3] == code:
+                found = slot
+                break
+        # the writer moved on to this region while it was read
+        moved = GENERATION.unpack_from(self._map, GENERATION_OFFSET)[0] != generation
+        if found is None or found[5] == LONG_NAME or moved:
+            self.misses += 1
+            return None
+        self.hits += 1
+        _, quantity, updated_at, _, active, length, name = found
+        return name[:length].decode(), quantity, active, updated_at
+
+    def stats(self):
+        """Returns the hits, misses and age of the table as seen by this process"""
+        published_at = None if self._map is None else HEADER.unpack_from(self._map, 0)[3]
+        return {"hits": self.hits, "misses": self.misses, "stale": self.stale,
+                "writer": self._regions is not None,
+                "age": round(self.clock() - published_at, 3) if published_at else None}
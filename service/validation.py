@@ -0,0 +1,131 @@
+"""
+Request Validation
+
+Validators are compiled once from a schema of Fields: each field becomes a
+small check function specialised for its type, range and choices, so that
+validating a request costs one dict lookup and a couple of comparisons per
+field. Problems are collected as Issues instead of raised, so one pass over
+a row reports everything wrong with it, and rows that are valid allocate
+nothing but their dict of clean values.
+
+The same schema generates the flask-restx fields that document the API, so
+the documentation and the validation cannot drift apart.
+"""
+from collections import namedtuple
+
+from flask_restx import fields as api_types
+
+# name: the key in the request body; kind: int, str or bool
+# key: part of the primary key; minimum: the smallest int allowed
+# choices: an Enum whose values are accepted and converted to its members
+Field = namedtuple("Field", "name kind description key minimum choices", defaults=(False, None, None))
+
+# out_of_range is False for values of the wrong type
+Issue = namedtuple("Issue", "field message out_of_range")
+
+KIND_NAMES = {int: "an integer", str: "a string", bool: "a boolean"}
+API_TYPES = {int: api_types.Integer, str: api_types.String, bool: api_types.Boolean}
+
+
+class _Missing:  # pylint: disable=too-few-public-methods
+    """Returned by checks for values that are absent"""
+
+
+MISSING = _Missing()
+
+
+def compile_check(field):
+    """Returns a function taking a raw value to its clean value, an Issue or MISSING
+
+    None is missing. Outside of the primary key, empty values ("" or 0) are
+    missing too, except False for booleans, so that a partial update does
+    not clear a field.
+    """
+    kind, minimum, empty_is_missing = field.kind, field.minimum, not field.key and field.kind is not bool
+    wrong_type = Issue(field.name, f"{field.name} must be {KIND_NAMES[kind]}", False)
+    too_small = Issue(field.name, f"{field.name} must be at least {minimum}", True)
+    if field.choices is not None:
+        members = {member.value: member for member in field.choices}
+        not_a_choice = Issue(field.name, f"{field.name} must be one of {', '.join(members)}", True)
+
+    def check(value):
+        if value is None or (empty_is_missing and not value):
+            return MISSING
+        # type() rather than isinstance() so True is not taken for an int
+        if type(value) is not kind:  # pylint: disable=unidiomatic-typecheck
+            return wrong_type
+        if minimum is not None and value < minimum:
+            return too_small
+        if field.choices is not None:
+            return members.get(value, not_a_choice)
+        return value
+
+    return check
+
+
+class Validator:
+    """Validates request bodies against a schema of Fields
+
+    The key fields are all or nothing: unless every one of them is present
+    with the right type they are left out of the clean values, so that a
+    body without them can still update a record.
+    """
+
+    def __init__(self, schema):
+        self.schema = tuple(schema)
+        self._keys = tuple((field.name, compile_check(field)) for field in self.schema if field.key)
+        self._values = tuple((field.name, compile_check(field)) for field in self.schema if not field.key)
+
+    def validate(self, data):
+        """Validates one dict
+
+        Returns:
+            tuple: the clean values by field name, and the list of Issues (empty when valid)
+        """
+        values, issues = {}, []
+        get = data.get
+        complete = True
+        for name, check in self._keys:
+            result = check(get(name))
+            if result is MISSING or (type(result) is Issue and not result.out_of_range):
+                complete = False
+            elif type(result) is Issue:
+                issues.append(result)
+            else:
+                values[name] = result
+        if not complete:
+            values, issues = {}, []
+        for name, check in self._values:
+            result = check(get(name))
+            if result is MISSING:
+                continue
+            if type(result) is Issue:
+                issues.append(result)
+            else:
+                values[name] = result
+        return values, issues
+
+    def validate_many(self, rows):
+        """Validates a list of dicts in one pass
+
+        Returns:
+            list: a (values, issues) tuple for every row, in order
+        """
+        validate = self.validate
+        not_an_object = Issue(None, "row must be an object", False)
+        return [validate(row) if isinstance(row, dict) else ({}, [not_an_object]) for row in rows]
+
+
+def api_fields(schema, names, **options):
+    """Returns the flask-restx fields documenting the named Fields of a schema"""
+    documented = {}
+    for field in schema:
+        if field.name not in names:
+            continue
+        arguments = dict(options, description=field.description)
+        if field.minimum is not None:
+            arguments["min"] = field.minimum
+        if field.choices is not None:
+            arguments["enum"] = [member.value for member in field.choices]
+        documented[field.name] = API_TYPES[field.kind](**arguments)
+    return documented
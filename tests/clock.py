@@ -0,0 +1,13 @@
+"""
+Clock the tests move by hand, for code that takes a clock function
+"""
+
+
+class FakeClock:  # pylint: disable=too-few-public-methods
+    """A clock moved by hand"""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
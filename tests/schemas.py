@@ -0,0 +1,21 @@
+"""
+Test schema shared by the filter and validation tests
+"""
+import enum
+
+from service.validation import Field
+
+
+class Color(enum.Enum):
+    """Choices used by the test schema"""
+    RED = "red"
+    BLUE = "blue"
+
+
+SCHEMA = (
+    Field("id", int, "The id", key=True),
+    Field("color", str, "The color", key=True, choices=Color),
+    Field("label", str, "The label"),
+    Field("count", int, "The count", minimum=0),
+    Field("enabled", bool, "Whether it is enabled"),
+)
@@ -0,0 +1,105 @@
+"""
+Test cases for the admission controller
+
+"""
+import threading
+import time
+import unittest
+
+from service.admission import CRITICAL, LOW, NORMAL, WINDOW_SAMPLES, AdmissionController
+from tests.clock import FakeClock
+
+
+######################################################################
+#  A D M I S S I O N   T E S T   C A S E S
+######################################################################
+class TestAdmissionController(unittest.TestCase):
+    """ Test Cases for the concurrency limit and its queue """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.controller = AdmissionController(limit=2, min_limit=1, max_limit=4, queue_size=1,
+                                              target_db_seconds=0.05, window_seconds=1, clock=self.clock)
+
+    def waiting(self, priority, results):
+        """Starts a thread acquiring a slot, returning once it is queued"""
+        thread = threading.Thread(target=lambda: results.append((priority, self.controller.acquire(priority, 5))))
+        queued = self.controller.stats()["queued"]
+        thread.start()
+        while self.controller.stats()["queued"] == queued and thread.is_alive():
+            time.sleep(0.001)
+        return thread
+
+    def test_limit_and_full_queue(self):
+        """It should admit up to the limit, queue one more and reject the rest"""
+        self.assertTrue(self.controller.acquire(LOW, 0))
+        self.assertTrue(self.controller.acquire(LOW, 0))
+        results = []
+        thread = self.waiting(LOW, results)
+        self.assertFalse(self.controller.acquire(LOW, 0))
+        self.controller.release()
+        thread.join()
+        self.assertEqual(results, [(LOW, True)])
+        self.assertEqual(self.controller.stats()["rejected"], 1)
+
+    def test_priority_evicts_less_important_waiter(self):
+        """It should reject a queued list request to make room for a checkout"""
+        self.controller.acquire(LOW, 0)
+        self.controller.acquire(LOW, 0)
+        results = []
+        threads = [self.waiting(LOW, results),
+                   threading.Thread(target=lambda: results.append((CRITICAL, self.controller.acquire(CRITICAL, 5))))]
+        threads[1].start()
+        while not results:
+            time.sleep(0.001)
+        self.assertEqual(results, [(LOW, False)])
+        self.assertFalse(self.controller.acquire(NORMAL, 0))
+        self.controller.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [(LOW, False), (CRITICAL, True)])
+
+    def test_wait_timeout(self):
+        """It should give up on a slot after the timeout"""
+        self.controller.acquire(NORMAL, 0)
+        self.controller.acquire(NORMAL, 0)
+        self.assertFalse(self.controller.acquire(NORMAL, 0.01))
+        self.assertEqual(self.controller.stats()["queued"], 0)
+
+    def test_adapts_to_database_latency(self):
+        """It should shrink the limit when queries slow down and grow it when saturated"""
+        self.controller.observe(0.2)
+        self.clock.now = 1
+        self.controller.acquire(NORMAL, 0)
+        self.assertEqual(self.controller.limit, 1.8)
+        self.assertEqual(self.controller.stats()["db_ms"], 200)
+
+        self.assertFalse(self.controller.acquire(NORMAL, 0))  # the limit of 1 is reached
+        self.controller.observe(0.01)
+        self.clock.now = 2
+        self.controller.release()
+        self.assertAlmostEqual(self.controller.limit, 2.8)
+        for _ in range(10):
+            self.clock.now += 1
+            self.controller.observe(1)
+            self.controller.acquire(NORMAL, 0)
+            self.controller.release()
+        self.assertEqual(self.controller.limit, 1)
+
+    def test_latency_percentile(self):
+        """It should ignore a few slow queries and keep the sample bounded"""
+        for _ in range(95):
+            self.controller.observe(0.01)
+        for _ in range(5):
+            self.controller.observe(5)
+        self.clock.now = 1
+        self.controller.acquire(NORMAL, 0)
+        self.assertEqual(self.controller.limit, 2)
+        self.assertEqual(self.controller.stats()["db_ms"], 10)
+
+        for _ in range(10 * WINDOW_SAMPLES):
+            self.controller.observe(0.1)
+        self.assertEqual(len(self.controller._window_samples), WINDOW_SAMPLES)  # pylint: disable=protected-access
+        self.clock.now = 2
+        self.controller.release()
+        self.assertEqual(self.controller.limit, 1.8)
@@ -0,0 +1,101 @@
+"""
+Test cases for the columnar snapshot
+
+"""
+import unittest
+from datetime import datetime, timedelta
+
+from service import columnar, filters
+from service.columnar import ColumnarSnapshot
+from service.models import Inventory
+
+NEW, REFURBISHED, RETURN = Inventory.Condition.NEW, Inventory.Condition.REFURBISHED, Inventory.Condition.RETURN
+START = datetime(2022, 10, 1)
+
+
+class FakeTable:
+    """The rows of a table loaded the way _snapshot_rows loads them"""
+
+    def __init__(self):
+        self.rows = {}
+        self.now = START
+        self.loads = []
+
+    def put(self, product_id, name, condition, quantity, active=True):
+        """Inserts or updates a row"""
+        self.now += timedelta(seconds=1)
+        self.rows[(product_id, condition)] = (product_id, name, condition, quantity, active, self.now)
+
+    def load(self, since):
+        """Returns the row count and the rows updated at or after since"""
+        self.loads.append(since)
+        return len(self.rows), [row for row in self.rows.values() if since is None or row[5] >= since]
+
+
+######################################################################
+#  C O L U M N A R   S N A P S H O T   T E S T   C A S E S
+######################################################################
+@unittest.skipUnless(columnar.available(), "needs numpy")
+class TestColumnarSnapshot(unittest.TestCase):
+    """ Test Cases for ColumnarSnapshot """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.table = FakeTable()
+        self.table.put(3, "desk", NEW, 5)
+        self.table.put(1, "laptop", RETURN, 20, active=False)
+        self.table.put(1, "laptop", NEW, 10)
+        self.table.put(2, "monitor", REFURBISHED, 40)
+        self.snapshot = ColumnarSnapshot(conditions=list(Inventory.Condition), full_interval=60,
+                                         clock=lambda: 0.0)
+        self.snapshot.init_app(self.table.load)
+
+    def keys(self, by_filters):
+        """Returns the keys of the rows selected by by_filters"""
+        return [(row[0], row[2]) for row in self.snapshot.select(by_filters)]
+
+    def test_select(self):
+        """It should answer filters in primary key order"""
+        self.assertIsNone(self.snapshot.select({}))
+        self.assertTrue(self.snapshot.refresh())
+        self.assertEqual(self.snapshot.select({"product_id": "1"}),
+                         [(1, "laptop", NEW, 10, True), (1, "laptop", RETURN, 20, False)])
+        self.assertEqual(self.keys({}), [(1, NEW), (1, RETURN), (2, REFURBISHED), (3, NEW)])
+        self.assertEqual(self.keys({"condition": NEW, "active": True}), [(1, NEW), (3, NEW)])
+        self.assertEqual(self.keys({"quantity": ("10", ">")}), [(1, RETURN), (2, REFURBISHED)])
+        self.assertEqual(self.keys({"name": "desk"}), [(3, NEW)])
+        self.assertEqual(self.keys({"name": "chair"}), [])
+        self.assertIsNone(self.snapshot.select({"quantity": ("x", ">")}))
+
+    def test_filter_and_sort(self):
+        """It should answer filter expressions and sorts like the database"""
+        self.snapshot.refresh()
+        parsed = filters.parse("condition in (new, return) and quantity in 6..20 or name = monitor",
+                               Inventory.FIELDS)
+        self.assertEqual(self.keys({"filter": parsed}), [(1, NEW), (1, RETURN), (2, REFURBISHED)])
+        sort = filters.parse_sort("-quantity", Inventory.SORTABLE)
+        self.assertEqual(self.keys({"filter": parsed, "sort": sort}), [(2, REFURBISHED), (1, RETURN), (1, NEW)])
+        sort = filters.parse_sort("condition,-product_id", Inventory.SORTABLE)
+        self.assertEqual(self.keys({"sort": sort}), [(3, NEW), (1, NEW), (2, REFURBISHED), (1, RETURN)])
+        # names are left to the collation of the database
+        self.assertIsNone(self.snapshot.select({"filter": filters.parse("name > d", Inventory.FIELDS)}))
+        self.assertIsNone(self.snapshot.select({"sort": filters.parse_sort("name", Inventory.SORTABLE)}))
+
+    def test_incremental_refresh(self):
+        """It should merge changed rows and reload once rows are deleted"""
+        self.snapshot.refresh()
+        self.table.put(2, "monitor", REFURBISHED, 35)
+        self.table.put(0, "chair", NEW, 1)
+        self.snapshot.refresh()
+        self.assertEqual(self.table.loads[-1], self.table.now - timedelta(seconds=2) - columnar.OVERLAP)
+        self.assertEqual(self.snapshot.full_loads, 1)
+        self.assertEqual(self.keys({}), [(0, NEW), (1, NEW), (1, RETURN), (2, REFURBISHED), (3, NEW)])
+        self.assertEqual(self.snapshot.select({"product_id": 2})[0][3], 35)
+
+        del self.table.rows[(3, NEW)]
+        self.snapshot.refresh()
+        self.assertEqual(self.snapshot.full_loads, 2)
+        self.assertEqual(self.keys({"condition": NEW}), [(0, NEW), (1, NEW)])
+        stats = self.snapshot.stats()
+        self.assertEqual(stats["rows"], 4)
+        self.assertEqual(stats["bytes"], 4 * 22)
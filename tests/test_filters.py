@@ -0,0 +1,40 @@
+"""
+Test cases for filter expressions
+
+"""
+import unittest
+
+from service.filters import FilterError, Term, parse, parse_sort
+from tests.schemas import SCHEMA, Color
+
+
+######################################################################
+#  F I L T E R   T E S T   C A S E S
+######################################################################
+class TestFilters(unittest.TestCase):
+    """ Test Cases for filter expressions """
+
+    def test_parse_groups(self):
+        """It should parse an OR of AND groups with typed values"""
+        parsed = parse("color in (red, BLUE, red) and count in 10..50 or enabled = false", SCHEMA)
+        self.assertEqual(parsed, (
+            (Term("color", "in", (Color.RED, Color.BLUE)), Term("count", "between", (10, 50))),
+            (Term("enabled", "=", False),),
+        ))
+
+    def test_parse_quoted_values(self):
+        """It should take quoted values with spaces and escaped quotes"""
+        self.assertEqual(parse("label = 'oak desk' AND id != 3", SCHEMA),
+                         ((Term("label", "=", "oak desk"), Term("id", "!=", 3)),))
+        self.assertEqual(parse("label >= 'it''s'", SCHEMA), ((Term("label", ">=", "it's"),),))
+
+    def test_parse_errors(self):
+        """It should reject filters that are not valid"""
+        for text in ("size = 1", "count = x", "count >", "count in 5..1", "enabled in 1..2",
+                     "label = a b", "count = 1 or", "color = green", "(count = 1)", "count in (1,"):
+            self.assertRaises(FilterError, parse, text, SCHEMA)
+
+    def test_parse_sort(self):
+        """It should parse sort columns and their direction"""
+        self.assertEqual(parse_sort("-count, label", ("label", "count")), (("count", True), ("label", False)))
+        self.assertRaises(FilterError, parse_sort, "enabled", ("label", "count"))
@@ -0,0 +1,63 @@
+"""
+Test cases for the gunicorn configuration
+
+"""
+import os
+import runpy
+import unittest
+from unittest import mock
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gunicorn.conf.py")
+
+
+def load(**environ):
+    """Returns the settings of gunicorn.conf.py under the given environment"""
+    with mock.patch.dict(os.environ, environ):
+        return runpy.run_path(CONFIG)
+
+
+######################################################################
+#  G U N I C O R N   C O N F I G   T E S T   C A S E S
+######################################################################
+class TestGunicornConfig(unittest.TestCase):
+    """ Test Cases for gunicorn.conf.py """
+
+    def test_defaults(self):
+        """It should preload threaded workers and recycle them"""
+        settings = load(PORT="9000")
+        self.assertEqual(settings["bind"], "0.0.0.0:9000")
+        self.assertEqual(settings["worker_class"], "gthread")
+        self.assertTrue(settings["preload_app"])
+        self.assertEqual(settings["max_requests"], 1000)
+
+    def test_long_response_caps(self):
+        """It should leave half of a worker's threads to requests other than streams and exports"""
+        for worker_class, streams, exports in [("gthread", "2", "2"), ("gevent", "25", "25"), ("sync", "0", "1")]:
+            with mock.patch.dict(os.environ, {"GUNICORN_WORKER_CLASS": worker_class}):
+                os.environ.pop("STREAM_MAX_PER_WORKER", None)
+                os.environ.pop("EXPORT_MAX_PER_WORKER", None)
+                runpy.run_path(CONFIG)
+                self.assertEqual((os.environ["STREAM_MAX_PER_WORKER"], os.environ["EXPORT_MAX_PER_WORKER"]),
+                                 (streams, exports))
+        with mock.patch.dict(os.environ, {"STREAM_MAX_PER_WORKER": "7"}):
+            runpy.run_path(CONFIG)
+            self.assertEqual(os.environ["STREAM_MAX_PER_WORKER"], "7")
+
+    def test_environment(self):
+        """It should be tuned from the environment"""
+        settings = load(GUNICORN_WORKER_CLASS="gevent", GUNICORN_WORKERS="3", GUNICORN_MAX_REQUESTS="0",
+                        GUNICORN_BIND="127.0.0.1:8001")
+        self.assertEqual(settings["workers"], 3)
+        self.assertFalse(settings["preload_app"])
+        self.assertEqual(settings["max_requests"], 0)
+        self.assertEqual(settings["bind"], "127.0.0.1:8001")
+        self.assertTrue(load(GUNICORN_WORKER_CLASS="gevent", GUNICORN_PRELOAD="true")["preload_app"])
+
+    @unittest.skipUnless(os.path.exists("/proc/self/statm"), "needs /proc")
+    def test_memory_recycling(self):
+        """It should stop a worker that grew past the memory threshold"""
+        worker = mock.Mock(alive=True, pid=1)
+        load(GUNICORN_MAX_WORKER_MEMORY_MB="100000")["post_request"](worker, None, {}, None)
+        self.assertTrue(worker.alive)
+        load(GUNICORN_MAX_WORKER_MEMORY_MB="1")["post_request"](worker, None, {}, None)
+        self.assertFalse(worker.alive)
@@ -5,9 +5,12 @@ Test cases for Inventory Model
 import logging
 import os
 import unittest
+from datetime import datetime, timedelta
 
-from service import app
-from service.models import DataValidationError, InactiveRecordError, Inventory, OutOfRangeError, db
+from service import app, filters
+from service.models import (DataValidationError, IdempotencyKey, InactiveRecordError, Inventory, InventoryCheckpoint,
+                            InventoryHistory, InventoryLocation, InventoryShard, Location,
+                            OutOfRangeError, db, dispose_connections)
 from tests.factories import InventoryFactory
 
 DATABASE_URI = os.getenv(
@@ -37,6 +40,12 @@ class TestInventory(unittest.TestCase):
 
     def setUp(self):
         """ This runs before each test """
+        db.session.query(IdempotencyKey).delete()
+        db.session.query(InventoryHistory).delete()
+        db.session.query(InventoryCheckpoint).delete()
+        db.session.query(InventoryShard).delete()
+        db.session.query(InventoryLocation).delete()
+        db.session.query(Location).delete()
         db.session.query(Inventory).delete()  # clean up the last tests
         db.session.commit()
 
@@ -197,6 +206,16 @@ class TestInventory(unittest.TestCase):
             self.assertRaises(OutOfRangeError, record.deserialize, request)
             request[field] = temp
 
+    def test_deserialize_reports_every_error(self):
+        """It should list every invalid field in one error"""
+        data = {"product_id": 1, "condition": "used", "name": 2, "quantity": -1, "active": "no"}
+        with self.assertRaises(DataValidationError) as context:
+            Inventory().deserialize(data)
+        message = str(context.exception)
+        for expected in ("condition must be one of new, refurbished, return", "name must be a string",
+                         "quantity must be at least 0", "active must be a boolean"):
+            self.assertIn(expected, message)
+
     def test_read_a_record(self):
         """It should Read a Record"""
         record = InventoryFactory()
@@ -299,3 +318,330 @@ class TestInventory(unittest.TestCase):
         # reorder fails when record is inactive
         record.active = False
         self.assertRaises(InactiveRecordError, record.reorder, data)
+
+    ######################################################################
+    #  S H A R D E D   C O U N T E R S
+    ######################################################################
+
+    def test_shard_record(self):
+        """It should split the quantity of a record over shards"""
+        record = InventoryFactory(quantity=10, active=True)
+        record.create()
+        record.set_shard_count(4)
+        self.assertEqual(record.shard_count, 4)
+        self.assertEqual(record.quantity, 0)
+        shards = [shard.quantity for shard in InventoryShard.of(record).order_by(InventoryShard.shard)]
+        self.assertEqual(shards, [3, 3, 2, 2])
+        self.assertEqual(record.serialize()["quantity"], 10)
+
+        # resizing keeps the total
+        record.set_shard_count(2)
+        self.assertEqual(InventoryShard.of(record).count(), 2)
+        self.assertEqual(record.available_quantity(), 10)
+
+        # merging moves the stock back into the record
+        record.set_shard_count(0)
+        self.assertEqual(InventoryShard.of(record).count(), 0)
+        self.assertEqual(record.quantity, 10)
+        self.assertRaises(DataValidationError, record.set_shard_count, -1)
+
+    def test_sharded_checkout_and_reorder(self):
+        """It should checkout from and reorder into shards"""
+        record = InventoryFactory(quantity=10, active=True)
+        record.create()
+        record.set_shard_count(4)
+        record.checkout({"ordered_quantity": 2})
+        self.assertEqual(record.available_quantity(), 8)
+        # no single shard holds 7 so the shards are drained together
+        record.checkout({"ordered_quantity": 7})
+        self.assertEqual(record.available_quantity(), 1)
+        self.assertRaises(OutOfRangeError, record.checkout, {"ordered_quantity": 2})
+        db.session.rollback()
+        record.reorder({"ordered_quantity": 5})
+        self.assertEqual(record.available_quantity(), 6)
+        self.assertEqual(Inventory.find((record.product_id, record.condition)).quantity, 0)
+
+    def test_rebalance_shards(self):
+        """It should even out the shards of every sharded record"""
+        record = InventoryFactory(quantity=8, active=True)
+        record.create()
+        record.set_shard_count(2)
+        record.reorder({"ordered_quantity": 4})
+        self.assertEqual(Inventory.rebalance_all_shards(), 1)
+        shards = [shard.quantity for shard in InventoryShard.of(record)]
+        self.assertEqual(shards, [6, 6])
+
+        # the shards loaded before a checkout committed are read again once locked
+        InventoryShard.of(record).all()
+        InventoryShard.of(record).filter(InventoryShard.shard == 0).update(
+            {InventoryShard.quantity: InventoryShard.quantity - 5}, synchronize_session=False)
+        record.rebalance_shards()
+        self.assertEqual([shard.quantity for shard in InventoryShard.of(record)], [4, 3])
+        record.set_shard_count(0)
+        self.assertEqual(record.quantity, 7)
+
+    def test_filter_sharded_quantity(self):
+        """It should filter sharded records on the sum of their shards"""
+        record = InventoryFactory(quantity=50, active=True)
+        record.create()
+        record.set_shard_count(4)
+        key = (record.product_id, record.condition)
+        found = Inventory.find_by_general_filter({"quantity": ("10", ">")})
+        self.assertIn(key, [(each.product_id, each.condition) for each in found])
+        self.assertEqual(Inventory.find_by_general_filter({"quantity": ("0", "=")}), [])
+        # filter expressions and sorts compare the sum of the shards too
+        InventoryFactory(quantity=20, active=True).create()
+        parsed = filters.parse("quantity in 40..60", Inventory.FIELDS)
+        found = Inventory.find_by_general_filter({"filter": parsed})
+        self.assertEqual([(each.product_id, each.condition) for each in found], [key])
+        found = Inventory.find_by_general_filter({"sort": filters.parse_sort("-quantity", Inventory.SORTABLE)})
+        self.assertEqual((found[0].product_id, found[0].condition), key)
+
+    def test_count_sharded_quantity(self):
+        """It should count sharded records like the list finds them"""
+        record = InventoryFactory(quantity=50, active=True)
+        record.create()
+        record.set_shard_count(4)
+        InventoryFactory(quantity=0, active=True).create()
+        for by_filters in [{"quantity": ("10", ">")}, {"quantity": ("0", "=")},
+                           {"filter": filters.parse("quantity >= 50", Inventory.FIELDS)}]:
+            self.assertEqual(Inventory.count(by_filters),
+                             (len(Inventory.find_by_general_filter(by_filters)), False))
+        self.assertEqual(Inventory.count({"quantity": ("10", ">")}), (1, False))
+
+    def test_update_and_delete_sharded_record(self):
+        """It should update and delete a sharded record"""
+        record = InventoryFactory(quantity=8, active=True)
+        record.create()
+        record.set_shard_count(3)
+        new_data = Inventory(quantity=30)
+        record.update(new_data)
+        self.assertEqual(record.available_quantity(), 30)
+        record.delete()
+        self.assertEqual(InventoryShard.query.count(), 0)
+
+    ######################################################################
+    #  C O A L E S C E D   R E A D S
+    ######################################################################
+
+    def test_find_coalesced(self):
+        """It should find detached copies of records"""
+        record = InventoryFactory()
+        record.create()
+        found = Inventory.find_coalesced((record.product_id, record.condition.name))
+        self.assertEqual(found.serialize(), record.serialize())
+        self.assertNotIn(found, db.session)
+        self.assertIsNone(Inventory.find_coalesced((record.product_id + 1, record.condition.name)))
+        # keys from the URL are text
+        self.assertEqual(Inventory.find_coalesced((str(record.product_id), record.condition.name)).product_id,
+                         record.product_id)
+        self.assertIsNone(Inventory.find_coalesced(("abc", record.condition.name)))
+
+    def test_find_many_text_keys(self):
+        """It should convert the product ids of the keys it finds"""
+        record = InventoryFactory()
+        record.create()
+        text_key, bad_key = (str(record.product_id), record.condition), ("abc", record.condition)
+        found, missing = Inventory.find_many([text_key, bad_key])
+        self.assertEqual([found_record.product_id for found_record in found], [record.product_id])
+        self.assertEqual(missing, [bad_key])
+
+    def test_find_by_general_filter_coalesced(self):
+        """It should filter like find_by_general_filter"""
+        for quantity in [5, 10, 15]:
+            InventoryFactory(quantity=quantity).create()
+        found = Inventory.find_by_general_filter_coalesced({"quantity": (10, ">=")})
+        self.assertEqual(sorted(record.quantity for record in found), [10, 15])
+        self.assertEqual(len(Inventory.find_by_general_filter_coalesced({})), 3)
+        self.assertEqual(Inventory.find_by_general_filter_coalesced({"quantity": (10, "!")}), "Invalid")
+
+    def test_dispose_connections(self):
+        """It should empty the connection pools and keep working afterwards"""
+        record = InventoryFactory()
+        record.create()
+        key = (record.product_id, record.condition)
+        dispose_connections(close=False)
+        dispose_connections()
+        self.assertIsNotNone(Inventory.find(key))
+
+    def test_find_with_typed_product_id(self):
+        """It should convert product ids to integers and reject the others"""
+        record = InventoryFactory()
+        record.create()
+        found = Inventory.find((str(record.product_id), record.condition))
+        self.assertEqual(found.product_id, record.product_id)
+        self.assertIsNone(Inventory.find(("abc", record.condition)))
+        found = Inventory.find_by_general_filter({"product_id": str(record.product_id)})
+        self.assertEqual([found.product_id for found in found], [record.product_id])
+        self.assertEqual(Inventory.find_by_general_filter({"product_id": "abc"}), "Invalid")
+
+    ######################################################################
+    #  N A M E   S E A R C H
+    ######################################################################
+
+    def test_search(self):
+        """It should find names by prefix first, then by similarity"""
+        for product_id, name in enumerate(["laptop", "Laptop Stand", "desktop", "monitor", "lamp"]):
+            InventoryFactory(product_id=product_id, name=name).create()
+        self.assertEqual([record.name for record in Inventory.search("lapt")], ["laptop", "Laptop Stand"])
+        self.assertEqual([record.name for record in Inventory.search("moniter")], ["monitor"])
+        self.assertEqual([record.name for record in Inventory.search("desk")], ["desktop"])
+        self.assertEqual(Inventory.search("zzz"), [])
+
+        # pages, filters and renamed records
+        self.assertEqual([record.name for record in Inventory.search("lapt", limit=1, offset=1)], ["Laptop Stand"])
+        self.assertEqual(Inventory.search("lapt", {"product_id": 1})[0].name, "Laptop Stand")
+        self.assertEqual(Inventory.search("lapt", {"quantity": (1, "!")}), "Invalid")
+        record = Inventory.search("monitor")[0]
+        record.name = "screen"
+        db.session.commit()
+        self.assertEqual([record.name for record in Inventory.search("scre")], ["screen"])
+        self.assertEqual(Inventory.search("moniter"), [])
+
+    ######################################################################
+    #  L O C A T I O N S
+    ######################################################################
+
+    def _stock_in_locations(self, record, **quantities):
+        """Creates the test locations and stocks record in them"""
+        for code, name, latitude, longitude in [("NYC", "New York", 40.7, -74.0),
+                                                ("LAX", "Los Angeles", 34.1, -118.2),
+                                                ("CHI", "Chicago", 41.9, -87.6)]:
+            Location(code=code).deserialize({"name": name, "latitude": latitude, "longitude": longitude}).save()
+        for code, quantity in quantities.items():
+            record.set_location_stock(code, quantity)
+
+    def test_location_stock_rollup(self):
+        """It should keep the quantity of a record as the total over its locations"""
+        record = InventoryFactory(quantity=5, active=True)
+        record.create()
+        self._stock_in_locations(record, NYC=3, LAX=10)
+        self.assertEqual((record.quantity, record.location_count), (13, 2))
+        record.set_location_stock("NYC", 1)
+        self.assertEqual(record.quantity, 11)
+        record.reorder({"ordered_quantity": 4, "location": "NYC"})
+        self.assertEqual(record.quantity, 15)
+        self.assertEqual({row.location: row.quantity for row in InventoryLocation.of(record)},
+                         {"NYC": 5, "LAX": 10})
+        self.assertTrue(record.remove_location("LAX"))
+        self.assertFalse(record.remove_location("LAX"))
+        self.assertEqual((record.quantity, record.location_count), (5, 1))
+
+        self.assertRaises(DataValidationError, record.set_location_stock, "SFO", 1)
+        self.assertRaises(DataValidationError, record.set_location_stock, "NYC", -1)
+        self.assertRaises(DataValidationError, record.reorder, {"ordered_quantity": 1})
+        self.assertRaises(DataValidationError, record.reorder, {"ordered_quantity": 1, "location": "CHI"})
+        self.assertRaises(DataValidationError, record.set_shard_count, 2)
+        record.delete()
+        self.assertEqual(InventoryLocation.query.count(), 0)
+
+    def test_location_checkout(self):
+        """It should check out from the chosen, nearest or fullest location"""
+        record = InventoryFactory(quantity=0, active=True)
+        record.create()
+        self._stock_in_locations(record, NYC=3, LAX=10, CHI=4)
+        near_pittsburgh = {"latitude": 40.4, "longitude": -80.0}
+        record.checkout({"ordered_quantity": 2, **near_pittsburgh})
+        self.assertEqual((record.allocated_from, record.quantity), ("NYC", 15))
+        record.checkout({"ordered_quantity": 2, **near_pittsburgh})
+        self.assertEqual(record.allocated_from, "CHI")  # NYC has only 1 left
+        record.checkout({"ordered_quantity": 1})
+        self.assertEqual(record.allocated_from, "LAX")
+        record.checkout({"ordered_quantity": 1, "location": "NYC"})
+        self.assertEqual((record.allocated_from, record.quantity), ("NYC", 11))
+
+        self.assertRaises(OutOfRangeError, record.checkout, {"ordered_quantity": 1, "location": "NYC"})
+        db.session.rollback()
+        self.assertRaises(OutOfRangeError, record.checkout, {"ordered_quantity": 10})
+        db.session.rollback()
+        self.assertRaises(DataValidationError, record.checkout, {"ordered_quantity": 1, "latitude": "x"})
+        db.session.rollback()
+        self.assertEqual(Inventory.find((record.product_id, record.condition.name)).quantity, 11)
+
+    def test_location_deserialize(self):
+        """It should validate the name and coordinates of a location"""
+        location = Location(code="X").deserialize({"name": "Nowhere"})
+        self.assertIsNone(location.distance_to(0, 0))
+        self.assertAlmostEqual(Location(code="Y").deserialize(
+            {"name": "Equator", "latitude": 0, "longitude": 1}).distance_to(0, 0), 111.19, places=2)
+        for data in [{}, {"name": "A", "latitude": 1}, {"name": "A", "latitude": 91, "longitude": 0},
+                     {"name": "A", "latitude": True, "longitude": 0}]:
+            self.assertRaises(DataValidationError, Location(code="Z").deserialize, data)
+
+    ######################################################################
+    #  S T O C K   H I S T O R Y
+    ######################################################################
+
+    def test_history_of_mutations(self):
+        """It should append a history entry for every mutation"""
+        record = InventoryFactory(quantity=10, active=True)
+        record.create()
+        record.checkout({"ordered_quantity": 3})
+        record.reorder({"ordered_quantity": 5})
+        record.delete()
+        entries = InventoryHistory.find_range(record.product_id, record.condition.name)
+        self.assertEqual([(entry.quantity, entry.deleted) for entry in entries],
+                         [(10, False), (7, False), (12, False), (0, True)])
+        self.assertEqual(len(InventoryHistory.find_range(record.product_id, record.condition.name, limit=2)), 2)
+        self.assertEqual(InventoryHistory.find_range(record.product_id, record.condition.name,
+                                                     since=entries[-1].recorded_at), entries[-1:])
+        self.assertEqual(InventoryHistory.find_range(record.product_id, record.condition.name,
+                                                     until=entries[0].recorded_at), [])
+        self.assertEqual(InventoryHistory.find_range("laptop", record.condition.name), [])
+
+    def test_find_as_of(self):
+        """It should rebuild the inventory at past times from checkpoints and history"""
+        def as_of(when, by_filters=None):
+            return sorted((record.product_id, record.quantity) for record in Inventory.find_as_of(when, by_filters))
+
+        first = InventoryFactory(product_id=1, quantity=10, active=True)
+        first.create()
+        self.assertEqual(as_of(datetime.utcnow()), [(1, 10)])
+        self.assertEqual(InventoryCheckpoint.take(), 1)
+        # from now on the state before the checkpoint can only come from it
+        InventoryHistory.query.delete()
+        db.session.commit()
+        after_checkpoint = datetime.utcnow()
+
+        first.checkout({"ordered_quantity": 4})
+        after_checkout = datetime.utcnow()
+        InventoryFactory(product_id=2, quantity=3, active=True).create()
+        first.delete()
+
+        self.assertEqual(as_of(after_checkpoint), [(1, 10)])
+        self.assertEqual(as_of(after_checkout), [(1, 6)])
+        self.assertEqual(as_of(datetime.utcnow()), [(2, 3)])
+        self.assertEqual(as_of(datetime.utcnow(), {"quantity": (5, ">")}), [])
+        self.assertEqual(Inventory.find_as_of(datetime.utcnow(), {"quantity": (5, "!")}), "Invalid")
+
+        self.assertEqual(InventoryCheckpoint.take(), 1)
+        self.assertEqual(InventoryCheckpoint.prune(datetime.utcnow()), 1)
+        self.assertEqual(as_of(datetime.utcnow()), [(2, 3)])
+
+    ######################################################################
+    #  I D E M P O T E N C Y   K E Y S
+    ######################################################################
+
+    def test_claim_idempotency_key(self):
+        """It should claim a key once and expire it"""
+        record, claimed = IdempotencyKey.claim("claim-test", "abc", 60)
+        self.assertTrue(claimed)
+        self.assertFalse(record.completed)
+        again, claimed = IdempotencyKey.claim("claim-test", "abc", 60)
+        self.assertFalse(claimed)
+        self.assertEqual(again.key, "claim-test")
+
+        record.complete(200, "{}", ttl_seconds=-1)
+        self.assertIsNone(IdempotencyKey.find("claim-test"))
+        self.assertEqual(IdempotencyKey.purge_expired(), 1)
+        _, claimed = IdempotencyKey.claim("claim-test", "abc", 60)
+        self.assertTrue(claimed)
+
+    def test_idempotency_key_outlives_its_lock(self):
+        """It should not hand the key of a running request over once its lock expired"""
+        IdempotencyKey.claim("slow-request", "abc", -1)
+        record, claimed = IdempotencyKey.claim("slow-request", "abc", 60)
+        self.assertFalse(claimed)
+        self.assertFalse(record.completed)
+        self.assertEqual(IdempotencyKey.purge_expired(), 0)
+        self.assertEqual(IdempotencyKey.purge_expired(abandoned_after=timedelta(0)), 1)
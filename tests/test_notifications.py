@@ -0,0 +1,139 @@
+"""
+Test cases for the stock notification broadcaster
+
+"""
+import json
+import socket
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+from service.notifications import StockBroadcaster
+
+
+def _event(product_id, quantity, condition="new"):
+    return {"product_id": product_id, "condition": condition,
+            "quantity": quantity, "active": True, "deleted": False}
+
+
+class FakeListenConnection:
+    """Stand-in for a psycopg2 connection that is readable once and then fails"""
+
+    def __init__(self, payload):
+        self.reader, self.writer = socket.socketpair()
+        self.writer.send(b"x")
+        self.payload = payload
+        self.notifies = []
+        self.polled = False
+
+    def fileno(self):
+        """The descriptor select waits on"""
+        return self.reader.fileno()
+
+    def set_isolation_level(self, level):
+        """Accepts the autocommit level"""
+
+    @staticmethod
+    def cursor():
+        """Returns a cursor accepting the LISTEN"""
+        return MagicMock()
+
+    def poll(self):
+        """Delivers the payload once, then fails like a dropped connection"""
+        if self.polled:
+            raise EOFError("connection closed")
+        self.polled = True
+        self.notifies.append(SimpleNamespace(payload=self.payload))
+
+    def close(self):
+        """Closes the socket pair"""
+        self.reader.close()
+        self.writer.close()
+
+
+######################################################################
+#  S T O C K   B R O A D C A S T E R   T E S T   C A S E S
+######################################################################
+class TestStockBroadcaster(unittest.TestCase):
+    """ Test Cases for the StockBroadcaster """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.broadcaster = StockBroadcaster()
+
+    def test_publish_to_matching_keys(self):
+        """It should only deliver events for subscribed keys"""
+        first = self.broadcaster.subscribe({(1, "new")})
+        second = self.broadcaster.subscribe({(2, "new"), (1, "return")})
+        self.assertEqual(self.broadcaster.subscriber_count, 2)
+        self.broadcaster.publish(_event(1, 5))
+        self.assertEqual(first.wait(0), [_event(1, 5)])
+        self.assertEqual(second.wait(0), [])
+
+    def test_coalesce_pending_events(self):
+        """It should keep only the latest undelivered event per key"""
+        subscription = self.broadcaster.subscribe({(1, "new"), (2, "new")})
+        self.broadcaster.publish(_event(1, 5))
+        self.broadcaster.publish(_event(2, 9))
+        self.broadcaster.publish(_event(1, 4))
+        self.assertEqual(subscription.wait(0), [_event(2, 9), _event(1, 4)])
+
+    def test_close_subscription(self):
+        """It should stop delivering events once a subscription is closed"""
+        subscription = self.broadcaster.subscribe({(1, "new")})
+        subscription.close()
+        subscription.close()
+        self.assertEqual(self.broadcaster.subscriber_count, 0)
+        self.broadcaster.publish(_event(1, 5))
+        self.assertEqual(subscription.wait(0), [])
+
+    def test_staged_events_wait_for_commit(self):
+        """It should only publish staged events after a commit"""
+        class FakeSession:  # pylint: disable=too-few-public-methods
+            """Stand-in exposing the session info dictionary"""
+            info = {}
+
+        session = FakeSession()
+        subscription = self.broadcaster.subscribe({(1, "new")})
+        self.broadcaster.stage(session, _event(1, 5))
+        self.assertEqual(subscription.wait(0), [])
+        self.broadcaster.discard_pending(session)
+        self.broadcaster.flush_pending(session)
+        self.assertEqual(subscription.wait(0), [])
+
+        self.broadcaster.stage(session, _event(1, 6))
+        self.broadcaster.flush_pending(session)
+        self.assertEqual(subscription.wait(0), [_event(1, 6)])
+
+    def test_listen_publishes_notifications(self):
+        """It should publish the notifications its connection receives"""
+        connection = FakeListenConnection(json.dumps(_event(1, 5)))
+        self.addCleanup(connection.close)
+        engine = MagicMock()
+        engine.raw_connection.return_value.connection = connection
+        self.broadcaster.init_app(engine)
+        subscription = self.broadcaster.subscribe({(1, "new")})
+        self.assertRaises(EOFError, self.broadcaster._listen)  # pylint: disable=protected-access
+        self.assertEqual(subscription.wait(0), [_event(1, 5)])
+        engine.raw_connection.return_value.invalidate.assert_called_once()
+
+    def test_listener_per_process(self):  # pylint: disable=protected-access
+        """It should start the listener lazily, once per process"""
+        stop = threading.Event()
+        self.addCleanup(stop.set)
+        self.broadcaster._listen_forever = stop.wait
+        self.broadcaster.init_app(MagicMock(**{"dialect.name": "postgresql"}))
+        self.broadcaster.ensure_observed()
+        self.assertIsNone(self.broadcaster._listener)
+        self.broadcaster.observe(lambda stock_event: None)
+        self.assertIsNone(self.broadcaster._listener)
+        self.broadcaster.ensure_observed()
+        listener = self.broadcaster._listener
+        self.assertTrue(listener.is_alive())
+        self.broadcaster.ensure_observed()
+        self.assertIs(self.broadcaster._listener, listener)
+        # a forked child inherits the listener of its parent but not its thread
+        self.broadcaster._listener_pid = -1
+        self.broadcaster.ensure_observed()
+        self.assertIsNot(self.broadcaster._listener, listener)
@@ -0,0 +1,51 @@
+"""
+Test cases for the inventory table partitioning helpers
+
+"""
+import unittest
+
+from sqlalchemy import Column, Enum, Integer, MetaData, Table
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable
+from service import partitioning
+
+
+######################################################################
+#  P A R T I T I O N I N G   T E S T   C A S E S
+######################################################################
+class TestPartitioning(unittest.TestCase):
+    """ Test Cases for the partitioning DDL """
+
+    def test_partition_by(self):
+        """It should give the PARTITION BY clause of each scheme"""
+        self.assertEqual(partitioning.partition_by("hash"), "HASH (product_id)")
+        self.assertEqual(partitioning.partition_by("list"), "LIST (condition)")
+        self.assertRaises(ValueError, partitioning.partition_by, "range")
+
+    def test_hash_partitions(self):
+        """It should create one partition per hash remainder"""
+        statements = partitioning.partition_ddl("inventory", "hash", 3, [])
+        self.assertEqual(len(statements), 3)
+        self.assertEqual(statements[2], "CREATE TABLE inventory_p2 PARTITION OF inventory "
+                                        "FOR VALUES WITH (MODULUS 3, REMAINDER 2)")
+
+    def test_list_partitions(self):
+        """It should create one partition per condition and a default one"""
+        statements = partitioning.partition_ddl("rebuilt", "list", 8, ["NEW", "RETURN"], prefix="part")
+        self.assertEqual(statements, [
+            "CREATE TABLE part_new PARTITION OF rebuilt FOR VALUES IN ('NEW')",
+            "CREATE TABLE part_return PARTITION OF rebuilt FOR VALUES IN ('RETURN')",
+            "CREATE TABLE part_default PARTITION OF rebuilt DEFAULT",
+        ])
+
+    def test_configure(self):
+        """It should make PostgreSQL create the table partitioned"""
+        table = Table("inventory", MetaData(), Column("product_id", Integer, primary_key=True),
+                      Column("condition", Enum("NEW", "RETURN", name="condition"), primary_key=True))
+        partitioning.configure(table, "", 4)
+        self.assertNotIn("PARTITION BY", str(CreateTable(table).compile(dialect=postgresql.dialect())))
+        self.assertRaises(ValueError, partitioning.configure, table, "hash", 0)
+        partitioning.configure(table, "hash", 4)
+        ddl = str(CreateTable(table).compile(dialect=postgresql.dialect()))
+        self.assertIn("PARTITION BY HASH (product_id)", ddl)
+        self.assertEqual(table.info["partitioning"], ("hash", 4))
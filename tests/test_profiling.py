@@ -0,0 +1,82 @@
+"""
+Test cases for on-demand profiling
+
+"""
+import cProfile
+import threading
+import unittest
+
+from service.profiling import Profiler, collapsed
+
+
+def spin(stop):
+    """Keeps a thread busy until stop is set"""
+    total = 0
+    while not stop.is_set():
+        total += 1
+    return total
+
+
+######################################################################
+#  P R O F I L E R   T E S T   C A S E S
+######################################################################
+class TestProfiler(unittest.TestCase):
+    """ Test Cases for Profiler """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.profiler = Profiler()
+
+    def test_sample(self):
+        """It should count the collapsed stacks of the other threads"""
+        stop = threading.Event()
+        worker = threading.Thread(target=spin, args=(stop,))
+        worker.start()
+        try:
+            stacks, samples, overhead = self.profiler.sample(0.2, 0.001)
+        finally:
+            stop.set()
+            worker.join()
+        self.assertGreater(samples, 10)
+        self.assertLess(overhead, 0.05)
+        # the sample may catch spin in a call it makes, not only as the leaf
+        spinning = [stack for stack in stacks if "spin (" in stack]
+        self.assertTrue(spinning)
+        # outermost frame first, the thread's entry point
+        self.assertTrue(spinning[0].startswith("_bootstrap ("))
+        # the sampling thread leaves itself out
+        self.assertFalse([stack for stack in stacks if "test_sample (" in stack])
+        line = collapsed(stacks).splitlines()[0]
+        self.assertEqual(int(line.rsplit(" ", 1)[1]), stacks.most_common(1)[0][1])
+
+    def test_one_profile_at_a_time(self):
+        """It should turn profiles away while one is running"""
+        self.assertTrue(self.profiler.acquire())
+        self.assertIsNone(self.profiler.sample(0.01, 0.001))
+        self.profiler.release()
+        self.assertIsNotNone(self.profiler.sample(0.01, 0.001))
+        self.assertEqual(self.profiler.stats(), {"profiles": 2, "rejected": 1, "running": False})
+
+    def test_overhead_bound(self):
+        """It should space samples so walking the stacks stays under the overhead bound"""
+        clock = [0.0]
+        pauses = []
+
+        def sleep(seconds):
+            pauses.append(seconds)
+            clock[0] += seconds
+
+        _, samples, _ = Profiler(clock=lambda: clock[0], sleep=sleep).sample(1.0, 0.0)
+        # the interval is never below a millisecond
+        self.assertTrue(all(pause >= 0.001 for pause in pauses))
+        self.assertEqual(samples, len(pauses) + 1)
+
+    def test_report(self):
+        """It should report a cProfile profile sorted by a known key"""
+        profile = cProfile.Profile()
+        profile.enable()
+        sorted(range(1000), key=str)
+        profile.disable()
+        self.assertIn("cumulative", Profiler.report(profile))
+        self.assertIn("internal time", Profiler.report(profile, "tottime"))
+        self.assertIn("cumulative", Profiler.report(profile, "bogus"))
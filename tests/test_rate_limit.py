@@ -0,0 +1,91 @@
+"""
+Test cases for the rate limit token buckets
+
+"""
+import os
+import tempfile
+import unittest
+
+from flask import Flask
+from service.rate_limit import MemoryStore, RateLimiter, SharedMemoryStore, client_key, create_store, trust_proxies
+
+CONFIG = {"RATE_LIMIT_STORE": "memory", "RATE_LIMIT_PER_SECOND": 2, "RATE_LIMIT_BURST": 10}
+
+
+######################################################################
+#  T O K E N   B U C K E T   T E S T   C A S E S
+######################################################################
+class TestTokenBuckets(unittest.TestCase):
+    """ Test Cases for the bucket stores """
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+
+    def check_bucket(self, store):
+        """Takes from a bucket until it is empty, then lets it refill"""
+        self.assertEqual(store.take("a", 6, 2, 10, 100.0), (True, 4))
+        self.assertEqual(store.take("a", 6, 2, 10, 100.0), (False, 4))
+        self.assertEqual(store.take("b", 6, 2, 10, 100.0), (True, 4))
+        self.assertEqual(store.take("a", 6, 2, 10, 101.0), (True, 0))
+        self.assertEqual(store.take("a", 1, 2, 10, 200.0), (True, 9))
+
+    def test_memory_store(self):
+        """It should keep buckets in process memory"""
+        self.check_bucket(MemoryStore())
+        store = MemoryStore(max_buckets=1)
+        store.take("a", 5, 1, 10, 0.0)
+        store.take("b", 5, 1, 10, 0.0)
+        self.assertEqual(store.take("a", 5, 1, 10, 0.0), (True, 5))
+
+    def test_shared_memory_store(self):
+        """It should share buckets between processes through the mapped file"""
+        self.check_bucket(SharedMemoryStore(self.path, slots=64))
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover - runs in the child
+            SharedMemoryStore(self.path, slots=64).take("c", 7, 2, 10, 300.0)
+            os._exit(0)  # pylint: disable=protected-access
+        os.waitpid(pid, 0)
+        self.assertEqual(SharedMemoryStore(self.path, slots=64).take("c", 7, 2, 10, 300.0), (False, 3))
+
+    def test_shared_memory_eviction(self):
+        """It should give the slot idle the longest to a new key when the table is full"""
+        store = SharedMemoryStore(self.path, slots=2)
+        store.take("a", 5, 1, 10, 0.0)
+        store.take("b", 5, 1, 10, 1.0)
+        self.assertEqual(store.take("c", 5, 1, 10, 2.0), (True, 5))
+        self.assertEqual(store.take("b", 5, 1, 10, 2.0), (True, 1))
+
+    def test_create_store(self):
+        """It should create the configured store"""
+        self.assertIsInstance(create_store("memory"), MemoryStore)
+        self.assertIsInstance(create_store("shm"), SharedMemoryStore)
+        self.assertEqual(create_store("shm", self.path).path, self.path)
+        self.assertEqual(RateLimiter().store("shm", self.path).path, self.path)
+        self.assertRaises(ValueError, create_store, "memcached://localhost")
+
+    def test_charge_headers(self):
+        """It should describe the bucket in RateLimit headers"""
+        limiter = RateLimiter()
+        allowed, headers = limiter.charge(CONFIG, "client", 4)
+        self.assertTrue(allowed)
+        self.assertEqual(headers["RateLimit-Limit"], "10")
+        self.assertEqual(headers["RateLimit-Remaining"], "6")
+        self.assertEqual(headers["RateLimit-Reset"], "2")
+        limiter.charge(CONFIG, "client", 4)
+        allowed, headers = limiter.charge(CONFIG, "client", 4)
+        self.assertFalse(allowed)
+        self.assertEqual(headers["Retry-After"], "1")
+        self.assertTrue(limiter.charge(CONFIG, "client", 50)[0] is False)
+
+    def test_trusted_proxies(self):
+        """It should only take the client address from the entries of trusted proxies"""
+        for hops, expected in [(0, "ip:10.0.0.9"), (1, "ip:203.0.113.7"), (2, "ip:198.51.100.1")]:
+            app = Flask(__name__)
+            app.config["TRUSTED_PROXY_HOPS"] = hops
+            app.add_url_rule("/", "client", client_key)
+            trust_proxies(app)
+            response = app.test_client().get("/", headers={"X-Forwarded-For": "198.51.100.1, 203.0.113.7"},
+                                             environ_base={"REMOTE_ADDR": "10.0.0.9"})
+            self.assertEqual(response.get_data(as_text=True), expected)
@@ -0,0 +1,71 @@
+"""
+Test cases for the read replica router
+
+"""
+import math
+import time
+import unittest
+
+from service.replicas import Replica, ReplicaRouter
+
+CONFIG = {
+    "DATABASE_REPLICA_URIS": [],
+    "REPLICA_READ_YOUR_WRITES_SECONDS": 5,
+    "REPLICA_MAX_LAG_SECONDS": 1,
+    "REPLICA_LAG_CHECK_SECONDS": 60,
+}
+UNREACHABLE = "sqlite:////nonexistent/replica.db"
+
+
+######################################################################
+#  R E P L I C A   R O U T E R   T E S T   C A S E S
+######################################################################
+class TestReplicaRouter(unittest.TestCase):
+    """ Test Cases for choosing the database of a read """
+
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.addCleanup(self.router.replicas, CONFIG)  # disposes of the engines
+
+    def test_no_replicas(self):
+        """It should read from the primary without replicas"""
+        self.assertIsNone(self.router.choose(CONFIG))
+        self.assertEqual(self.router.stats()["replica"], 0)
+
+    def test_round_robin(self):
+        """It should spread reads over the replicas"""
+        config = dict(CONFIG, DATABASE_REPLICA_URIS=["sqlite://", "sqlite://"])
+        engines = [self.router.choose(config) for _ in range(4)]
+        replicas = [replica.engine for replica in self.router.replicas(config)]
+        self.assertEqual(engines, replicas * 2)
+        self.assertEqual(self.router.stats()["replica"], 4)
+
+    def test_read_your_writes(self):
+        """It should send clients that just wrote to the primary"""
+        config = dict(CONFIG, DATABASE_REPLICA_URIS=["sqlite://"])
+        self.assertIsNone(self.router.choose(config, wrote_at=time.time() - 1))
+        self.assertIsNotNone(self.router.choose(config, wrote_at=time.time() - 10))
+        self.assertEqual(self.router.stats()["primary"], 1)
+
+    def test_unreachable_replica(self):
+        """It should skip replicas it cannot reach and fall back to the primary"""
+        config = dict(CONFIG, DATABASE_REPLICA_URIS=[UNREACHABLE, "sqlite://"])
+        healthy = self.router.replicas(config)[1].engine
+        self.assertEqual([self.router.choose(config) for _ in range(2)], [healthy, healthy])
+
+        config = dict(CONFIG, DATABASE_REPLICA_URIS=[UNREACHABLE])
+        self.assertIsNone(self.router.choose(config))
+        stats = self.router.stats()
+        self.assertEqual(stats["fallback"], 1)
+        self.assertEqual(stats["lag_seconds"], [math.inf])
+
+    def test_lag_is_cached(self):
+        """It should measure the lag of a replica once per check interval"""
+        replica = Replica(None)
+        measured = []
+        replica.measure = lambda: measured.append(1) or 3.0
+        self.assertEqual(replica.current_lag(60), 3.0)
+        self.assertEqual(replica.current_lag(60), 3.0)
+        self.assertEqual(len(measured), 1)
+        self.assertEqual(replica.current_lag(0), 3.0)
+        self.assertEqual(len(measured), 2)
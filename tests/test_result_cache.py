@@ -0,0 +1,76 @@
+"""
+Test cases for the result cache
+
+"""
+import contextlib
+import threading
+import unittest
+
+from service.result_cache import ResultCache
+from tests.clock import FakeClock
+
+
+######################################################################
+#  R E S U L T   C A C H E   T E S T   C A S E S
+######################################################################
+class TestResultCache(unittest.TestCase):
+    """ Test Cases for ResultCache """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.clock = FakeClock()
+        self.cache = ResultCache(partitions=("NEW", "RETURN"), ttl=5, stale=10, max_rows=4, clock=self.clock)
+        self.loads = 0
+
+    def load(self, rows=("row",)):
+        """Returns a loader counting its calls"""
+        def loader():
+            self.loads += 1
+            return list(rows)
+        return loader
+
+    def test_hit_until_invalidated(self):
+        """It should serve cached rows until a partition they were read from changes"""
+        self.assertEqual(self.cache.get("new", self.load(), ("NEW",)), ["row"])
+        self.cache.get("new", self.load(), ("NEW",))
+        self.cache.get("all", self.load())
+        self.cache.invalidate(("RETURN",))
+        self.cache.get("new", self.load(), ("NEW",))
+        self.assertEqual(self.loads, 2)
+        self.cache.get("all", self.load())
+        self.assertEqual(self.loads, 3)
+        self.cache.invalidate()
+        self.cache.get("new", self.load(), ("NEW",))
+        self.assertEqual(self.loads, 4)
+        self.assertEqual(self.cache.stats()["hits"], 2)
+        self.assertEqual(self.cache.stats()["hit_rate"], round(2 / 6, 4))
+
+    def test_expiry(self):
+        """It should reload expired rows, serving them stale only while refreshing in the background"""
+        self.cache.get("key", self.load())
+        self.clock.now = 6
+        self.cache.get("key", self.load())
+        self.assertEqual(self.loads, 2)
+
+        refreshed = threading.Event()
+        self.cache.init_app(contextlib.nullcontext, refreshed.set)
+        self.clock.now = 12
+        self.assertEqual(self.cache.get("key", self.load(["new row"])), ["row"])
+        self.assertTrue(refreshed.wait(5))
+        self.assertEqual(self.cache.get("key", self.load()), ["new row"])
+        self.assertEqual(self.cache.stats()["stale_hits"], 1)
+        self.clock.now = 100
+        self.cache.get("key", self.load())
+        self.assertEqual(self.cache.stats()["misses"], 3)
+
+    def test_bounded_rows(self):
+        """It should drop the least recently used entries beyond max_rows"""
+        self.cache.get("a", self.load(["1", "2"]))
+        self.cache.get("b", self.load(["3", "4"]))
+        self.cache.get("a", self.load())
+        self.cache.get("c", self.load(["5"]))
+        self.cache.get("too big", self.load(["6"] * 5))
+        stats = self.cache.stats()
+        self.assertEqual((stats["entries"], stats["rows"], stats["evictions"]), (2, 3, 1))
+        self.cache.get("a", self.load())
+        self.assertEqual(self.loads, 4)
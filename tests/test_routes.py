@@ -5,14 +5,27 @@ Test cases can be run with the following:
   nosetests -v --with-spec --spec-color
   coverage report -m
 """
+import gzip
+import json
 import logging
 import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timezone
 from urllib.parse import quote_plus
-from unittest import TestCase
-
-from service import app
-from service.common import status  # HTTP Status Codes
-from service.models import Inventory, db, init_db
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+import msgpack
+
+from service import admission, app, columnar, idempotency
+from service.common import assets, status  # HTTP Status Codes
+from service.common.compression import compress_stream, Compressor
+from service.common.representations import COLUMNAR_JSON, MSGPACK, to_columns
+from service.replicas import COOKIE, router as replica_router
+from service.models import (IdempotencyKey, Inventory, InventoryCheckpoint, InventoryHistory, InventoryLocation,
+                            Location, cached_results, columnar_snapshot, db, init_db, stock_table)
 from tests.factories import InventoryFactory
 
 DATABASE_URI = os.getenv(
@@ -46,6 +59,10 @@ class TestInventory(TestCase):
     def setUp(self):
         """ This runs before each test """
         self.client = app.test_client()
+        db.session.query(InventoryHistory).delete()
+        db.session.query(InventoryCheckpoint).delete()
+        db.session.query(InventoryLocation).delete()
+        db.session.query(Location).delete()
         db.session.query(Inventory).delete()  # clean up the last tests
         db.session.commit()
 
@@ -562,6 +579,40 @@ class TestInventory(TestCase):
         self.assertEqual(response.get_json(), {"status": "OK"})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_metrics(self):
+        """ It should report the per-process counters """
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("coalesced", response.get_json()["single_flight"])
+
+    def test_profiling(self):
+        """ It should profile the worker and flagged requests for holders of the token """
+        self.assertEqual(self.client.get("/admin/profile").status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(BASE_URL, headers={"X-Profile": "1"}).status_code, status.HTTP_200_OK)
+        old = app.config["PROFILING_TOKEN"]
+        self.addCleanup(app.config.__setitem__, "PROFILING_TOKEN", old)
+        app.config["PROFILING_TOKEN"] = "s3cret"
+        auth = {"Authorization": "Bearer s3cret"}
+
+        response = self.client.get("/admin/profile?seconds=0.05", headers={"Authorization": "Bearer nope"})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response.headers["WWW-Authenticate"], "Bearer")
+        response = self.client.get("/admin/profile?seconds=1000", headers=auth)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get("/admin/profile?seconds=0.05&interval_ms=5", headers=auth)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["X-Profiled-Pid"], str(os.getpid()))
+        self.assertGreater(int(response.headers["X-Profile-Samples"]), 0)
+
+        response = self.client.get(BASE_URL, headers={"X-Profile": "tottime", **auth})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["X-Profiled-Status"], "200")
+        self.assertIn("internal time", response.get_data(as_text=True))
+        self.assertIn("routes.py", response.get_data(as_text=True))
+        response = self.client.get(BASE_URL, headers={"X-Profile": "1", "Authorization": "Bearer nope"})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertFalse(self.client.get("/metrics").get_json()["profiling"]["running"])
+
     def test_checkout_features_success(self):
         """Test for cases when the checkout feature fails if product is not in the database"""
         test_record = InventoryFactory()
@@ -618,3 +669,673 @@ class TestInventory(TestCase):
         url = f"{BASE_URL}/reorder/{record.product_id + 1}/{record.condition.name}"
         response = self.client.put(url, json=request_body)
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    ######################################################################
+    # T E S T   S T O C K   S T R E A M
+    ######################################################################
+    def test_stream_stock_changes(self):
+        """It should stream the current stock and then each change"""
+        record = InventoryFactory(active=True, quantity=10)
+        response = self.client.post(BASE_URL, json=record.serialize())
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        heartbeat = app.config["STREAM_HEARTBEAT_SECONDS"]
+        self.addCleanup(app.config.__setitem__, "STREAM_HEARTBEAT_SECONDS", heartbeat)
+        app.config["STREAM_HEARTBEAT_SECONDS"] = 0.01
+        key = f"{record.product_id}:{record.condition.value}"
+        stream = self.client.get(f"{BASE_URL}/stream?keys={key}", buffered=False)
+        self.assertEqual(stream.status_code, status.HTTP_200_OK)
+        self.assertEqual(stream.mimetype, "text/event-stream")
+        chunks = iter(stream.response)
+        self.assertTrue(next(chunks).startswith(b"retry:"))
+        self.assertIn(b'"quantity": 10', next(chunks))
+
+        url = f"{BASE_URL}/checkout/{record.product_id}/{record.condition.name}"
+        response = self.client.put(url, json={"ordered_quantity": 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        chunk = next(chunks)
+        self.assertIn(b"event: stock", chunk)
+        self.assertIn(b'"quantity": 7', chunk)
+        # nothing else changed so the stream only sends heartbeats
+        self.assertEqual(next(chunks), b": keep-alive\n\n")
+        stream.close()
+
+    def test_stream_cap(self):
+        """It should turn streams away once the worker has as many open as it may"""
+        self.addCleanup(app.config.__setitem__, "STREAM_MAX_PER_WORKER", app.config["STREAM_MAX_PER_WORKER"])
+        app.config["STREAM_MAX_PER_WORKER"] = 1
+        stream = self.client.get(f"{BASE_URL}/stream?keys=1:new", buffered=False)
+        self.assertEqual(stream.status_code, status.HTTP_200_OK)
+        response = self.client.get(f"{BASE_URL}/stream?keys=1:new")
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.headers["Retry-After"], "3")
+        self.assertIn("Too many open streams", response.get_json()["message"])
+        self.assertEqual(self.client.get("/metrics").get_json()["streams"]["open"], 1)
+        stream.close()
+        stream = self.client.get(f"{BASE_URL}/stream?keys=1:new", buffered=False)
+        self.assertEqual(stream.status_code, status.HTTP_200_OK)
+        stream.close()
+        self.assertEqual(self.client.get("/metrics").get_json()["streams"]["open"], 0)
+
+    def test_export_cap(self):
+        """It should turn exports away once the worker is sending as many as it may"""
+        self.addCleanup(app.config.__setitem__, "EXPORT_MAX_PER_WORKER", app.config["EXPORT_MAX_PER_WORKER"])
+        app.config["EXPORT_MAX_PER_WORKER"] = 1
+        export = self.client.get(f"{BASE_URL}/export.csv", buffered=False)
+        self.assertEqual(export.status_code, status.HTTP_200_OK)
+        response = self.client.get(f"{BASE_URL}/export.csv")
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIn("Retry-After", response.headers)
+        export.close()
+        self.assertEqual(self.client.get(f"{BASE_URL}/export.csv", buffered=True).status_code, status.HTTP_200_OK)
+        response = self.client.get(f"{BASE_URL}/export.csv", query_string="quantity=1&operator=!")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get("/metrics").get_json()["exports"]["open"], 0)
+
+    def test_stream_bad_keys(self):
+        """It should not open a stream without valid keys"""
+        response = self.client.get(f"{BASE_URL}/stream")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(f"{BASE_URL}/stream?keys=abc:new")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(f"{BASE_URL}/stream?keys=1:broken")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batched_checkout_and_reorder(self):
+        """It should checkout and reorder through the group committer"""
+        self.addCleanup(app.config.__setitem__, "CHECKOUT_BATCHING", False)
+        app.config["CHECKOUT_BATCHING"] = True
+        record = InventoryFactory(active=True, quantity=10)
+        response = self.client.post(BASE_URL, json=record.serialize())
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        key = f"{record.product_id}/{record.condition.name}"
+        response = self.client.put(f"{BASE_URL}/checkout/{key}", json={"ordered_quantity": 4})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["quantity"], 6)
+        response = self.client.put(f"{BASE_URL}/checkout/{key}", json={"ordered_quantity": 40})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.put(f"{BASE_URL}/reorder/{key}", json={"ordered_quantity": 1})
+        self.assertEqual(response.get_json()["quantity"], 7)
+        response = self.client.put(f"{BASE_URL}/reorder/{record.product_id + 1}/{record.condition.name}",
+                                   json={"ordered_quantity": 1})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    ######################################################################
+    # T E S T   I D E M P O T E N C Y   K E Y S
+    ######################################################################
+    def test_idempotent_checkout_retry(self):
+        """It should apply a retried checkout with the same key only once"""
+        record = InventoryFactory(active=True, quantity=10)
+        response = self.client.post(BASE_URL, json=record.serialize())
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        url = f"{BASE_URL}/checkout/{record.product_id}/{record.condition.name}"
+        headers = {"Idempotency-Key": f"checkout-{record.product_id}"}
+        first = self.client.put(url, json={"ordered_quantity": 3}, headers=headers)
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(first.get_json()["quantity"], 7)
+        retry = self.client.put(url, json={"ordered_quantity": 3}, headers=headers)
+        self.assertEqual(retry.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry.get_json(), first.get_json())
+        self.assertEqual(retry.headers["Idempotent-Replayed"], "true")
+
+        # the replay also survives losing the in-process cache
+        idempotency.cache.clear()
+        retry = self.client.put(url, json={"ordered_quantity": 3}, headers=headers)
+        self.assertEqual(retry.get_json()["quantity"], 7)
+        response = self.client.get(f"{BASE_URL}/{record.product_id}/{record.condition.name}")
+        self.assertEqual(response.get_json()["quantity"], 7)
+
+        # reusing the key for another request is rejected
+        response = self.client.put(url, json={"ordered_quantity": 1}, headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_idempotent_create_and_failures(self):
+        """It should replay a create and let failed requests be retried"""
+        record = InventoryFactory()
+        headers = {"Idempotency-Key": f"create-{record.product_id}"}
+        response = self.client.post(BASE_URL, json=record.serialize(), headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.post(BASE_URL, json=record.serialize(), headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.headers["Idempotent-Replayed"], "true")
+
+        url = f"{BASE_URL}/reorder/{record.product_id + 1}/{record.condition.name}"
+        headers = {"Idempotency-Key": f"reorder-{record.product_id}"}
+        response = self.client.put(url, json={"ordered_quantity": 1}, headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIsNone(IdempotencyKey.find(headers["Idempotency-Key"]))
+
+        response = self.client.post(BASE_URL, json=record.serialize(),
+                                    headers={"Idempotency-Key": "x" * 256})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # a checkout commits with its stored response or not at all
+        record = InventoryFactory(active=True, quantity=10)
+        self.client.post(BASE_URL, json=record.serialize())
+        url = f"{BASE_URL}/checkout/{record.product_id}/{record.condition.name}"
+        headers = {"Idempotency-Key": f"checkout-{record.product_id}"}
+        with patch.object(IdempotencyKey, "complete", side_effect=RuntimeError("worker died")):
+            with self.assertRaises(RuntimeError):
+                self.client.put(url, json={"ordered_quantity": 1}, headers=headers)
+        response = self.client.get(f"{BASE_URL}/{record.product_id}/{record.condition.name}")
+        self.assertEqual(response.get_json()["quantity"], 10)
+        self.assertIsNone(IdempotencyKey.find(headers["Idempotency-Key"]))
+
+    ######################################################################
+    # T E S T   C O M P R E S S I O N
+    ######################################################################
+    def test_gzip_large_response(self):
+        """It should gzip responses above the size threshold"""
+        self._create_inventory_records(20)
+        response = self.client.get(BASE_URL, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response.vary)
+        self.assertEqual(len(json.loads(gzip.decompress(response.get_data()))), 20)
+
+        response = self.client.get(BASE_URL)
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(len(response.get_json()), 20)
+
+    def test_skip_small_response(self):
+        """It should not compress responses below the size threshold"""
+        response = self.client.get("/health", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(response.get_json(), {"status": "OK"})
+
+    def test_compress_stream(self):
+        """It should compress a stream chunk by chunk"""
+        chunks = list(compress_stream(iter([b"event one\n\n", "event two\n\n"]), Compressor("gzip", 6)))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(gzip.decompress(b"".join(chunks)), b"event one\n\nevent two\n\n")
+
+    def test_build_and_serve_assets(self):
+        """It should serve hashed, precompressed assets with long cache headers"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.addCleanup(setattr, app, "static_folder", app.static_folder)
+        shutil.copytree(app.static_folder, os.path.join(temp_dir, "static"),
+                        ignore=shutil.ignore_patterns(assets.DIST))
+        app.static_folder = os.path.join(temp_dir, "static")
+        manifest = assets.build_assets(app.static_folder)
+        hashed = manifest["js/rest_api.js"]
+        self.assertRegex(hashed, r"^js/rest_api\.[0-9a-f]{10}\.js$")
+
+        response = self.client.get("/", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertTrue(response.cache_control.no_cache)
+        self.assertIn(f"static/dist/{hashed}".encode(), gzip.decompress(response.get_data()))
+        response.close()
+
+        response = self.client.get(f"/static/dist/{hashed}", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertIn(response.mimetype, ("text/javascript", "application/javascript"))
+        self.assertEqual(response.cache_control.max_age, 365 * 24 * 60 * 60)
+        self.assertTrue(response.cache_control.immutable)
+        response.close()
+
+        response = self.client.get(f"/static/dist/{hashed}")
+        self.assertNotIn("Content-Encoding", response.headers)
+        response.close()
+        response = self.client.get("/static/dist/js/missing.js")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    ######################################################################
+    # T E S T   R E P R E S E N T A T I O N S
+    ######################################################################
+    def test_list_as_msgpack(self):
+        """It should list records as MessagePack"""
+        records = self._create_inventory_records(3)
+        response = self.client.get(BASE_URL, headers={"Accept": MSGPACK})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, MSGPACK)
+        self.assertIn("Accept", response.vary)
+        data = msgpack.unpackb(response.get_data())
+        self.assertEqual(sorted(row["product_id"] for row in data),
+                         sorted(record.product_id for record in records))
+
+        record = records[0]
+        response = self.client.get(f"{BASE_URL}/{record.product_id}/{record.condition.name}",
+                                   headers={"Accept": MSGPACK})
+        self.assertEqual(msgpack.unpackb(response.get_data())["name"], record.name)
+
+    def test_list_as_columns(self):
+        """It should list records in the columnar JSON layout"""
+        records = self._create_inventory_records(3)
+        response = self.client.get(BASE_URL, headers={"Accept": COLUMNAR_JSON})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, COLUMNAR_JSON)
+        data = json.loads(response.get_data())
+        self.assertEqual(sorted(data["product_id"]), sorted(record.product_id for record in records))
+        self.assertEqual(len(data["quantity"]), 3)
+
+        # JSON stays the default
+        response = self.client.get(BASE_URL)
+        self.assertEqual(response.mimetype, "application/json")
+        self.assertIn("Accept", response.vary)
+
+    def test_to_columns(self):
+        """It should only convert lists of records into columns"""
+        self.assertEqual(to_columns([{"a": 1, "b": 2}, {"a": 3, "b": 4}]), {"a": [1, 3], "b": [2, 4]})
+        self.assertEqual(to_columns([]), {})
+        self.assertEqual(to_columns({"a": 1}), {"a": 1})
+
+    def test_import_csv(self):
+        """It should import records from a CSV upload"""
+        body = "product_id,name,condition,quantity,active\n1,laptop,new,3,true\n2,desk,used,1,true\n"
+        response = self.client.post(f"{BASE_URL}/import", data=body, content_type="text/csv")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        report = response.get_json()
+        self.assertEqual((report["read"], report["imported"], report["rejected"]), (2, 1, 1))
+        self.assertEqual(report["rejected_rows"][0]["line"], 3)
+        response = self.client.get(f"{BASE_URL}/1/NEW")
+        self.assertEqual(response.get_json()["quantity"], 3)
+
+        response = self.client.post(f"{BASE_URL}/import", data=body, content_type="text/csv")
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        response = self.client.post(f"{BASE_URL}/import", query_string="on_conflict=update",
+                                    data=body.replace("laptop,new,3", "laptop,new,8"),
+                                    content_type="text/csv")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(f"{BASE_URL}/1/NEW").get_json()["quantity"], 8)
+
+        response = self.client.post(f"{BASE_URL}/import", data=body, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        response = self.client.post(f"{BASE_URL}/import", query_string="on_conflict=merge",
+                                    data=body, content_type="text/csv")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_csv(self):
+        """It should stream the filtered records as CSV"""
+        records = self._create_inventory_records(3)
+        response = self.client.get(f"{BASE_URL}/export.csv", buffered=True)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "text/csv")
+        self.assertIn("attachment", response.headers["Content-Disposition"])
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], "product_id,name,condition,quantity,active")
+        self.assertEqual(len(lines), 4)
+
+        record = records[0]
+        response = self.client.get(f"{BASE_URL}/export.csv", query_string=f"product_id={record.product_id}",
+                                   buffered=True)
+        self.assertEqual(response.get_data(as_text=True).splitlines()[1].split(",")[:3],
+                         [str(record.product_id), record.name, record.condition.value])
+
+        response = self.client.get(f"{BASE_URL}/export.csv", query_string="quantity=1&operator=!")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_names(self):
+        """It should search names by prefix and typo with pages"""
+        for product_id, name in enumerate(["laptop", "laptop stand", "lapdesk", "monitor"]):
+            record = InventoryFactory(product_id=product_id, name=name)
+            self.client.post(BASE_URL, json=record.serialize())
+        response = self.client.get(BASE_URL, query_string="q=lap&per_page=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 2)
+        self.assertIn('rel="next"', response.headers["Link"])
+        self.assertIn("page=2", response.headers["Link"])
+        response = self.client.get(BASE_URL, query_string="q=lap&per_page=2&page=2")
+        self.assertEqual(len(response.get_json()), 1)
+        self.assertNotIn("Link", response.headers)
+
+        response = self.client.get(BASE_URL, query_string="q=moniter")
+        self.assertEqual([row["name"] for row in response.get_json()], ["monitor"])
+        response = self.client.get(BASE_URL, query_string="q=lap&product_id=1")
+        self.assertEqual([row["name"] for row in response.get_json()], ["laptop stand"])
+
+        for query_string in ["q=lap&page=0", "q=lap&per_page=1000", "q=lap&page=x"]:
+            response = self.client.get(BASE_URL, query_string=query_string)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_history_and_as_of(self):
+        """It should return the history of a record and the inventory at a past time"""
+        record = InventoryFactory(quantity=10, active=True)
+        self.client.post(BASE_URL, json=record.serialize())
+        url = f"{BASE_URL}/{record.product_id}/{record.condition.name}"
+        before_checkout = datetime.now(timezone.utc).isoformat()
+        self.client.put(f"{BASE_URL}/checkout/{record.product_id}/{record.condition.name}",
+                        json={"ordered_quantity": 4})
+
+        response = self.client.get(f"{url}/history")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([entry["quantity"] for entry in response.get_json()], [10, 6])
+        response = self.client.get(f"{url}/history", query_string={"since": before_checkout})
+        self.assertEqual([entry["quantity"] for entry in response.get_json()], [6])
+        response = self.client.get(f"{url}/history", query_string="limit=1")
+        self.assertEqual(len(response.get_json()), 1)
+
+        response = self.client.get(BASE_URL, query_string={"as_of": before_checkout})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row["quantity"] for row in response.get_json()], [10])
+        response = self.client.get(BASE_URL, query_string={"as_of": before_checkout, "quantity": 10,
+                                                           "operator": "<"})
+        self.assertEqual(response.get_json(), [])
+
+        for query_string in ["limit=0", "since=yesterday"]:
+            response = self.client.get(f"{url}/history", query_string=query_string)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(f"{BASE_URL}/{record.product_id}/USED/history")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(f"{BASE_URL}/laptop/{record.condition.name}/history")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(BASE_URL, query_string={"as_of": before_checkout, "q": "x"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_locations(self):
+        """It should stock a record in locations and check out from the nearest"""
+        for code, latitude, longitude in [("NYC", 40.7, -74.0), ("LAX", 34.1, -118.2)]:
+            response = self.client.put(f"/api/locations/{code}",
+                                       json={"name": code, "latitude": latitude, "longitude": longitude})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row["code"] for row in self.client.get("/api/locations").get_json()], ["LAX", "NYC"])
+        self.assertEqual(self.client.get("/api/locations/NYC").get_json()["latitude"], 40.7)
+        self.assertEqual(self.client.get("/api/locations/SFO").status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.put("/api/locations/SFO", json={"name": "SFO", "latitude": 37})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        record = InventoryFactory(quantity=0, active=True)
+        self.client.post(BASE_URL, json=record.serialize())
+        url = f"{BASE_URL}/{record.product_id}/{record.condition.name}"
+        for code, quantity in [("NYC", 5), ("LAX", 8)]:
+            response = self.client.put(f"{url}/locations/{code}", json={"quantity": quantity})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["quantity"], 13)
+        self.assertEqual(self.client.get(f"{url}/locations").get_json(),
+                         [{"location": "LAX", "quantity": 8}, {"location": "NYC", "quantity": 5}])
+
+        checkout = f"{BASE_URL}/checkout/{record.product_id}/{record.condition.name}"
+        response = self.client.put(checkout, json={"ordered_quantity": 2, "latitude": 36.2, "longitude": -115.1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["Inventory-Location"], "LAX")
+        self.assertEqual(response.get_json()["quantity"], 11)
+        response = self.client.put(checkout, json={"ordered_quantity": 6, "location": "NYC"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        # a replayed checkout names the location it shipped from too
+        headers = {"Idempotency-Key": f"ship-{record.product_id}"}
+        for _ in range(2):
+            response = self.client.put(checkout, json={"ordered_quantity": 1, "location": "NYC"}, headers=headers)
+            self.assertEqual(response.headers["Inventory-Location"], "NYC")
+        self.assertEqual(response.headers["Idempotent-Replayed"], "true")
+
+        response = self.client.delete(f"{url}/locations/LAX")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.client.get(url).get_json()["quantity"], 4)
+        response = self.client.put(f"{url}/locations/SFO", json={"quantity": 1})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.put(f"{BASE_URL}/0/NEW/locations/NYC", json={"quantity": 1})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.put(f"{BASE_URL}/abc/NEW/locations/NYC", json={"quantity": 1})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(f"{BASE_URL}/abc/NEW/locations").status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_replica_reads(self):
+        """It should read from a replica unless the client just wrote"""
+        app.config["DATABASE_REPLICA_URIS"] = [DATABASE_URI]
+        self.addCleanup(app.config.__setitem__, "DATABASE_REPLICA_URIS", [])
+        InventoryFactory().create()
+        before = replica_router.stats()
+        response = self.client.get(BASE_URL)
+        self.assertEqual(len(response.get_json()), 1)
+        self.assertEqual(replica_router.stats()["replica"], before["replica"] + 1)
+        response = self.client.post(f"{BASE_URL}/lookup", json={"keys": [{"product_id": 1, "condition": "new"}]})
+        self.assertNotIn("Set-Cookie", response.headers)
+
+        response = self.client.post(BASE_URL, json=InventoryFactory().serialize())
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertIn(COOKIE, response.headers["Set-Cookie"])
+        response = self.client.get(BASE_URL)
+        self.assertEqual(len(response.get_json()), 2)
+        self.assertEqual(replica_router.stats()["primary"], before["primary"] + 1)
+        self.assertIn("replicas", self.client.get("/metrics").get_json())
+
+    def test_load_shedding(self):
+        """It should reject queued routes with 503 and Retry-After when the queue is full"""
+        controller = admission.controller
+        self.addCleanup(setattr, controller, "queue_size", controller.queue_size)
+        self.addCleanup(setattr, controller, "window_seconds", controller.window_seconds)
+        controller.queue_size, controller.window_seconds = 0, float("inf")
+        held = int(controller.limit)
+        for _ in range(held):
+            controller.acquire(admission.CRITICAL, 0)
+        try:
+            response = self.client.get(BASE_URL)
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(response.headers["Retry-After"], "1")
+            self.assertEqual(self.client.get("/health").status_code, status.HTTP_200_OK)
+        finally:
+            for _ in range(held):
+                controller.release()
+        self.assertEqual(self.client.get(BASE_URL).status_code, status.HTTP_200_OK)
+        self.assertIn("admission", self.client.get("/metrics").get_json())
+
+    def test_admission_held_while_streaming(self):
+        """It should hold the admission slot of a streamed response until its body is sent"""
+        self._create_inventory_records(2)
+        controller = admission.controller
+        in_flight = controller.stats()["in_flight"]
+        export = self.client.get(f"{BASE_URL}/export.csv", buffered=False)
+        self.assertEqual(export.status_code, status.HTTP_200_OK)
+        self.assertEqual(controller.stats()["in_flight"], in_flight + 1)
+        self.assertTrue(next(export.response).startswith(b"product_id,"))
+        self.assertEqual(controller.stats()["in_flight"], in_flight + 1)
+        export.close()
+        self.assertEqual(controller.stats()["in_flight"], in_flight)
+        self.client.get(BASE_URL)
+        self.assertEqual(controller.stats()["in_flight"], in_flight)
+
+    def test_rate_limit(self):
+        """It should charge clients for their requests and refuse them once out of tokens"""
+        app.config.update(RATE_LIMIT=True, RATE_LIMIT_STORE="memory", RATE_LIMIT_BURST=12)
+        self.addCleanup(app.config.update, RATE_LIMIT=False, RATE_LIMIT_STORE="shm", RATE_LIMIT_BURST=200)
+        headers = {"X-Api-Key": "test-rate-limit"}
+        response = self.client.get(BASE_URL, headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["RateLimit-Limit"], "12")
+        self.assertEqual(response.headers["RateLimit-Remaining"], "2")
+        response = self.client.get(BASE_URL, headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn("Retry-After", response.headers)
+        self.assertEqual(len(response.headers.getlist("RateLimit-Remaining")), 1)
+        response = self.client.get(f"{BASE_URL}?name=x", headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("RateLimit-Limit", self.client.get("/health").headers)
+
+    def test_rate_limit_per_address(self):
+        """It should give clients without an API key a bucket per address"""
+        app.config.update(RATE_LIMIT=True, RATE_LIMIT_STORE="memory", RATE_LIMIT_BURST=12)
+        self.addCleanup(app.config.update, RATE_LIMIT=False, RATE_LIMIT_STORE="shm", RATE_LIMIT_BURST=200)
+        first, second = ({"REMOTE_ADDR": address} for address in ("192.0.2.1", "192.0.2.2"))
+        self.assertEqual(self.client.get(BASE_URL, environ_base=first).status_code, status.HTTP_200_OK)
+        response = self.client.get(BASE_URL, environ_base=first)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        response = self.client.get(BASE_URL, environ_base=second)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["RateLimit-Remaining"], "2")
+
+    def test_lookup_many_keys(self):
+        """It should return the records of many keys and the keys not found"""
+        records = self._create_inventory_records(3)
+        keys = [{"product_id": record.product_id, "condition": record.condition.value} for record in records]
+        missing = {"product_id": 0, "condition": "return"}
+        response = self.client.post(f"{BASE_URL}/lookup", json={"keys": [keys[2], missing, keys[0], keys[1]]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([(record["product_id"], record["condition"]) for record in data["records"]],
+                         [(key["product_id"], key["condition"]) for key in (keys[2], keys[0], keys[1])])
+        self.assertEqual(data["missing"], [missing])
+
+        app.config["LOOKUP_CHUNK_SIZE"] = 1
+        self.addCleanup(app.config.__setitem__, "LOOKUP_CHUNK_SIZE", 250)
+        response = self.client.post(f"{BASE_URL}/lookup", json={"keys": keys})
+        self.assertEqual(len(response.get_json()["records"]), 3)
+        for body in ({"keys": []}, {"keys": [{"product_id": 1}]}, {"keys": [{"product_id": 1, "condition": "old"}]},
+                     {"keys": "1:new"}, [keys[0]]):
+            response = self.client.post(f"{BASE_URL}/lookup", json=body)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_read_every_condition(self):
+        """It should return a product in every condition"""
+        record = InventoryFactory(condition=Inventory.Condition.NEW)
+        record.create()
+        InventoryFactory(product_id=record.product_id, condition=Inventory.Condition.RETURN).create()
+        response = self.client.get(f"{BASE_URL}/{record.product_id}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item["condition"] for item in response.get_json()], ["new", "return"])
+        response = self.client.get(f"{BASE_URL}/0")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_query_filter_expression(self):
+        """It should filter with IN lists, ranges and OR groups, and sort"""
+        for product_id, condition, quantity, active in ((1, "NEW", 5, True), (2, "RETURN", 20, True),
+                                                         (3, "REFURBISHED", 40, True), (4, "NEW", 60, False)):
+            InventoryFactory(product_id=product_id, condition=Inventory.Condition[condition],
+                             quantity=quantity, active=active).create()
+        resp = self.client.get(BASE_URL, query_string={
+            "filter": "condition in (new, return) and quantity in 10..60 or active = false and quantity < 100",
+            "sort": "-quantity",
+        })
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([record["product_id"] for record in resp.get_json()], [4, 2])
+        resp = self.client.get(BASE_URL, query_string={"sort": "condition,-product_id"})
+        self.assertEqual([record["product_id"] for record in resp.get_json()], [4, 1, 3, 2])
+        for query in ({"filter": "quantity = many"}, {"filter": "price > 3"}, {"sort": "active"},
+                      {"sort": "name", "q": "desk"}, {"quantity": "x", "operator": "="}):
+            resp = self.client.get(BASE_URL, query_string=query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_count_records(self):
+        """It should count the matching records, with or without them"""
+        records = self._create_inventory_records(5)
+        new = len([record for record in records if record.condition == Inventory.Condition.NEW])
+        resp = self.client.get(BASE_URL, query_string={"count": "exact", "condition": "new"})
+        self.assertEqual(resp.headers["X-Total-Count"], str(new))
+        self.assertEqual(len(resp.get_json()), new)
+        resp = self.client.head(BASE_URL, query_string={"count": "exact"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["X-Total-Count"], "5")
+        self.assertEqual(resp.get_data(), b"")
+        # small counts are exact even when an estimate is asked for
+        resp = self.client.head(BASE_URL, query_string={"count": "estimate"})
+        self.assertEqual(resp.headers["X-Total-Count"], "5")
+        app.config["COUNT_ESTIMATE_MIN"] = 0
+        self.addCleanup(app.config.__setitem__, "COUNT_ESTIMATE_MIN", 1000)
+        resp = self.client.head(BASE_URL, query_string={"count": "estimate"})
+        self.assertGreaterEqual(int(resp.headers["X-Total-Count-Estimate"]), 5)
+        for query in ({"count": "some"}, {"count": "exact", "q": "desk"}, {"count": "exact", "filter": "x = 1"}):
+            resp = self.client.get(BASE_URL, query_string=query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_cached_list_results(self):
+        """It should serve repeated lists from the cache until a record changes"""
+        self.addCleanup(app.config.__setitem__, "RESULT_CACHE", app.config["RESULT_CACHE"])
+        app.config["RESULT_CACHE"] = True
+        record = InventoryFactory(condition=Inventory.Condition.NEW, active=True)
+        record.create()
+        before = cached_results.stats()
+        for _ in range(3):
+            resp = self.client.get(BASE_URL, query_string={"condition": "new", "active": "True"})
+            self.assertEqual(len(resp.get_json()), 1)
+        self.assertEqual(cached_results.stats()["hits"], before["hits"] + 2)
+        other = InventoryFactory(product_id=record.product_id, condition=Inventory.Condition.RETURN)
+        other.create()
+        self.client.get(BASE_URL, query_string={"condition": "new", "active": "True"})
+        self.assertEqual(cached_results.stats()["hits"], before["hits"] + 3)
+        resp = self.client.post(BASE_URL, json=InventoryFactory(condition=Inventory.Condition.NEW,
+                                                                active=True).serialize())
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.client.get(BASE_URL, query_string={"condition": "new", "active": "True"})
+        self.assertEqual(len(resp.get_json()), 2)
+        self.assertIn("result_cache", self.client.get("/metrics").get_json())
+
+    def test_cached_list_after_write_elsewhere(self):
+        """It should read past the cache for a client that wrote through another worker"""
+        self.addCleanup(app.config.__setitem__, "RESULT_CACHE", app.config["RESULT_CACHE"])
+        app.config["RESULT_CACHE"] = True
+        record = InventoryFactory(condition=Inventory.Condition.NEW, active=True, quantity=1)
+        record.create()
+        query = {"condition": "new", "active": "True"}
+        self.assertEqual(self.client.get(BASE_URL, query_string=query).get_json()[0]["quantity"], 1)
+        # another worker updates the record; this worker's cache does not hear of it
+        table = Inventory.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.update().where(table.c.product_id == record.product_id).values(quantity=7))
+        self.assertEqual(self.client.get(BASE_URL, query_string=query).get_json()[0]["quantity"], 1)
+        # that worker gave the client the write cookie
+        self.client.set_cookie("localhost", COOKIE, f"{time.time():.3f}")
+        self.assertEqual(self.client.get(BASE_URL, query_string=query).get_json()[0]["quantity"], 7)
+
+    @skipUnless(columnar.available(), "needs numpy")
+    def test_columnar_snapshot_list(self):
+        """It should answer lists from the columnar snapshot once it is loaded"""
+        records = [InventoryFactory(product_id=i, active=True, quantity=10 * i) for i in range(1, 4)]
+        for record in records:
+            record.create()
+        records[0].set_shard_count(2)
+        query = {"filter": "active = true and product_id in 1..3", "sort": "-product_id"}
+        expected = self.client.get(BASE_URL, query_string=query).get_json()
+
+        self.addCleanup(columnar_snapshot.clear)
+        self.addCleanup(app.config.__setitem__, "COLUMNAR_SNAPSHOT", False)
+        app.config["COLUMNAR_SNAPSHOT"] = True
+        columnar_snapshot.clear()
+        self.assertTrue(columnar_snapshot.refresh())
+        served = columnar_snapshot.served
+        self.assertEqual(self.client.get(BASE_URL, query_string=query).get_json(), expected)
+        self.assertEqual(columnar_snapshot.served, served + 1)
+
+        # changes show up once the snapshot is refreshed, sharded quantities included
+        key = f"{records[0].product_id}/{records[0].condition.name}"
+        resp = self.client.put(f"{BASE_URL}/checkout/{key}", json={"ordered_quantity": 4})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.client.delete(f"{BASE_URL}/{records[2].product_id}/{records[2].condition.name}")
+        columnar_snapshot.refresh()
+        resp = self.client.get(BASE_URL, query_string={"product_id": records[0].product_id})
+        self.assertEqual([record["quantity"] for record in resp.get_json()], [6])
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 2)
+        # names are compared by the database
+        resp = self.client.get(BASE_URL, query_string={"sort": "name"})
+        self.assertEqual(len(resp.get_json()), 2)
+        self.assertEqual(columnar_snapshot.served, served + 3)
+        self.assertIn("columnar", self.client.get("/metrics").get_json())
+
+    def test_shared_stock_table_reads(self):
+        """It should read single records from the shared stock table once it is refreshed after a write"""
+        handle, path = tempfile.mkstemp(prefix="inventory-stock-")
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        self.addCleanup(app.config.__setitem__, "STOCK_TABLE", False)
+        self.addCleanup(stock_table.close)
+        self.addCleanup(setattr, stock_table, "interval", stock_table.interval)
+        self.addCleanup(setattr, stock_table, "path", stock_table.path)
+        stock_table.close()
+        stock_table.path, stock_table.interval = path, 3600
+        app.config["STOCK_TABLE"] = True
+
+        record = InventoryFactory(active=True, quantity=10)
+        resp = self.client.post(BASE_URL, json=record.serialize())
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        url = f"{BASE_URL}/{record.product_id}/{record.condition.name}"
+        self.assertTrue(stock_table.elect())
+        stock_table.refresh()
+        hits = stock_table.hits
+        resp = self.client.get(url)
+        self.assertEqual(resp.get_json(), record.serialize())
+        self.assertEqual(stock_table.hits, hits + 1)
+
+        # the client that wrote reads the database until the table is refreshed
+        resp = self.client.put(f"{BASE_URL}/checkout/{record.product_id}/{record.condition.name}",
+                               json={"ordered_quantity": 4})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(url).get_json()["quantity"], 6)
+        self.assertEqual(stock_table.hits, hits + 1)
+        stock_table.refresh()
+        self.assertEqual(self.client.get(url).get_json()["quantity"], 6)
+        self.assertEqual(stock_table.hits, hits + 2)
+        self.assertEqual(self.client.get(f"{BASE_URL}/0/NEW").status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIn("stock_table", self.client.get("/metrics").get_json())
@@ -0,0 +1,70 @@
+"""
+Test cases for the name search helpers
+
+"""
+import unittest
+
+from sqlalchemy import create_engine, event, text
+
+from service import search
+
+
+######################################################################
+#  N A M E   S E A R C H   T E S T   C A S E S
+######################################################################
+class TestSearch(unittest.TestCase):
+    """ Test Cases for the name search helpers """
+
+    def test_trigrams(self):
+        """It should extract trigrams like pg_trgm"""
+        self.assertEqual(search.trigrams("Cat"), {"  c", " ca", "cat", "at "})
+        self.assertEqual(search.trigrams("a-b"), {"  a", " a ", "  b", " b "})
+        self.assertEqual(search.trigrams("!!"), set())
+
+    def test_similarity(self):
+        """It should score shared trigrams from 0 to 1"""
+        self.assertEqual(search.similarity("laptop", "LAPTOP"), 1.0)
+        self.assertEqual(search.similarity("laptop", ""), 0.0)
+        self.assertGreater(search.similarity("laptop", "laptp"), search.MIN_SIMILARITY)
+        self.assertLess(search.similarity("laptop", "monitor"), search.MIN_SIMILARITY)
+
+    def test_like_prefix(self):
+        """It should escape LIKE wildcards"""
+        self.assertEqual(search.like_prefix("lap"), "lap%")
+        self.assertEqual(search.like_prefix("50%_off\\"), "50\\%\\_off\\\\%")
+
+    def test_fts_query(self):
+        """It should OR the raw trigrams of the search text"""
+        self.assertEqual(search.fts_query("Lapt"), '"apt" OR "lap"')
+        self.assertEqual(search.fts_query('a"b'), '"a""b"')
+        self.assertIsNone(search.fts_query("la"))
+
+    def test_rank(self):
+        """It should rank prefixes before similar names"""
+        self.assertEqual(search.rank("lap", "laptop")[0], 0)
+        self.assertEqual(search.rank("laptp", "laptop")[0], 1)
+        self.assertIsNone(search.rank("lap", "monitor"))
+        self.assertLess(search.rank("laptop", "laptop"), search.rank("laptop", "laptop stand"))
+
+    def test_init_search_rebuilds_when_stale(self):
+        """It should rebuild the SQLite index only when it is new or out of sync"""
+        engine = create_engine("sqlite://")
+        rebuilds = []
+        event.listen(engine, "before_cursor_execute",
+                     lambda *args: rebuilds.append(args[2]) if args[2] == search.SQLITE_REBUILD else None)
+        with engine.begin() as connection:
+            connection.execute(text("CREATE TABLE inventory (name TEXT)"))
+            connection.execute(text("INSERT INTO inventory (name) VALUES ('laptop'), ('monitor')"))
+        search.init_search(engine)
+        self.assertEqual(len(rebuilds), 1)
+        with engine.begin() as connection:
+            connection.execute(text("INSERT INTO inventory (name) VALUES ('laptop stand')"))
+            self.assertEqual(connection.execute(text(f"SELECT count(*) FROM {search.FTS_TABLE} "
+                                                     f"WHERE {search.FTS_TABLE} MATCH 'lap'")).scalar(), 2)
+        search.init_search(engine)
+        self.assertEqual(len(rebuilds), 1)
+        with engine.begin() as connection:
+            connection.execute(text("DROP TRIGGER inventory_name_fts_insert"))
+            connection.execute(text("INSERT INTO inventory (name) VALUES ('keyboard')"))
+        search.init_search(engine)
+        self.assertEqual(len(rebuilds), 2)
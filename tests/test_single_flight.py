@@ -0,0 +1,58 @@
+"""
+Test cases for single-flight coalescing
+
+"""
+import threading
+import unittest
+
+from service.common.single_flight import SingleFlight
+
+
+######################################################################
+#  S I N G L E   F L I G H T   T E S T   C A S E S
+######################################################################
+class TestSingleFlight(unittest.TestCase):
+    """ Test Cases for SingleFlight """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.flights = SingleFlight()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def slow_query(self):
+        """Blocks until released and counts its executions"""
+        self.calls += 1
+        self.release.wait(5)
+        return ["row"]
+
+    def test_coalesce_concurrent_calls(self):
+        """It should run one query for concurrent callers of the same key"""
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.flights.do("key", self.slow_query)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while self.flights.stats()["coalesced"] < 4:
+            threading.Event().wait(0.001)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [["row"]] * 5)
+        self.assertEqual(self.flights.stats(), {"executed": 1, "coalesced": 4, "in_flight": 0})
+
+    def test_sequential_calls_run_again(self):
+        """It should not reuse results once a call has finished"""
+        self.release.set()
+        self.flights.do("key", self.slow_query)
+        self.flights.do("key", self.slow_query)
+        self.flights.do("other", self.slow_query)
+        self.assertEqual(self.calls, 3)
+
+    def test_share_errors(self):
+        """It should raise the leader's error and forget the key"""
+        def failing():
+            raise KeyError("boom")
+        self.assertRaises(KeyError, self.flights.do, "key", failing)
+        self.assertEqual(self.flights.stats()["in_flight"], 0)
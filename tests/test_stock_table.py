@@ -0,0 +1,88 @@
+"""
+Test cases for the shared stock table
+
+"""
+import os
+import tempfile
+import unittest
+
+from service.models import Inventory
+from service.stock_table import SharedStockTable
+from tests.clock import FakeClock
+from tests.test_columnar import NEW, RETURN, FakeTable
+
+
+######################################################################
+#  S T O C K   T A B L E   T E S T   C A S E S
+######################################################################
+class TestSharedStockTable(unittest.TestCase):
+    """ Test Cases for SharedStockTable """
+
+    def setUp(self):
+        """ This runs before each test """
+        handle, self.path = tempfile.mkstemp(prefix="inventory-stock-")
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+        self.clock = FakeClock(1000.0)
+        self.table = FakeTable()
+        self.table.put(1, "laptop", NEW, 10)
+        self.table.put(1, "laptop", RETURN, 2, active=False)
+        self.table.put(2, "x" * 70, NEW, 5)
+        self.stock = self.open()
+
+    def open(self):
+        """Returns a SharedStockTable on the test file"""
+        stock = SharedStockTable(conditions=list(Inventory.Condition), path=self.path, slots=64,
+                                 max_staleness=5, clock=self.clock)
+        stock.init_app(self.table.load)
+        self.addCleanup(stock.close)
+        return stock
+
+    def test_lookup(self):
+        """It should answer reads from the last published region"""
+        self.assertIsNone(self.stock.lookup(1, NEW))
+        self.assertTrue(self.stock.elect())
+        self.stock.refresh()
+        reader = self.open()
+        self.assertEqual(reader.lookup(1, NEW)[:3], ("laptop", 10, True))
+        self.assertEqual(reader.lookup(1, RETURN)[:3], ("laptop", 2, False))
+        # unknown keys and names too long for a slot are left to the database
+        self.assertIsNone(reader.lookup(3, NEW))
+        self.assertIsNone(reader.lookup(2, NEW))
+        self.assertEqual((reader.hits, reader.misses), (2, 2))
+        # nor is the table read before the client's last write or once it is too old
+        self.assertIsNone(reader.lookup(1, NEW, not_before=self.clock.now))
+        self.clock.now += 6
+        self.assertIsNone(reader.lookup(1, NEW))
+        self.assertEqual(reader.stale, 2)
+
+    def test_refresh(self):
+        """It should publish changes and deletions through both regions"""
+        self.stock.elect()
+        self.stock.refresh()
+        self.stock.refresh()
+        self.table.put(1, "laptop", NEW, 7)
+        self.table.put(4, "desk", NEW, 1)
+        for _ in range(2):
+            self.stock.refresh()
+            self.assertEqual(self.stock.lookup(1, NEW)[1], 7)
+            self.assertEqual(self.stock.lookup(4, NEW)[1], 1)
+        # each region was loaded in full once, then only read the changes
+        self.assertEqual(self.table.loads[:2], [None, None])
+        self.assertNotIn(None, self.table.loads[2:])
+
+        del self.table.rows[(4, NEW)]
+        self.stock.refresh()
+        self.assertIsNone(self.stock.lookup(4, NEW))
+        # the incremental read found a count that did not match and reloaded the region
+        self.assertEqual(self.table.loads[-1], None)
+
+    def test_single_writer(self):
+        """It should let a single process write the table"""
+        self.assertTrue(self.stock.elect())
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover - the child process
+            other = SharedStockTable(conditions=list(Inventory.Condition), path=self.path, slots=64)
+            os._exit(0 if other.elect() else 3)
+        _, code = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(code), 3)
@@ -0,0 +1,68 @@
+"""
+Test cases for compiled request validation
+
+"""
+import unittest
+
+from flask_restx import fields
+from service.validation import Issue, Validator, api_fields
+from tests.schemas import SCHEMA, Color
+
+
+######################################################################
+#  V A L I D A T I O N   T E S T   C A S E S
+######################################################################
+class TestValidator(unittest.TestCase):
+    """ Test Cases for Validator """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.validator = Validator(SCHEMA)
+
+    def test_clean_values(self):
+        """It should return the clean values of a valid dict"""
+        values, issues = self.validator.validate(
+            {"id": 3, "color": "red", "label": "x", "count": 2, "enabled": False, "extra": 1}
+        )
+        self.assertEqual(issues, [])
+        self.assertEqual(values, {"id": 3, "color": Color.RED, "label": "x", "count": 2, "enabled": False})
+
+    def test_collect_every_issue(self):
+        """It should report every bad field of a row at once"""
+        values, issues = self.validator.validate({"id": 3, "color": "green", "label": 7, "count": -1,
+                                                  "enabled": "yes"})
+        self.assertEqual([issue.field for issue in issues], ["color", "label", "count", "enabled"])
+        self.assertEqual([issue.out_of_range for issue in issues], [True, False, True, False])
+        self.assertEqual(values, {"id": 3})
+
+    def test_empty_values_are_missing(self):
+        """It should skip None and empty values, but keep False"""
+        values, issues = self.validator.validate({"label": "", "count": 0, "enabled": False})
+        self.assertEqual((values, issues), ({"enabled": False}, []))
+
+    def test_bool_is_not_an_int(self):
+        """It should not take a boolean for an integer"""
+        _, issues = self.validator.validate({"count": True})
+        self.assertEqual(issues, [Issue("count", "count must be an integer", False)])
+
+    def test_incomplete_key_is_ignored(self):
+        """It should leave out the key unless all of it is present with the right types"""
+        self.assertEqual(self.validator.validate({"id": 3, "label": "x"}), ({"label": "x"}, []))
+        self.assertEqual(self.validator.validate({"id": "3", "color": "red"}), ({}, []))
+        self.assertEqual(self.validator.validate({"id": 0, "color": "blue"}), ({"id": 0, "color": Color.BLUE}, []))
+
+    def test_validate_many(self):
+        """It should validate a list of rows in order"""
+        results = self.validator.validate_many([{"label": "a"}, "nope", {"count": -2}])
+        self.assertEqual(results[0], ({"label": "a"}, []))
+        self.assertEqual(results[1][1][0].message, "row must be an object")
+        self.assertEqual(results[2][1][0].message, "count must be at least 0")
+
+    def test_api_fields(self):
+        """It should document the named fields with their types and choices"""
+        documented = api_fields(SCHEMA, ("color", "count", "enabled"), required=True)
+        self.assertEqual(list(documented), ["color", "count", "enabled"])
+        self.assertIsInstance(documented["count"], fields.Integer)
+        self.assertEqual(documented["count"].minimum, 0)
+        self.assertEqual(documented["color"].enum, ["red", "blue"])
+        self.assertTrue(documented["enabled"].required)